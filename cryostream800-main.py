@@ -9,12 +9,12 @@
 
 
 # Port Information:
-# Port 30303 UDP - Get  Identification Packets. (Not Using)
+# Port 30303 UDP - Get  Identification Packets. (Discovery, cryostream_discovery.py)
 # Port 30304 UDP - Get  Status Packets.
 # Port 30305 UDP - Send Commands.
 
 ##########################
-### Python 2.7 Edition ###
+### Python 2.7 and 3 Ed. ###
 ##########################
 
 #Authors:
@@ -23,13 +23,28 @@
 
 import sys
 from cryostream800 import Cryostream800
+from cryostream_discovery import connect
+from cryostream_journal import CommandJournal
+from cryostream_cache import StatusCache
 
 ############
 ### Main ###
 ############
 
 #Please, Update Your IP!
+#Or give a name, controller number or coldhead number found by discovery:
+#python cryostream800-main.py BL821
 
-BL821_Cryostream800 = Cryostream800(ip="121.223.76.47")
+#Sequences (Shutdown and Get Ready, Annealing, ...) are journaled in ~/.cryostream_journal.jsonl
+#If this program is killed in the middle of one, it is finished on the next start
+journal = CommandJournal()
+
+#The last status is cached in ~/.cryostream_cache, limits and serials are known before the first broadcast
+statusCache = StatusCache()
+
+if len(sys.argv) > 1:
+    BL821_Cryostream800 = connect(sys.argv[1], journal=journal, statusCache=statusCache)
+else:
+    BL821_Cryostream800 = Cryostream800(ip="121.223.76.47", journal=journal, statusCache=statusCache)
 
 BL821_Cryostream800.terminal_displayMenu()
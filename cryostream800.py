@@ -1,3 +1,6 @@
+from __future__ import print_function
+
+import numbers
 import os
 import re
 import socket
@@ -5,16 +8,29 @@ import struct
 import subprocess
 from subprocess import CalledProcessError, PIPE
 import sys
+import threading
 import time
 
+from cryostream_clock import DeviceClock, enableKernelTimestamps, receiveStamped
+from cryostream_errors import CryostreamError, ForeignSourceError, MalformedPacketError, InvalidCommandError, ConfirmationTimeout, StatusTimeout
+from cryostream_integrity import PacketValidator
+from cryostream_models import getModel
+from cryostream_retry import AdaptiveRetryPolicy
+
 # Useful for parsing XML files
 # Should be activated if not using _buildOxCryoPropertiesInline() Method
 # import xml.etree.ElementTree as ET
 
-# Python 2.7 Edition.
-# Remember to run with Python2.7 otherwise it will not work.
-# Porting to Python3 should be straightforward.
-# We are running this version for business reasons, but we could for sure use Python3.
+# Python 2.7 and Python 3 Edition.
+# Status packets are handled as bytes (bytearray, memoryview) and decoded with struct,
+# which works the same way on both versions, without a per-byte ord().
+# Public method names are the same as in the Python 2.7 only edition.
+
+# Compatibility Layer - raw_input was renamed to input in Python 3
+try:
+    _input = raw_input
+except NameError:
+    _input = input
 
 #Authors:
 #John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
@@ -24,11 +40,81 @@ import time
 class Cryostream800:
 
     # Constructor
-    def __init__(self, ip):
+    # raiseOnTimeout: if True, commands with confirmation raise ConfirmationTimeout instead of returning False
+    # statusTimeout: seconds to wait for a status packet before raising StatusTimeout, None waits forever
+    # statusListener: SharedStatusListener (cryostream_listener.py) to receive the status from, when several devices
+    #                 are controlled from the same process. None opens port 30304 on every status read.
+    # transport: object replacing the sockets, with waitForPacket(ip, deadline) for the status and
+    #            sendCommand(packet, address) for the commands, e.g. FaultInjectingTransport (cryostream_faults.py)
+    # journal: CommandJournal (cryostream_journal.py) recording the multi-step sequences, None for no journal
+    #          A sequence interrupted by a crash is reconciled with the first status, see recoverJournal()
+    # statusCache: StatusCache (cryostream_cache.py) to start from the last known status, None waits for a broadcast
+    #              With a cached status the constructor returns at once and the live status is read in the background
+    #              Limits and identity are right at once, call waitForLiveStatus() before relying on the run mode
+    # model: Cryostream model (cryostream_models.py), "800" (default) or "1000", or a CryostreamModel
+    #        The transport, cache, confirmation and journal are the same, the model chooses how anneal() works
+    def __init__(self, ip, raiseOnTimeout = False, statusTimeout = 5.0, statusListener = None, transport = None,
+                 journal = None, statusCache = None, model = None):
 
         # Stores IP of the Cryostream 800
         self._ip = ip
 
+        # Model of the device, raises UnknownModelError before anything is opened
+        self._model = getModel(model)
+
+        # Shared receiver of the status broadcasts, or None
+        self._statusListener = statusListener
+
+        # Replaces the status and command sockets, or None
+        self._transport = transport
+
+        # Journal of the multi-step sequences, or None, and the id of the sequence running
+        self._journal        = journal
+        self._activeSequence = None
+
+        # Default deadline of every status read
+        # The device broadcasts every second, a few seconds without status means it is off or filtered
+        self._statusTimeout = statusTimeout
+
+        # Time when the last status packet was received, see getStatusAge()
+        # Stamped by the kernel when the platform allows it (cryostream_clock.py)
+        self._lastStatusTime = None
+        self._lastPacketTime = None
+
+        # Offset and drift of the device clock ("Real time", "Real date") relative to the host clock
+        self._deviceClock = DeviceClock()
+
+        # Warm-start cache, the status read from it (None if the status is live from the start),
+        # and set once a status packet was received from the network, see isLiveStatus()
+        self._statusCache  = statusCache
+        self._cachedStatus = None
+        self._liveStatus   = threading.Event()
+
+        # Longest pause (s) between two attempts to read the first live status after a warm start
+        self._maxCatchUpDelay = 60.0
+
+        # Status reads in a row that may time out while a profile waits for the end of a phase, see runProfile()
+        self._maxPhaseTimeouts = 3
+
+        # Field offsets of the status packets of this device, shared by every snapshot (see getSnapshot())
+        self._packetLayout = None
+
+        # Errors are raised (cryostream_errors.py), the library never exits the process
+        self._raiseOnTimeout = raiseOnTimeout
+
+        # Bad packets are skipped and counted instead of stopping the program
+        # "foreign": packets broadcast by other devices, "malformed": packets that could not be decoded,
+        # "late": packets older than the last status (reordered by the network)
+        self._packetErrors = {"foreign": 0, "malformed": 0, "late": 0}
+
+        # Number of malformed packets in a row before giving up with an exception
+        # Packets of other devices are skipped until the status deadline, a wrong IP is reported then
+        self._maxSkippedPackets = 10
+
+        # Checks size, checksum and sequence of every status packet (cryostream_integrity.py)
+        # Only packets that pass are kept as last status, so snapshots can be trusted by the confirmation logic
+        self._packetValidator = PacketValidator()
+
         # Port where status is broadcasted as UDP to all subnetwork
         self._statusPort = 30304
 
@@ -53,6 +139,10 @@ class Cryostream800:
         # Inline Version, increases efficiency
         self._oxCryoProperties = self._buildOxCryoPropertiesInline()
 
+        # Labels of the properties broadcast as enumerations (Run mode, Phase id, AF Mode, ...)
+        # For instance self._oxCryoEnums[1053][2] retrieves "Ready".
+        self._oxCryoEnums = self._buildOxCryoEnumsInline()
+
         # Path for file with Cryostream Data
         # Stores the List of Commands
         # !!! Needs to be defined if inline functions are not used
@@ -69,18 +159,60 @@ class Cryostream800:
         # If not reading from file, more efficient, pre-calculated
         self._commandBook = self._getCommandBookInline()
 
-        #print("Updating Status Information...")
-        # Update Status:
-        # 1) Retrieves the binary status packet from the network
-        # 2) Parses the binary status packet
-        # 3) Updates the last Status dictionary
-        self._updateStatus() 
+        # Resend intervals and deadlines of the commands with confirmation
+        # Learned from the send -> confirmation latencies observed on this device
+        self._retryPolicy = AdaptiveRetryPolicy()
+
+        # Guards the last status, held only while it is replaced, never while a packet is awaited
+        # Status reads from several threads (cryostream_daemon.py, the warm start catch-up, commands) share it
+        self._statusLock = threading.RLock()
+
+        # Only one thread receives at a time, the others wait on the condition for the status it reads
+        # _statusCount grows with every status read from the network
+        self._statusCondition = threading.Condition(self._statusLock)
+        self._receivingStatus = False
+        self._statusCount     = 0
+
+        # Set by preempt() to make a running confirmation loop give up at its next attempt
+        # Used by the command scheduler so Stop does not wait for a slow Cool or Restart
+        self._preemptEvent = threading.Event()
+
+        # Last status from the cache, if any
+        # A sequence interrupted by a crash is reconciled with the live status before anything else is done
+        cachedStatus = None
+        if self._statusCache is not None:
+            cachedStatus = self._statusCache.load(ip)
+            if cachedStatus is not None and self._journal is not None and self._journal.getInterrupted(ip):
+                cachedStatus = None
+
+        if cachedStatus is not None:
+
+            # Warm start: getters and command checks use the cached status (with its real age)
+            # until the first live status arrives, read in the background
+            self._loadCachedStatus(cachedStatus)
+
+            catchUp = threading.Thread(target = self._catchUpStatus, name = "CryostreamCatchUp-" + ip)
+            catchUp.daemon = True
+            catchUp.start()
+
+        else:
+
+            #print("Updating Status Information...")
+            # Update Status:
+            # 1) Retrieves the binary status packet from the network
+            # 2) Parses the binary status packet
+            # 3) Updates the last Status dictionary
+            self._updateStatus() 
+
+            # Finishes or rolls back a sequence interrupted by a crash, now that the status is known
+            if self._journal is not None:
+                self.recoverJournal()
 
     # Method to print a Cryostream 800 object
     # Pending Implementation
     def __str__(self):
         s = ""
-        s += "Model: Cryostream 800"
+        s += "Model: " + self._model.getName()
         return s
 
     #==================================
@@ -117,7 +249,7 @@ class Cryostream800:
 
         except ET.ParseError:
             print("Invalid XML format")
-            exit(1)
+            raise
 
     # Populates a Dictionary called _oxCryoProperties with All Cryostream 800 Properties
     # This method avoids us to read from a file
@@ -128,7 +260,8 @@ class Cryostream800:
     # Programming Use:
     # _oxCryoProperties[1003] would return the string "Max Temp"
     # File also available at: https://connect.oxcryo.com/ethernetcomms/OxcryoProperties.xml
-    def _buildOxCryoPropertiesInline(self):
+    @staticmethod
+    def _buildOxCryoPropertiesInline():
 
 
         tempDictionary = dict()
@@ -138,6 +271,37 @@ class Cryostream800:
         return tempDictionary
 
 
+    # Populates a Dictionary with the labels of the Cryostream 800 Properties that are enumerations
+    # ID, {Value: Label}
+    # 1053, {0: "Initializing", 1: "Initialization Failed", 2: "Ready", ...}
+    # Run modes and phases from Cryostream.xml (LIST_OF_MODES, LIST_OF_PHASES), modes from the command options.
+    # Run mode labels are the ones used by this class since the first version, other methods compare against them.
+    # File also available at: https://connect.oxcryo.com/ethernetcomms/Cryostream.xml
+    @staticmethod
+    def _buildOxCryoEnumsInline():
+
+        tempDictionary = dict()
+
+        tempDictionary = {1053: {0: 'Initializing', 1: 'Initialization Failed', 2: 'Ready', 3: 'Running', 4: 'Set up Mode', 5: 'Shut down without error', 6: 'Shut down with error'}, 1054: {0: 'Ramp', 1: 'Cool', 2: 'Plat', 3: 'Hold', 4: 'End', 5: 'Purge', 6: 'Erase', 7: 'Load', 8: 'Save', 9: 'Purge', 10: 'Wait', 11: 'Regen', 12: 'Regen'}, 1068: {0: 'Off', 1: 'On', 2: 'On (Automatic)', 3: 'On (Automatic)'}, 1209: {0: 'Manual', 1: 'Auto', 2: 'Scheduled'}, 2519: {0: 'Always off', 1: 'Always on', 2: 'Auto'}}
+
+        return tempDictionary
+
+    # Populates a Dictionary with the units of the Cryostream 800 Properties
+    # This method avoids us to read from a file
+    # ID, (Units broadcast by the device, Units shown to the user)
+    # 1051, ("cK", "K")
+    # 1060, ("dl/min", "l/min")
+    # Properties without units are not in the dictionary
+    # File also available at: https://connect.oxcryo.com/ethernetcomms/OxcryoProperties.xml
+    @staticmethod
+    def _buildOxCryoUnitsInline():
+
+        tempDictionary = dict()
+
+        tempDictionary = {1002: ('cK', 'K'), 1003: ('cK', 'K'), 1031: ('hour', 'hour'), 1032: ('cK', 'K'), 1050: ('cK', 'K'), 1051: ('cK', 'K'), 1052: ('cK', 'cK'), 1055: ('K/hour', 'K/hour'), 1056: ('cK', 'K'), 1057: ('cK', 'K'), 1058: ('cK', 'K'), 1059: ('min', 'min'), 1060: ('dl/min', 'l/min'), 1061: ('%', '%'), 1062: ('%', '%'), 1063: ('%', '%'), 1064: ('cbar', 'mbar'), 1066: ('min', 'min'), 1067: ('%', '%'), 1069: ('%', '%'), 1070: ('%', '%'), 1081: ('min', 'min'), 1083: ('min', 'min'), 1084: ('cK', 'K'), 1085: ('cK', 'K'), 1086: ('cK', 'K'), 1087: ('cK', 'K'), 1088: ('%', '%'), 1089: ('%', '%'), 1090: ('%', '%'), 1091: ('cl/min', 'l/min'), 1092: ('mbar', 'mbar'), 1097: ('rpm', 'rpm'), 1100: ('cl/min', 'l/min'), 1101: ('mbar', 'mbar'), 1102: ('mbar', 'mbar'), 1103: ('%', '%'), 1106: ('cl/min', 'l/min'), 1109: ('bits', 'bits'), 1110: ('bits', 'bits'), 1111: ('%', '%'), 1112: ('cl/min', 'l/min'), 1113: ('cl/min', 'l/min'), 1115: ('ds', 's'), 1203: ('c%', '%'), 1207: ('c%', '%'), 1208: ('c%', '%'), 1408: ('C', 'C'), 1409: ('C', 'C'), 1410: ('C', 'C'), 1411: ('dbar', 'bar'), 1412: ('dbar', 'bar'), 1413: ('hour', 'hour'), 1414: ('rpm', 'rpm'), 1415: ('rpm', 'rpm'), 1416: ('cV', 'cV'), 1417: ('cV', 'cV'), 1418: ('hour', 'hour'), 1419: ('rpm', 'rpm'), 1420: ('min', 'min'), 1421: ('rpm', 'rpm'), 1422: ('min', 'min'), 1423: ('rpm', 'rpm'), 1424: ('rpm', 'rpm'), 1425: ('min', 'min'), 1426: ('min', 'min'), 1427: ('min', 'min'), 1428: ('s', 's'), 1429: ('hour', 'hour'), 1431: ('dbar', 'bar'), 1432: ('dbar', 'bar'), 1433: ('dbar', 'bar'), 1434: ('hour', 'hour'), 1435: ('hour', 'hour'), 1503: ('C', 'C'), 1504: ('cC', 'C'), 1505: ('mbar', 'mbar'), 1506: ('mbar', 'mbar'), 1507: ('rpm', 'rpm'), 1508: ('%', '%'), 1509: ('mA', 'mA'), 1515: ('s', 's'), 1516: ('V', 'V'), 1517: ('V', 'V'), 1519: ('hour', 'hour'), 1604: ('cK', 'K'), 1605: ('K/hour', 'K/hour'), 1606: ('s', 's'), 1701: ('mbar', 'mbar'), 1804: ('Hz', 'Hz'), 1805: ('cV', 'V'), 1806: ('cV', 'V'), 1807: ('cA', 'A'), 1808: ('cC', 'C'), 1809: ('mbar', 'mbar'), 1813: ('hour', 'hour'), 1900: ('cK', 'K'), 1901: ('cK', 'K'), 1902: ('bits', 'bits'), 2001: ('rpm', 'rpm'), 2002: ('%', '%'), 2010: ('cK', 'K'), 2011: ('cK', 'K'), 2012: ('mV', 'mV'), 2013: ('cK', 'K'), 2014: ('%', '%'), 2015: ('%', '%'), 2016: ('%', '%'), 2017: ('%', '%'), 2019: ('%', '%'), 2020: ('%', '%'), 2022: ('hour', 'hour'), 2023: ('min', 'min'), 2024: ('min', 'min'), 2030: ('cK', 'K'), 2031: ('cK', 'K'), 2034: ('min', 'min'), 2041: ('cK', 'K'), 2042: ('mbar', 'mbar'), 2043: ('dl/min', 'l/min'), 2045: ('min', 'min'), 2046: ('cK', 'K'), 2047: ('s', 's'), 2048: ('s', 's'), 2500: ('mbar', 'mbar'), 2501: ('%', '%'), 2502: ('C', 'C'), 2513: ('%', '%'), 2514: ('cK', 'K'), 2520: ('cl/min', 'l/min'), 2615: ('cl/min', 'l/min'), 2620: ('C', 'C'), 2621: ('dbar', 'bar'), 2622: ('dbar', 'bar'), 3001: ('cK', 'K'), 3002: ('cK', 'K'), 3003: ('mW', 'mW'), 3004: ('mW', 'mW'), 3005: ('cK', 'K'), 3006: ('cK', 'K'), 3007: ('mW', 'mW'), 3008: ('mW', 'mW'), 4004: ('cl/min', 'cl/min'), 4005: ('cl/min', 'cl/min'), 4006: ('rpm', 'rpm'), 4007: ('cK', 'K'), 6004: ('V', 'V'), 6005: ('Hz', 'Hz'), 6006: ('V', 'V'), 6007: ('V', 'V'), 6008: ('mA', 'A')}
+
+        return tempDictionary
+
     # Populates a Dictionary called _oxCryoProperties with All Cryostream 800 Properties
     # ID, Name
     # 1002, Min Temp
@@ -148,57 +312,27 @@ class Cryostream800:
     # File also available at: https://connect.oxcryo.com/ethernetcomms/OxcryoProperties.xml
     def _parseBinaryStatusPacket(self, binaryStatusPacket):
 
-        # Lists which stores the binary status packet retrieved from the internet
-        # However we use the list format to be more acessible and able to navigate using indexes
-        binaryStatusList = []
-
-        for byte in binaryStatusPacket:
-            binaryStatusList.append(byte)
-
         # Sanity Check - Currently at 1148 parameters
-        if (len(binaryStatusList)%4) != 0:
-            print("The number of elements on the status package from Cryostream 800 is")
-            print("It should be a multiple of 4, if it is not, something is wrong.")
-            print("Please, Please contact support.")
-            sys.exit(1)
+        # It should be a multiple of 4, if it is not, something is wrong (truncated or corrupted packet).
+        if (len(binaryStatusPacket)%4) != 0:
+            raise MalformedPacketError("The status packet from Cryostream 800 has " + str(len(binaryStatusPacket)) + " bytes, it should be a multiple of 4.")
 
-        # List that Stores tuples of data (cmdID, value)
-        parsedStatusList = []
-
-        # Iterate elements in groups of 4
-        for i in range(0, len(binaryStatusList), 4):
-
-            # Gets Current Group of 4 Elements
-            group = binaryStatusList[i: (i + 4)]
-
-            # For more details on this math, please visit
-            # OxCryo Cryostream 800 Ethernet Communications Documentation
-            # https://connect.oxcryo.com/ethernetcomms/status.html
+        # For more details on this math, please visit
+        # OxCryo Cryostream 800 Ethernet Communications Documentation
+        # https://connect.oxcryo.com/ethernetcomms/status.html
 
-            # Relative to the Command
-            a = int(ord(group[0])) << 8  # Multiplies by 256
-            b = int(ord(group[1])) & 0xFF
+        # The packet is a sequence of groups of 4 bytes: 2 bytes command id, 2 bytes value.
+        # Both are big endian unsigned 16 bit integers, so the whole packet is decoded in a single struct call.
+        # Works for str (Python 2.7), bytes (Python 3), bytearray and memoryview.
+        words = struct.unpack_from(">" + str(len(binaryStatusPacket) // 2) + "H", binaryStatusPacket)
 
-            # Relative to the Parameters
-            c = int(ord(group[2])) << 8  # Multiplies by 256
-            d = int(ord(group[3])) & 0xFF
-
-            # By Definition
-            # Check https://connect.oxcryo.com/ethernetcomms/status.html
-            cmdId = a + b
-            value = c + d
-
-            # Temporary Tuple
-            tempTuple = (cmdId, value)
+        # List that Stores tuples of data (cmdID, value)
+        # Even positions are the ids, odd positions the values
+        parsedStatusList = list(zip(words[0::2], words[1::2]))
 
-            # Enable this line for EPICS debugging purposes
-            #print(tempTuple, group,(a,b,c,d))
+        # Enable this line for EPICS debugging purposes
+        #print(parsedStatusList)
 
-            #print(tempTuple)
-            
-            # append to the parsed status list
-            parsedStatusList.append(tempTuple)
-                    
         return parsedStatusList
 
     # Builds dictionary with the last status of the Cryostream 800
@@ -231,27 +365,131 @@ class Cryostream800:
     # 1) Get Binary Packet from the Network
     # 2) Parse the binary status
     # 3) Update the dictionary on memory
-    def _updateStatus(self):
+    # timeout: seconds to wait for a valid status packet, None uses the default given to the constructor
+    # Raises StatusTimeout if no valid packet arrives in time, the last status is kept
+    # One thread at a time receives, the others wait for its status instead of queueing on the socket:
+    # a caller never waits past its own deadline, and takes over if the receiving thread gives up
+    def _updateStatus(self, timeout = None):
+
+        if timeout is None:
+            timeout = self._statusTimeout
+
+        # Deadline shared by every packet read, including the skipped ones
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
 
         # IP is useful to verify if the broadcasted message on the subnetwork
         # It is really coming from our CS800 device and not other device.
         CS800sIP = self.getIP()
- 
-        # print("Retrieving Cryostream 800 Status Packet from the Network...")
 
-        # Retrieves the binary status packet broadcasted to the subnetwork as UDP
-        # Notice that the packet is still in binary format
-        self._lastBinaryStatusPacket = self._getBinaryStatusPacket(CS800sIP)
+        with self._statusCondition:
 
-        # print("Parsing Cryostream 800 binary status packet...")
-        
-        # Stores the parsed binary status packet in the form of list of tuples
-        # list = [(11007, 97), (2515, 64), (2021, 65534),...]
-        self._lastBinaryStatusList = self._parseBinaryStatusPacket(self._lastBinaryStatusPacket)
+            statusCount = self._statusCount
 
-        # print("Updating last status Information on memory...")
-        
-        self._lastStatus = self._buildLastStatus(self._lastBinaryStatusList, self._oxCryoProperties) 
+            while self._receivingStatus:
+
+                if deadline is None:
+                    self._statusCondition.wait(1.0)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise StatusTimeout(CS800sIP, deadline)
+                    self._statusCondition.wait(remaining)
+
+                # The receiving thread got a status packet after this call started, it is ours too
+                if self._statusCount != statusCount:
+                    return
+
+            self._receivingStatus = True
+
+        try:
+
+            # print("Retrieving Cryostream 800 Status Packet from the Network...")
+
+            # Malformed packets are skipped and counted, we wait for the next one
+            malformedPackets = 0
+
+            while True:
+
+                # Retrieves the binary status packet broadcasted to the subnetwork as UDP
+                # Notice that the packet is still in binary format
+                binaryStatusPacket = self._getBinaryStatusPacket(CS800sIP, deadline)
+
+                # print("Parsing Cryostream 800 binary status packet...")
+
+                # Stores the parsed binary status packet in the form of list of tuples
+                # list = [(11007, 97), (2515, 64), (2021, 65534),...]
+                try:
+                    binaryStatusList = self._parseBinaryStatusPacket(binaryStatusPacket)
+                    # A packet that arrived late is older than the last status, we wait for the next one
+                    if not self._packetValidator.check(binaryStatusPacket):
+                        self._packetErrors["late"] += 1
+                        continue
+                    break
+                except MalformedPacketError:
+                    self._packetErrors["malformed"] += 1
+                    malformedPackets += 1
+                    if malformedPackets >= self._maxSkippedPackets:
+                        raise
+
+            # print("Updating last status Information on memory...")
+
+            lastStatus = self._buildLastStatus(binaryStatusList, self._oxCryoProperties)
+
+            # The lock is only held while the status is replaced, never while receiving
+            with self._statusCondition:
+
+                self._lastBinaryStatusPacket = binaryStatusPacket
+                self._lastBinaryStatusList   = binaryStatusList
+                self._lastStatusTime         = self._lastPacketTime
+                self._lastStatus             = lastStatus
+                self._statusCount           += 1
+
+                self._deviceClock.add(self._lastStatusTime, lastStatus.get("Real time"), lastStatus.get("Real date"))
+
+                self._liveStatus.set()
+
+            if self._statusCache is not None:
+                self._statusCache.update(CS800sIP, binaryStatusPacket, self._lastStatusTime)
+
+        finally:
+
+            # Wakes up the waiting callers: they return with the new status, or one of them receives next
+            with self._statusCondition:
+                self._receivingStatus = False
+                self._statusCondition.notify_all()
+
+    # Uses a status read from the cache (cryostream_cache.py) as last status
+    # The status keeps the time it was received, so getStatusAge() tells how old it is
+    def _loadCachedStatus(self, cachedStatus):
+
+        with self._statusLock:
+            self._lastBinaryStatusPacket = cachedStatus.getPacket()
+            self._lastBinaryStatusList   = self._parseBinaryStatusPacket(cachedStatus.getPacket())
+            self._lastStatusTime         = cachedStatus.getTime()
+            self._lastStatus             = self._buildLastStatus(self._lastBinaryStatusList, self._oxCryoProperties)
+            self._packetLayout           = cachedStatus.getLayout()
+            self._cachedStatus           = cachedStatus
+
+    # Reads the first live status after a warm start, waits as long as the device is silent
+    # Backs off between attempts, and stops as soon as any other read got a live status
+    def _catchUpStatus(self):
+
+        delay    = 1.0
+        reported = False
+
+        while not self._liveStatus.is_set():
+
+            try:
+                self._updateStatus()
+            except CryostreamError as e:
+                if not reported:
+                    print("No live status from " + self._ip + " yet, using the cached status (" + str(e) + "). Retrying in the background.")
+                    reported = True
+                if self._liveStatus.wait(delay):
+                    break
+                delay = min(delay * 2, self._maxCatchUpDelay)
 
     # Deactivated while using _getCommandBookInline()
     """
@@ -296,7 +534,8 @@ class Cryostream800:
 
     # Returns a list of Commands, Used to Increase Efficiency in relation to _getCommandBook()
     # File also available at: https://connect.oxcryo.com/ethernetcomms/Cryostream.xml
-    def _getCommandBookInline(self):
+    @staticmethod
+    def _getCommandBookInline():
 
         commandsDict = dict()
 
@@ -360,18 +599,15 @@ class Cryostream800:
 
         # Cryostream 800 requires 7 bytes as input to generate a binary command.
         if len(cmdList) != 7:
-            print("Error in binarizeListOfCommands(): In order to create a binary command to the Cryojet 800, it is necessary to have a list of exactly 7 integers between 0 and 255, in order to generate a binary command of size 7 bytes.")
-            sys.exit(1)
+            raise InvalidCommandError("In order to create a binary command to the Cryostream 800, it is necessary to have a list of exactly 7 integers between 0 and 255, in order to generate a binary command of size 7 bytes.")
 
         # Convert the integers to binary and pack them into a single variable
         binary_data = struct.pack("7B", *cmdList)
 
         # For Inspection purposes only
         # Convert the binary data to a binary string
-        # Python 3 Version:
-        # binary_string = ''.join(format(byte, '08b') for byte in binary_data)
-        # Python 2 Version: 
-        binary_string = ''.join(format(ord(byte), '08b') for byte in binary_data)
+        # bytearray gives integers on Python 2.7 and Python 3
+        binary_string = ''.join(format(byte, '08b') for byte in bytearray(binary_data))
 
         return binary_data
 
@@ -391,6 +627,10 @@ class Cryostream800:
         # print("Generating Binary Command.")
         binary  = self._binarizeCommand(cmdList)
 
+        # Written ahead, so a crash right after the send still knows the command may have reached the device
+        if self._journal is not None and self._activeSequence is not None:
+            self._journal.command(self._activeSequence, command, p1, p2)
+
         # Open connection and sends the command
         # print("Sending Binary Command to the Cryostream 800.")
         self._submitBinaryCommand(binary)
@@ -401,7 +641,25 @@ class Cryostream800:
 
     # Function to capture status packets from Cryostream 800.
     # This device broadcasts a status packet every second on the network on port 30304.
-    def _getBinaryStatusPacket(self, interestIP):
+    # deadline: time.time() value after which StatusTimeout is raised, None waits forever
+    def _getBinaryStatusPacket(self, interestIP, deadline = None):
+
+        # The receive time of the packet is kept in self._lastPacketTime
+
+        # The transport, if any, hands us the packets of our IP
+        # A transport without receive timestamps gets the packets stamped when they are handed over
+        if self._transport is not None:
+            if hasattr(self._transport, "waitForStampedPacket"):
+                packet, self._lastPacketTime = self._transport.waitForStampedPacket(interestIP, deadline)
+            else:
+                packet = self._transport.waitForPacket(interestIP, deadline)
+                self._lastPacketTime = time.time()
+            return packet
+
+        # Port 30304 is owned by a listener shared with other devices, it hands us the packets of our IP
+        if self._statusListener is not None:
+            packet, self._lastPacketTime = self._statusListener.waitForStampedPacket(interestIP, deadline)
+            return packet
 
         # The maximum size of the buffer to receive the UDP packets.
         bufMax = 8192
@@ -430,35 +688,46 @@ class Cryostream800:
             # This effectively tells the operating system that any UDP packets arriving on this port should be directed to this program.
             s.bind(idBroadcast)
 
-            # Receiving data from the socket. This is a blocking call that waits for data to arrive.
-            # 'm' contains the data of the received packet, and 'reportedAddress' contains the address of the sender.
-            m, broadcasterNetworkInfo = s.recvfrom(bufMax)
+            # The kernel stamps each packet when it arrives, the time spent before recv() does not count
+            kernelTimestamps = enableKernelTimestamps(s)
 
-            # broadcasterNetworkInfo variable should contain the IP and Port, Saving just the IP
-            # Because the port we already know 30304
-            broadcasterIP = broadcasterNetworkInfo[0]
+            # IP of the last packet that came from another device, None if there was none
+            foreignIP = None
 
-            if(broadcasterIP == interestIP):
-                return m
-            else:
-                print("The UDP packet captured from the subnetwork is coming from " + broadcasterIP + ".")
-                print("You are trying to communicate with " + interestIP + ".")
-                print("Please, call for help and check these things:")
-                print("- Are you trying to connect to the right Cryostream 800 (" + interestIP + ")?")
-                print("- Check IP settings on your Cryostream 800.")
-                print("- The packet being broadcasted on the network is it coming from the expected device?")
-                sys.exit(-1)
+            while True:
+
+                # The receive is bounded by the deadline, so a powered off device cannot hang the caller
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise self._getStatusTimeoutError(interestIP, deadline, foreignIP)
+                    s.settimeout(remaining)
+
+                # Receiving data from the socket. This is a blocking call that waits for data to arrive.
+                # 'm' contains the data of the received packet, and 'reportedAddress' contains the address of the sender.
+                try:
+                    m, broadcasterNetworkInfo, receiveTime = receiveStamped(s, bufMax, kernelTimestamps)
+                except socket.timeout:
+                    raise self._getStatusTimeoutError(interestIP, deadline, foreignIP)
+
+                # broadcasterNetworkInfo variable should contain the IP and Port, Saving just the IP
+                # Because the port we already know 30304
+                broadcasterIP = broadcasterNetworkInfo[0]
+
+                if(broadcasterIP == interestIP):
+                    self._lastPacketTime = receiveTime
+                    return m
+
+                # Another device broadcasting on the subnetwork, the packet is skipped and counted
+                # With many devices on the subnetwork most packets are foreign, only the deadline ends the wait
+                self._packetErrors["foreign"] += 1
+                foreignIP = broadcasterIP
 
         except KeyboardInterrupt:
 
             # A way to exit the program gracefully if the user hits Ctrl+C (commonly used to signal program interruption).
             print("Exiting program.")
-
-        except Exception as e:
-
-            # Catching any other exceptions that could occur to avoid crashing and to log the error.
-            #print(e)
-            print("An error occurred: " + e)
+            raise
 
         finally:
 
@@ -466,12 +735,29 @@ class Cryostream800:
             # This is important to release the system resources associated with the socket.
             s.close()
 
+    # Returns the error raised when no status packet of the device arrived before the deadline
+    # ForeignSourceError if other devices broadcast and nothing ever came from this one (probably the wrong IP),
+    # StatusTimeout otherwise
+    def _getStatusTimeoutError(self, interestIP, deadline, foreignIP):
+
+        if foreignIP is not None and self._lastPacketTime is None:
+            return ForeignSourceError(interestIP, foreignIP)
+
+        return StatusTimeout(interestIP, deadline)
+
     # Sends a binary command to the Cryostream 800
     def _submitBinaryCommand(self, bin):
 
         ip   = self.getIP()
         port = 30305
 
+        # Spaces consecutive commands, so retries never flood the command port
+        self._retryPolicy.waitForSendSlot()
+
+        if self._transport is not None:
+            self._transport.sendCommand(bin, (ip, port))
+            return
+
         # Creates an UDP Socket.
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
@@ -518,22 +804,8 @@ class Cryostream800:
         attribute    = "Run mode"
         runMode = self._lastStatus[attribute]
 
-        if runMode == 0:
-            message = "Initializing"
-        elif runMode == 1:
-            message = "Initialization Failed"
-        elif runMode == 2:
-            message = "Ready"
-        elif runMode == 3:
-            message = "Running"
-        elif runMode == 4:
-            message = "Set up Mode"
-        elif runMode == 5:
-            message = "Shut down without error"
-        elif runMode == 6:
-            message = "Shut down with error"
-        else:
-            message = "Unknown mode"
+        # Table lookup, labels in _buildOxCryoEnumsInline()
+        message = self._oxCryoEnums[1053].get(runMode, "Unknown mode")
 
         return message
 
@@ -573,14 +845,8 @@ class Cryostream800:
         attribute    = "AF Mode"
         runMode = self._lastStatus[attribute]
 
-        if runMode == 0:
-            message = "Manual"
-        elif runMode == 1:
-            message = "Auto"
-        elif runMode == 2:
-            message = "Scheduled"
-        else:
-            message = "Unknown mode"
+        # Table lookup, labels in _buildOxCryoEnumsInline()
+        message = self._oxCryoEnums[1209].get(runMode, "Unknown mode")
 
         return message 
 
@@ -592,6 +858,26 @@ class Cryostream800:
 
 
 
+    #=====================================================
+    #=== Kernel - Get Commands - Generic (All Fields) ===
+    #=====================================================
+
+    # The getters above cover the most used fields, these cover every field of the status packet.
+    # Fields are read by name ("CD Coldhead hours") or ID (1434), see cryostream_catalog.py.
+
+    # Returns any property in its output units (e.g. K, l/min, bar), None if not broadcast
+    def getProperty(self, prop):
+        return self.getSnapshot().get(prop)
+
+    # Returns any property as text: enumeration label ("Running") or value with units ("100.0 K")
+    def getPropertyText(self, prop):
+        return self.getSnapshot().getText(prop)
+
+    # Returns every property of a subsystem, name -> value in output units
+    # Subsystems: "FC" flow controller, "CD" Cryodrive, "PU" pump, "AF" autofill, "DAU", "SRB", ...
+    def getSubsystemStatus(self, subsystem):
+        return self.getSnapshot().getSubsystem(subsystem)
+
     #=====================================================
     #=== My Implementations - Get Commands - Low Level ===
     #=====================================================
@@ -611,6 +897,30 @@ class Cryostream800:
     def getCommandsPort(self):
         return self._commandsPort
 
+    # Returns the model of the device, a CryostreamModel (cryostream_models.py)
+    def getModel(self):
+        return self._model
+
+    # Returns how anneal() will anneal with the last status: "native", "flowInterrupt" or "software"
+    def getAnnealMethod(self):
+        return self._model.getAnnealMethod(self.getSnapshot())
+
+    # Asks a running confirmation loop to give up at its next attempt
+    # Called by the command scheduler when Stop or an emergency command arrives
+    def preempt(self):
+        self._preemptEvent.set()
+
+    # Clears a previous preempt() request before a new command starts
+    def clearPreempt(self):
+        self._preemptEvent.clear()
+
+    # Returns True if preempt() was called since the last clearPreempt()
+    def _isPreempted(self):
+        if self._preemptEvent.is_set():
+            print("Command preempted by a higher priority command.")
+            return True
+        return False
+
     # Checks if Device is in "Ready" or "Running" State
     def _isReadyOrRunning(self):
 
@@ -635,6 +945,120 @@ class Cryostream800:
         else:
             return False
 
+    # Waits for the confirmation of a command that was just sent
+    # The status is updated at every broadcast until isConfirmed() returns True or the resend interval expires
+    # The resend interval comes from the retry policy, and grows with the attempt number
+    # The latency recorded ends when the confirming packet arrived, not when it was processed
+    # Returns True if the command was confirmed
+    def _awaitConfirmation(self, commandType, isConfirmed, attempt):
+
+        sentAt   = time.time()
+        interval = self._retryPolicy.getResendInterval(commandType, attempt)
+
+        while True:
+
+            # Status read bounded by the resend interval, a silent device counts as not confirmed
+            try:
+                self._updateStatus(max(interval - (time.time() - sentAt), 1.5))
+            except StatusTimeout:
+                return False
+
+            if isConfirmed():
+                self._retryPolicy.recordConfirmation(commandType, max(self._lastStatusTime - sentAt, 0.0))
+                return True
+
+            if time.time() - sentAt >= interval:
+                return False
+
+    # Called when a command with confirmation gives up
+    # Raises ConfirmationTimeout if the object was created with raiseOnTimeout = True
+    def _confirmationFailed(self, commandType, attempts, startTime):
+        if self._raiseOnTimeout:
+            raise ConfirmationTimeout(commandType, attempts, time.time() - startTime)
+
+    # Returns True once a status packet was received from the network
+    # False after a warm start from the status cache, until the first live status arrives
+    def isLiveStatus(self):
+        return self._liveStatus.is_set()
+
+    # Waits for the first live status after a warm start
+    # Returns True if the status is live, False if timeout (s) expired first
+    def waitForLiveStatus(self, timeout = None):
+        return self._liveStatus.wait(timeout)
+
+    # Returns a property that rarely changes ("Max temp", "Control firmware", "CD Serial", ...) with its age
+    # Returns (value in output units, age in seconds), from the last status if it has the property,
+    # otherwise from the status cache, (None, None) if it was never seen
+    def getStaticProperty(self, prop):
+
+        value = self.getSnapshot().get(prop)
+        if value is not None:
+            return value, self.getStatusAge()
+
+        if self._cachedStatus is not None:
+            return self._cachedStatus.getStatic(prop)
+
+        return None, None
+
+    # Returns the seconds since the last status packet was received (None if never)
+    # After a warm start, the age of the cached status until the first live status arrives
+    def getStatusAge(self):
+        if self._lastStatusTime is None:
+            return None
+        return time.time() - self._lastStatusTime
+
+    # Returns the last known status without touching the network, with its age in seconds
+    # Returns (status dictionary, age), the dictionary can be queried by name or by ID
+    def getLastStatus(self):
+        return dict(self._lastStatus), self.getStatusAge()
+
+    # Reads a new status only if the last one is older than maxAge seconds
+    # Lets callers trade freshness for latency: refreshStatus(maxAge = 5) returns at once with a recent status
+    # timeout: seconds to wait for a new packet, None uses the default given to the constructor
+    # Returns the age of the status in memory after the call
+    def refreshStatus(self, maxAge = 0.0, timeout = None):
+        age = self.getStatusAge()
+        if age is None or age > maxAge:
+            self._updateStatus(timeout)
+        return self.getStatusAge()
+
+    # Returns the last status as an immutable StatusSnapshot (cryostream_snapshot.py)
+    # Fields are decoded on access and converted to output units, e.g. snapshot.get("Sample temp") in K
+    # Does not touch the network, call refreshStatus() first for a newer status
+    def getSnapshot(self):
+
+        # Imported here, cryostream_snapshot.py (through cryostream_catalog.py) uses the property tables of this class
+        from cryostream_snapshot import PacketLayout, StatusSnapshot
+
+        if self._packetLayout is None:
+            self._packetLayout = PacketLayout()
+
+        # Packet and time of the same status, another thread may be replacing it
+        with self._statusLock:
+            packet, statusTime = self._lastBinaryStatusPacket, self._lastStatusTime
+
+        return StatusSnapshot(packet, statusTime, self._packetLayout, self.getIP())
+
+    # Returns the DeviceClock (cryostream_clock.py): offset and drift of the device clock relative to this host
+    # Converts the device times (log files, "Last run date", ...) to the time.time() scale, and back
+    def getDeviceClock(self):
+        return self._deviceClock
+
+    # Returns the number of status packets skipped since the object was created
+    # {"foreign": packets from other devices, "malformed": packets that could not be decoded, "late": packets older than the last status}
+    def getPacketErrorCounts(self):
+        return dict(self._packetErrors)
+
+    # Returns the integrity counters of the status packets: rejected, lost, duplicated, late, and the loss rate
+    # {"packets": 3600, "checksum": 0, "truncated": 1, "lost": 4, "lossRate": 0.0011, ...}
+    def getPacketIntegrityStats(self):
+        return self._packetValidator.getStats()
+
+    # Returns the send -> confirmation latency statistics of this device per command type
+    # {"Cool": {"count": 12, "p50": 1.1, "p95": 2.3}, ...}
+    def getConfirmationStats(self):
+        return self._retryPolicy.getStats()
+
     #=========================================
     #=== Kernel - Set Commands - Low Level ===
     #=========================================
@@ -659,7 +1083,8 @@ class Cryostream800:
     def cool(self, targetTemp):
         code = self._commandBook["Cool"]
         # In order to send to the functions we must multiply the temperature by 100.
-        targetTemp = targetTemp * 100
+        # Rounded, 100.1 * 100 is 10009.999... and would be truncated to 10009 cK
+        targetTemp = int(round(targetTemp * 100))
         self._launchCommand(code,targetTemp,targetTemp)
 
     # Ramp to 300 K at a specified rate and then shut down
@@ -669,6 +1094,23 @@ class Cryostream800:
         code = self._commandBook["End"]
         self._launchCommand(code,rate,rate)
 
+    # Change to new temperature at a controlled rate
+    # Command ID: 11 (two parameters, rate and temperature)
+    # Ramp rate between 0 to 360 K/hour.
+    def ramp(self, rate, targetTemp):
+        code = self._commandBook["Ramp"]
+        # In order to send to the functions we must multiply the temperature by 100.
+        # Rounded, 100.1 * 100 is 10009.999... and would be truncated to 10009 cK
+        targetTemp = int(round(targetTemp * 100))
+        self._launchCommand(code,rate,targetTemp)
+
+    # Hold current temperature for a specified period
+    # Command ID: 12 (one parameter, duration)
+    # Duration between 1 to 1440 minutes.
+    def plat(self, duration):
+        code = self._commandBook["Plat"]
+        self._launchCommand(code,duration,duration)
+
     # Stop cooler immediately
     # Command ID: 19 (No parameters)
     def stop(self):
@@ -687,6 +1129,22 @@ class Cryostream800:
         code = self._commandBook["Set Autofill mode"]
         self._launchCommand(code,afmode,afmode)
 
+    # Set the time for which the flow will be interrupted by interruptFlow()
+    # Command ID: 120 (one parameter, duration in ds)
+    # Duration between 0.1 to 60 seconds.
+    def setFlowInterruptTime(self, duration):
+        code = self._commandBook["Set flow interrupt time"]
+        # Sent in tenths of a second, rounded
+        duration = int(round(duration * 10))
+        self._launchCommand(code,duration,duration)
+
+    # Interrupt the flow for the time set by setFlowInterruptTime()
+    # Cryostream 1000, and Cryostream 800 whose flow controller reports "FC Interrupt count"
+    # Command ID: 121 (No parameters)
+    def interruptFlow(self):
+        code = self._commandBook["Interrupt flow now"]
+        self._launchCommand(code,0,0)
+
 
     #==========================================
     #=== Kernel - Set Commands - High Level ===
@@ -707,8 +1165,16 @@ class Cryostream800:
         # Initialize Retry Count
         retries = 0
 
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Restart", maxRetries)
+
         #Loop until the desired mode is set or max retries reached
-        while (retries < maxRetries):
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
 
             print("Restart: Attempt " + str(retries+1) + " out of " + str(maxRetries) + ".")
 
@@ -716,10 +1182,8 @@ class Cryostream800:
             self._launchCommand(code,0,0)
 
             # Waits for device to initialize and go to ready state
-            time.sleep(4)
-
-            # We update the status to check if the restart command was effective
-            self._updateStatus()
+            # Status is checked at every broadcast until the resend interval expires
+            self._awaitConfirmation("Restart", lambda: self.getRunMode() == "Ready", retries)
 
             # Getting run mode information
             runMode = self.getRunMode()
@@ -732,6 +1196,9 @@ class Cryostream800:
                 # New Attempt
                 retries +=1
 
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Restart", retries, startTime)
+
         print("It was not possible to restart device (Get back to Ready).")
         print("Something odd happened. Not your lucky day!")
         print("Please, try again!")        
@@ -746,8 +1213,8 @@ class Cryostream800:
         code = self._commandBook["Cool"]
 
         # Gets Temperature lower and higher device limits
-        minTemp = self.getMinTemperature()/100
-        maxTemp = self.getMaxTemperature()/100
+        minTemp = self.getMinTemperature()/100.0
+        maxTemp = self.getMaxTemperature()/100.0
 
         # Check if the setTemp is within the allowed interval
         if not (minTemp <= targetTemp <= maxTemp):
@@ -755,22 +1222,29 @@ class Cryostream800:
             return False
 
         # In order to send to the functions we must multiply the temperature by 100.
-        targetTemp = targetTemp * 100
+        # Rounded, 100.1 * 100 is 10009.999... and would be truncated to 10009 cK
+        targetTemp = int(round(targetTemp * 100))
 
         # Initialize Retry Count
         retries = 0
 
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Cool", maxRetries)
+
         #Loop until the desired mode is set or max retries reached
-        while (retries < maxRetries):
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
 
             # Sends command to set target temperature
             self._launchCommand(code,targetTemp,targetTemp)
 
             # Waits a bit, so device status will be updated, usually every 1 second
-            time.sleep(1)
-
-            # We update the status to check if the restart command was effective
-            self._updateStatus()
+            # Status is checked at every broadcast until the resend interval expires
+            self._awaitConfirmation("Cool", lambda: self.getTargetTemperature() == targetTemp and self._isRunning(), retries)
 
             # Getting run mode information
             targetTempFromDevice = self.getTargetTemperature()
@@ -785,15 +1259,235 @@ class Cryostream800:
             else:
                 retries+=1
 
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Cool", retries, startTime)
+
         print("It was not possible to put device on cooling mode.")
         print("Running Mode: " + self.getRunMode())
-        print("Target Temperature: " + targetTemp + " K.")
-        print("Device Temperature: " + targetTempFromDevice + " K.")
+        print("Target Temperature: " + str(targetTemp/100.0) + " K.")
+        print("Device Target Temperature: " + str(self.getTargetTemperature()/100.0) + " K.")
         print("Something odd happened. Not your lucky day!")
         print("Please, try again!")
         return False
 
 
+    # Change to new temperature at a controlled rate
+    # With network confirmation that the rate and temperature were set
+    # Command ID: 11 (two parameters, rate and temperature)
+    # Ramp rate between 1 to 360 K/hour.
+    def rampWithConfirmation(self, rate, targetTemp, maxRetries = 10):
+
+        # Gets Code that represents "Ramp" Mode
+        code = self._commandBook["Ramp"]
+
+        # Gets Temperature lower and higher device limits
+        minTemp = self.getMinTemperature()/100.0
+        maxTemp = self.getMaxTemperature()/100.0
+
+        # Check if the setTemp is within the allowed interval
+        if not (minTemp <= targetTemp <= maxTemp):
+            print("Error: Temperature should be between [" + str(minTemp) + "," + str(maxTemp) + "]. You provided " + str(targetTemp) + ".")
+            return False
+
+        # Check if the rate is within the allowed interval
+        if not (1 <= rate <= 360):
+            print("Error: Ramp rate should be between [1,360] K/hour. You provided " + str(rate) + ".")
+            return False
+
+        rate = int(rate)
+
+        # In order to send to the functions we must multiply the temperature by 100.
+        targetTemp = int(round(targetTemp * 100))
+
+        # Initialize Retry Count
+        retries = 0
+
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Ramp", maxRetries)
+
+        #Loop until the desired rate and temperature are set or max retries reached
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
+
+            # Sends command to ramp to the target temperature
+            self._launchCommand(code,rate,targetTemp)
+
+            # Status is checked at every broadcast until the resend interval expires
+            self._awaitConfirmation("Ramp", lambda: self.getTargetTemperature() == targetTemp and self._lastStatus.get("Ramp rate") == rate and self._isRunning(), retries)
+
+            # Command was effective
+            if(self.getTargetTemperature() == targetTemp and self._lastStatus.get("Ramp rate") == rate and self._isRunning()):
+                return True
+            # Command was not effective
+            else:
+                retries+=1
+
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Ramp", retries, startTime)
+
+        print("It was not possible to ramp to " + str(targetTemp/100.0) + " K at " + str(rate) + " K/hour.")
+        print("Running Mode: " + self.getRunMode())
+        print("Please, try again!")
+        return False
+
+    # Hold current temperature for a specified period
+    # With network confirmation that the device is in the Plat phase
+    # Command ID: 12 (one parameter, duration)
+    # Duration between 1 to 1440 minutes.
+    def platWithConfirmation(self, duration, maxRetries = 10):
+
+        # Gets Code that represents "Plat" Mode
+        code = self._commandBook["Plat"]
+
+        # Check if the duration is within the allowed interval
+        if not (1 <= duration <= 1440):
+            print("Error: Plat duration should be between [1,1440] minutes. You provided " + str(duration) + ".")
+            return False
+
+        duration = int(duration)
+
+        # Initialize Retry Count
+        retries = 0
+
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Plat", maxRetries)
+
+        # "Phase id" 2 is Plat (see _buildOxCryoEnumsInline())
+        isPlat = lambda: self._lastStatus.get("Phase id") == 2 and self._isRunning()
+
+        #Loop until the device is in the Plat phase or max retries reached
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
+
+            # Sends command to hold the current temperature
+            self._launchCommand(code,duration,duration)
+
+            # Status is checked at every broadcast until the resend interval expires
+            self._awaitConfirmation("Plat", isPlat, retries)
+
+            # Command was effective
+            if isPlat():
+                return True
+            # Command was not effective
+            else:
+                retries+=1
+
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Plat", retries, startTime)
+
+        print("It was not possible to hold the temperature for " + str(duration) + " minutes.")
+        print("Running Mode: " + self.getRunMode())
+        print("Please, try again!")
+        return False
+
+    # Hold current temperature indefinitely
+    # With network confirmation that the device is in the Hold phase
+    # Command ID: 13 (No parameters)
+    def holdWithConfirmation(self, maxRetries = 10):
+
+        # Gets Code that represents "Hold" Mode
+        code = self._commandBook["Hold"]
+
+        # Initialize Retry Count
+        retries = 0
+
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Hold", maxRetries)
+
+        # "Phase id" 3 is Hold (see _buildOxCryoEnumsInline())
+        isHold = lambda: self._lastStatus.get("Phase id") == 3 and self._isRunning()
+
+        #Loop until the device is in the Hold phase or max retries reached
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
+
+            # Sends command to hold the current temperature
+            self._launchCommand(code,0,0)
+
+            # Status is checked at every broadcast until the resend interval expires
+            self._awaitConfirmation("Hold", isHold, retries)
+
+            # Command was effective
+            if isHold():
+                return True
+            # Command was not effective
+            else:
+                retries+=1
+
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Hold", retries, startTime)
+
+        print("It was not possible to hold the temperature.")
+        print("Running Mode: " + self.getRunMode())
+        print("Please, try again!")
+        return False
+
+    # Ramp to 300 K at a specified rate and then shut down
+    # With network confirmation that the device is in the End phase at that rate
+    # Command ID: 15 (one parameter, rate)
+    # Ramp rate between 1 to 360 K/hour.
+    def endWithConfirmation(self, rate, maxRetries = 10):
+
+        # Gets Code that represents "End" Mode
+        code = self._commandBook["End"]
+
+        # Check if the rate is within the allowed interval
+        if not (1 <= rate <= 360):
+            print("Error: Ramp rate should be between [1,360] K/hour. You provided " + str(rate) + ".")
+            return False
+
+        rate = int(rate)
+
+        # Initialize Retry Count
+        retries = 0
+
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("End", maxRetries)
+
+        # "Phase id" 4 is End (see _buildOxCryoEnumsInline())
+        isEnd = lambda: self._lastStatus.get("Phase id") == 4 and self._lastStatus.get("Ramp rate") == rate and self._isRunning()
+
+        #Loop until the device is in the End phase or max retries reached
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
+
+            # Sends command to ramp to 300 K and shut down
+            self._launchCommand(code,rate,rate)
+
+            # Status is checked at every broadcast until the resend interval expires
+            self._awaitConfirmation("End", isEnd, retries)
+
+            # Command was effective
+            if isEnd():
+                return True
+            # Command was not effective
+            else:
+                retries+=1
+
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("End", retries, startTime)
+
+        print("It was not possible to end the run at " + str(rate) + " K/hour.")
+        print("Running Mode: " + self.getRunMode())
+        print("Please, try again!")
+        return False
+
     # Stop cooler immediately with confirmation
     # Command ID: 19 (No parameters)
     def stopWithConfirmation(self, maxRetries = 10):
@@ -805,17 +1499,23 @@ class Cryostream800:
         # Initialize Retry Count
         retries = 0
 
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Stop", maxRetries)
+
         #Loop until the desired mode is set or max retries reached
-        while (retries < maxRetries):
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
 
             print("Stop: Attempt " + str(retries+1) + " out of " + str(maxRetries) + ".")
 
             self._launchCommand(code,0,0)
 
-            time.sleep(1)
-
-            # We update the status to check if the stop command was effective
-            self._updateStatus()
+            # Status is checked at every broadcast until the resend interval expires
+            self._awaitConfirmation("Stop", lambda: self.getRunMode() == "Shut down without error", retries)
 
             # Getting run mode information
             runMode = self.getRunMode()
@@ -828,6 +1528,9 @@ class Cryostream800:
                 #Go to next attempt
                 retries +=1
 
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Stop", retries, startTime)
+
         print("It was not possible to stop (Shutdown) device.")
         print("Something odd happened. Not your lucky day!")
         print("Please, try again!")
@@ -844,9 +1547,17 @@ class Cryostream800:
         # Initialize Retry Count
         retries = 0
 
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Turbo", maxRetries)
+
         #Loop until the desired mode is set or max retries reached
-        while (retries < maxRetries):
+        while (retries < maxRetries and time.time() < deadline):
         
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
+
             print("Turbo Mode: Attempt " + str(retries+1) + " out of " + str(maxRetries) + ".")
 
             # Saves Turbo Mode state before command is sent
@@ -856,10 +1567,9 @@ class Cryostream800:
             self._launchCommand(code,desiredMode,desiredMode)
 
             # Waits a bit, so device status will be updated.
-            time.sleep(3)
-
-            # We update the status to check if the turbo mode was set
-            self._updateStatus()
+            # Status is checked at every broadcast until the resend interval expires
+            # Turbo mode 2 or 3 (device in control) also ends the wait, it is handled below
+            self._awaitConfirmation("Turbo", lambda: self.getTurboMode() in (desiredMode, 2, 3), retries)
 
             # Getting run mode information
             after = self.getTurboMode()
@@ -898,6 +1608,9 @@ class Cryostream800:
             # Increment Retry Count
             retries +=1
 
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Turbo", retries, startTime)
+
         print("It was not possible to set Turbo Mode.")
         print("Something odd happened. Not your lucky day!")
         print("Please, try again!")
@@ -914,9 +1627,17 @@ class Cryostream800:
         # Initialize Retry Count
         retries = 0
 
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Autofill", maxRetries)
+
         #Loop until the desired mode is set or max retries reached
-        while (retries < maxRetries):
+        while (retries < maxRetries and time.time() < deadline):
         
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
+
             print("Auto Fill Mode: Attempt " + str(retries+1) + " out of " + str(maxRetries) + ".")
 
             # Saves Turbo Mode state before command is sent
@@ -926,10 +1647,9 @@ class Cryostream800:
             self._launchCommand(code,desiredAutofillMode,desiredAutofillMode)
 
             # Waits a bit, so device status will be updated.
-            time.sleep(4)
-
-            # We update the status to check if the turbo mode was set
-            self._updateStatus()
+            # Status is checked at every broadcast until the resend interval expires
+            expectedMode = {0: "Manual", 1: "Auto", 2: "Scheduled"}.get(desiredAutofillMode)
+            self._awaitConfirmation("Autofill", lambda: self.getAutofillMode() == expectedMode, retries)
 
             # Getting run mode information
             after = self.getAutofillMode()
@@ -956,18 +1676,99 @@ class Cryostream800:
             # Increment Retry Count
             retries +=1
 
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Autofill", retries, startTime)
+
         print("It was not possible to set Auto Fill Mode.")
         print("Something odd happened. Not your lucky day!")
         print("Please, try again!")
         
         return False
 
+    # Interrupt Flow With Confirmation
+    # Sets the interrupt time, then interrupts the gas flow (anneals the sample)
+    # The time is confirmed by "FC Interrupt time", the interrupt by "FC Interrupt count" going up
+    # The interrupt is not sent again before the interrupt time is over, so the sample is never annealed twice
+    # A device that does not report "FC Interrupt count" gets both commands once, without confirmation
+    # Command IDs: 120, 121
+    def interruptFlowWithConfirmation(self, duration, maxRetries = 10):
+
+        # Duration Check, sent in tenths of a second (1 to 600 ds)
+        if(self._isFloat(duration) == False or self._isFloatInRange(0.1, float(duration), 60.0) == False):
+            print("Flow interrupt time should be between 0.1 and 60 s.")
+            return False
+
+        duration      = float(duration)
+        interruptTime = int(round(duration * 10))
+
+        # Number of interrupts before the command, the confirmation is a different count
+        countBefore = self._lastStatus.get("FC Interrupt count")
+
+        if countBefore is None:
+            print("Device does not report flow interrupts, sent without confirmation.")
+            self.setFlowInterruptTime(duration)
+            self.interruptFlow()
+            return True
+
+        # A device that does not report the interrupt time has it confirmed by the first status after the command
+        timeSet     = lambda: self._lastStatus.get("FC Interrupt time", interruptTime) == interruptTime
+        interrupted = lambda: self._lastStatus.get("FC Interrupt count", countBefore) != countBefore
+
+        # Initialize Retry Count
+        retries = 0
+
+        # Gives up after the deadline learned from previous confirmations, even before maxRetries
+        startTime = time.time()
+        deadline  = startTime + self._retryPolicy.getDeadline("Interrupt", maxRetries) + duration
+
+        # The interrupt time is confirmed before the flow is interrupted
+        timeConfirmed = False
+
+        while (retries < maxRetries and time.time() < deadline):
+
+            # Gives up if a higher priority command (e.g. Stop) was requested
+            if self._isPreempted():
+                return False
+
+            print("Flow Interrupt: Attempt " + str(retries+1) + " out of " + str(maxRetries) + ".")
+
+            if not timeConfirmed:
+                self.setFlowInterruptTime(duration)
+                timeConfirmed = self._awaitConfirmation("Interrupt time", timeSet, retries)
+
+            if timeConfirmed:
+
+                self.interruptFlow()
+                sentAt = time.time()
+
+                # The count may only change when the flow comes back, status is read until then
+                while True:
+                    if self._awaitConfirmation("Interrupt", interrupted, retries):
+                        print("Flow interrupted for " + str(duration) + " s.")
+                        return True
+                    if time.time() - sentAt >= duration or self._isPreempted():
+                        break
+
+            # Increment Retry Count
+            retries +=1
+
+        # Raises ConfirmationTimeout if the caller asked for exceptions
+        self._confirmationFailed("Interrupt", retries, startTime)
+
+        print("It was not possible to interrupt the flow.")
+        print("Please, try again!")
+
+        return False
+
     #======================================================
     #=== My Implementations - Set Commands - High Level ===
     #======================================================
 
     # Shutdown and Get Ready
     def shutdownAndGetReady(self):
+        return self._runSequence("shutdownAndGetReady", [], self._shutdownAndGetReady)
+
+    def _shutdownAndGetReady(self):
 
         ready = False
 
@@ -1013,6 +1814,9 @@ class Cryostream800:
     # Puts the Cryostream 800 in Ready State
     # Sets the Temperature and Cool (Go, Running)
     def getReadySetTargetTemperatureAndGo(self, temperature):
+        return self._runSequence("getReadySetTargetTemperatureAndGo", [temperature], self._getReadySetTargetTemperatureAndGo)
+
+    def _getReadySetTargetTemperatureAndGo(self, temperature):
 
         # === Temperature Check - Float ===
 
@@ -1034,14 +1838,12 @@ class Cryostream800:
         # === Temperature Check - Range ===
         
         # Checks if temperature is in range
-        # Finds the Min and Max that device supports.
-        minTemperature = self.getMinTemperature()
-        maxTemperature = self.getMaxTemperature()
-        
-        # We need to multiply by 100, because the device uses dK
-        # (8000, 100.1, 40000), otherwise this test would fail
-        # Since 80K the device returns 8000, 400K, returns 40000
-        isTemperatureInRange = self._isFloatInRange(minTemperature, temperature * 100, maxTemperature)
+        # Finds the Min and Max that device supports, in K (the snapshot converts from cK)
+        snapshot = self.getSnapshot()
+        minTemperature = snapshot.get("Min temp")
+        maxTemperature = snapshot.get("Max temp")
+
+        isTemperatureInRange = self._isFloatInRange(minTemperature, temperature, maxTemperature)
 
         # Temperature not in range
         if(isTemperatureInRange == False):
@@ -1086,6 +1888,9 @@ class Cryostream800:
     # Tentative of Emulation of Annealing Function
     # Stop, Restart (Get Ready) and Cool
     def softwareAnnealing(self, temperature = 100.0):
+        return self._runSequence("softwareAnnealing", [temperature], self._softwareAnnealing)
+
+    def _softwareAnnealing(self, temperature):
 
         # Shutdown
         stop = self.stopWithConfirmation()
@@ -1106,6 +1911,115 @@ class Cryostream800:
 
         return cool
 
+    # Anneals the sample: the gas flow stops for a moment and the sample warms up
+    # The method depends on the model of the device and on its last status (cryostream_models.py):
+    # - native (Cryostream 1000) and flowInterrupt (800 reporting "FC Interrupt count"): interruptFlowWithConfirmation(duration),
+    #   the device cools back to its target temperature by itself, temperature is not used
+    # - software (other 800s): softwareAnnealing(temperature), Stop, Restart and Cool, duration is not used
+    def anneal(self, temperature = 100.0, duration = 2.0):
+
+        method = self.getAnnealMethod()
+        print("Annealing (" + method + ")...")
+
+        if method == "software":
+            return self.softwareAnnealing(temperature)
+
+        return self.interruptFlowWithConfirmation(duration)
+
+    # Runs a temperature profile, one phase after the other
+    # Each step is a list with the command name and its parameters, for instance:
+    # [["ramp", 360, 150], ["plat", 10], ["cool", 100]]
+    # Accepted steps: ramp (rate, temp), plat (duration), cool (temp), and as last step hold or end (rate)
+    # A phase command replaces the phase running on the device, so each step is sent with confirmation and
+    # the next one waits until the device leaves its phase ("Phase id"): ramp and cool at the temperature, plat after its duration
+    # Returns False without sending anything if a step is invalid, and as soon as a step fails
+    def runProfile(self, steps):
+
+        minTemp = self.getMinTemperature()/100.0
+        maxTemp = self.getMaxTemperature()/100.0
+
+        # Command with confirmation, "Phase id" (see _buildOxCryoEnumsInline()) and (min, max) of each parameter
+        profileCommands = {
+            "ramp": (self.rampWithConfirmation, 0, [(1, 360), (minTemp, maxTemp)]),
+            "cool": (self.coolWithConfirmation, 1, [(minTemp, maxTemp)]),
+            "plat": (self.platWithConfirmation, 2, [(1, 1440)]),
+            "hold": (self.holdWithConfirmation, 3, []),
+            "end":  (self.endWithConfirmation,  4, [(1, 360)]),
+        }
+
+        # Validates every step before sending anything
+        for index, step in enumerate(steps):
+
+            if len(step) == 0 or step[0] not in profileCommands:
+                print("Invalid profile step: " + str(step) + ". Use one of " + ", ".join(sorted(profileCommands)) + ".")
+                return False
+
+            limits = profileCommands[step[0]][2]
+            params = list(step[1:])
+
+            if len(params) != len(limits):
+                print("Invalid profile step: " + str(step) + ". " + step[0] + " takes " + str(len(limits)) + " parameter(s).")
+                return False
+
+            for value, (low, high) in zip(params, limits):
+                if isinstance(value, bool) or not isinstance(value, numbers.Real) or not (low <= value <= high):
+                    print("Invalid profile step: " + str(step) + ". " + str(value) + " should be a number between [" + str(low) + "," + str(high) + "].")
+                    return False
+
+            # Hold and End do not finish by themselves, a step after them would never run
+            if step[0] in ("hold", "end") and index != len(steps) - 1:
+                print("Invalid profile step: " + str(step) + ". " + step[0] + " can only be the last step.")
+                return False
+
+        for index, step in enumerate(steps):
+
+            command, phaseId = profileCommands[step[0]][:2]
+
+            print("Profile: step " + str(index + 1) + " out of " + str(len(steps)) + ", " + str(list(step)) + ".")
+
+            if not command(*step[1:]):
+                return False
+
+            # The last step keeps running on the device
+            if index < len(steps) - 1 and not self._waitForPhaseEnd(phaseId):
+                return False
+
+        return True
+
+    # Waits until the device leaves a phase of a profile ("Phase id" changes), the phase may last hours
+    # Returns False if the device stops running, goes silent, or a higher priority command (e.g. Stop) preempts the profile
+    def _waitForPhaseEnd(self, phaseId):
+
+        # Every read is bounded, even if the object waits forever for status (statusTimeout = None)
+        readTimeout = self._statusTimeout or 5.0
+
+        # Status reads in a row that timed out
+        timeouts = 0
+
+        while True:
+
+            if self._isPreempted():
+                return False
+
+            # A missed broadcast does not end the profile, a device that stays silent does
+            # The profile holds the command scheduler, the commands queued behind it must not wait forever
+            try:
+                self.refreshStatus(timeout = readTimeout)
+            except StatusTimeout:
+                timeouts += 1
+                if timeouts >= self._maxPhaseTimeouts:
+                    print("No status from the device for " + str(timeouts * readTimeout) + " s, the profile is abandoned.")
+                    return False
+                continue
+
+            timeouts = 0
+
+            if not self._isRunning():
+                print("The device stopped running during the profile. Running Mode: " + self.getRunMode() + ".")
+                return False
+
+            if self._lastStatus.get("Phase id") != phaseId:
+                return True
 
     # Turbo Mode General Function
     # It has a different name, so does not get confused with setTurboMode
@@ -1178,6 +2092,133 @@ class Cryostream800:
             print("Invalid Auto Fill Mode. Please, enter [0] Set to Off, [1] Set to On.")
             return False
 
+    #=======================
+    #=== Command Journal ===
+    #=======================
+
+    # Runs a multi-step sequence, recorded in the journal if there is one (cryostream_journal.py)
+    def _runSequence(self, name, args, function):
+
+        # Without journal, or inside another sequence, the steps run as they are
+        if self._journal is None or self._activeSequence is not None:
+            return function(*args)
+
+        # State before the sequence, to roll it back after a crash
+        before = {"runMode": self.getRunMode(), "targetTemp": self._lastStatus.get("Target temp")}
+
+        self._activeSequence = self._journal.begin(self._ip, name, args, before)
+
+        # An exception (Ctrl+C, ConfirmationTimeout) reaches the caller, the sequence is not resumed later
+        result = "aborted"
+
+        try:
+            succeeded = function(*args)
+            result = "done" if succeeded else "failed"
+            return succeeded
+        finally:
+            self._journal.end(self._activeSequence, result)
+            self._activeSequence = None
+
+    # Reconciles the sequences of this device interrupted by a crash with the last status
+    # Called by the constructor when a journal is given, right after the first status
+    # mode: "resume" finishes the sequence from where the device is, "rollback" restores the state recorded
+    #       before the sequence, "ignore" only closes it in the journal
+    # Sequences older than the maxAge of the journal are only closed, the device may have been handled by hand
+    # Returns a list of (sequence name, result)
+    def recoverJournal(self, mode = "resume"):
+
+        results = []
+
+        for entry in self._journal.getInterrupted(self._ip):
+
+            # Steps sent during the recovery belong to the interrupted sequence, a crash now is recovered again
+            self._activeSequence = entry["id"]
+
+            try:
+                result = self._recoverSequence(entry, mode)
+            finally:
+                self._activeSequence = None
+
+            self._journal.end(entry["id"], result)
+            self._journal.sync()
+
+            print("Journal: " + entry["sequence"] + str(tuple(entry["args"])) + " was interrupted, " + result + ".")
+            results.append((entry["sequence"], result))
+
+        return results
+
+    # Brings the device to the end (or start) of an interrupted sequence, returns the result for the journal
+    def _recoverSequence(self, entry, mode):
+
+        if mode == "ignore" or time.time() - entry["time"] > self._journal.getMaxAge():
+            return "abandoned"
+
+        if mode == "rollback":
+            return "rolledBack" if self._restoreState(entry["before"]) else "failed"
+
+        sequence = entry["sequence"]
+        args     = entry["args"]
+        runMode  = self.getRunMode()
+
+        stopSent    = int(self._commandBook["Stop"]) in entry["commands"]
+        restartSent = int(self._commandBook["Restart"]) in entry["commands"]
+        shutDown    = runMode.startswith("Shut down")
+
+        if sequence == "shutdownAndGetReady":
+
+            # Stop never left: the whole sequence again
+            if not stopSent:
+                succeeded = self._shutdownAndGetReady()
+            elif runMode in ("Ready", "Running"):
+                return "done"
+            else:
+                succeeded = self.restartWithConfirmation()
+
+        elif sequence == "softwareAnnealing":
+
+            temperature = float(args[0])
+
+            if not stopSent or (runMode == "Running" and not restartSent):
+                succeeded = self._softwareAnnealing(temperature)
+            elif runMode == "Running" and self.getTargetTemperature() == int(round(temperature * 100)):
+                return "done"
+            elif shutDown:
+                succeeded = self.restartWithConfirmation() and self.coolWithConfirmation(temperature)
+            else:
+                succeeded = self.coolWithConfirmation(temperature)
+
+        elif sequence == "getReadySetTargetTemperatureAndGo":
+
+            # Restart and Cool are safe to repeat
+            if runMode == "Running" and self.getTargetTemperature() == int(round(float(args[0]) * 100)):
+                return "done"
+            succeeded = self._getReadySetTargetTemperatureAndGo(args[0])
+
+        else:
+            return "abandoned"
+
+        return "recovered" if succeeded else "failed"
+
+    # Brings the device back to a state recorded by _runSequence(), returns True if it worked
+    def _restoreState(self, before):
+
+        runMode = self.getRunMode()
+
+        if before["runMode"] == "Running" and before["targetTemp"] is not None:
+            if runMode not in ("Ready", "Running") and not self.restartWithConfirmation():
+                return False
+            return self.coolWithConfirmation(before["targetTemp"] / 100.0)
+
+        if before["runMode"] == "Ready":
+            if runMode == "Running" and not self.stopWithConfirmation():
+                return False
+            return self.getRunMode() == "Ready" or self.restartWithConfirmation()
+
+        if before["runMode"].startswith("Shut down"):
+            return runMode.startswith("Shut down") or self.stopWithConfirmation()
+
+        return True
+
     #=============================
     #=== Accessories Functions ===
     #=============================
@@ -1212,7 +2253,7 @@ class Cryostream800:
     def _isFloatInRange(self, min, value, max):
         return min <= value <= max
 
-    # Returns true if a given ip is alive - Python2 version
+    # Returns true if a given ip is alive
     def pingIP(self, ip):
         try:
             # Use the 'ping' command to check if the device is online
@@ -1270,7 +2311,7 @@ class Cryostream800:
 
         # Menu Itself
         print("")
-        print("Cryostream 800 (IP " + self.getIP() + ":" + str(self.getStatusPort()) + ") [\033[1m" + onlineStatus + "\033[0m]:")
+        print(self._model.getName() + " (IP " + self.getIP() + ":" + str(self.getStatusPort()) + ") [\033[1m" + onlineStatus + "\033[0m]:")
         print("Run Mode (Status): [\033[1m" + runMode + "\033[0m]")
         print("\033[1m[0]\033[0m Info.")
         print("\033[1m[1]\033[0m Update Run Mode (Status).")            
@@ -1278,14 +2319,14 @@ class Cryostream800:
         print("\033[1m[3]\033[0m Restart (Get Ready).")
         print("\033[1m[4]\033[0m Set Temperature and Go.")
         print("\033[1m[5]\033[0m Set Autofill Mode.")
-        print("\033[1m[6]\033[0m Software Annealing.")
+        print("\033[1m[6]\033[0m Annealing (" + self.getAnnealMethod() + ").")
         print("\033[1m[7]\033[0m Set Turbo Mode [On, Off].")                                         
         print("\033[1m[8]\033[0m Exit.")
 
     # Gets User Input
     def terminal_getChoice(self):
 
-        choice = raw_input("Enter your choice: ")
+        choice = _input("Enter your choice: ")
 
         # Choice Validation
         # Needs to be an integer to be able to enter the menu
@@ -1307,73 +2348,80 @@ class Cryostream800:
         #Loop
         while True:
 
-            # Draws Menu
-            self.terminal_drawMenu()
+            # Errors from the device (e.g. packets from another IP) are shown and the menu keeps running
+            try:
 
-            # Get Users Input
-            choice = self.terminal_getChoice()
+                # Draws Menu
+                self.terminal_drawMenu()
 
-            # Case 00 - Display info related to the device
-            if choice == 0:
+                # Get Users Input
+                choice = self.terminal_getChoice()
 
-                self.terminal_displayInfo()
+                # Case 00 - Display info related to the device
+                if choice == 0:
 
+                    self.terminal_displayInfo()
 
-            # Case 01 - Updates Run Mode that appears on the opening screen
-            elif choice == 1:
 
-                # We just print a message on this choice, however since the dial menu is redraw
-                # It updates the run mode information on screen
-                print("Updating Run Mode")
+                # Case 01 - Updates Run Mode that appears on the opening screen
+                elif choice == 1:
 
+                    # We just print a message on this choice, however since the dial menu is redraw
+                    # It updates the run mode information on screen
+                    print("Updating Run Mode")
 
-            # Case 02 - Stop (Shutdown and Get Ready)
-            elif choice == 2:
 
-                self.terminal_shutdownAndGetReady()
+                # Case 02 - Stop (Shutdown and Get Ready)
+                elif choice == 2:
 
+                    self.terminal_shutdownAndGetReady()
 
-            # Case 03 - Restart (Get Ready)
-            elif choice == 3:
 
-                self.terminal_getReady()
+                # Case 03 - Restart (Get Ready)
+                elif choice == 3:
 
+                    self.terminal_getReady()
 
-            # Case 04 - Get Ready, Set Target Temperature and Go
-            elif choice == 4:
 
-                self.terminal_getReadySetTargetTemperatureAndGo()
+                # Case 04 - Get Ready, Set Target Temperature and Go
+                elif choice == 4:
 
+                    self.terminal_getReadySetTargetTemperatureAndGo()
 
-            # Case 05 - Set Auto Fill Mode
-            elif choice == 5:
 
-                self.terminal_setAutofillMode()
+                # Case 05 - Set Auto Fill Mode
+                elif choice == 5:
 
+                    self.terminal_setAutofillMode()
 
-            # Case 06 - Software Annealing
-            elif choice == 6:
 
-                self.terminal_softwareAnnealing()
+                # Case 06 - Software Annealing
+                elif choice == 6:
 
+                    self.terminal_softwareAnnealing()
 
-            # Case 07 - Set Turbo Mode [On, Off]
-            elif choice == 7:
 
-                self.terminal_setTurboModeGeneral()
+                # Case 07 - Set Turbo Mode [On, Off]
+                elif choice == 7:
 
+                    self.terminal_setTurboModeGeneral()
 
-            # Case 08 - Exit
-            elif choice == 8:
 
-                self.terminal_exit()
+                # Case 08 - Exit
+                elif choice == 8:
 
+                    self.terminal_exit()
 
-            # Case Others
-            else:
 
-                # User typed an invalid option
-                print("Invalid choice. Please select a valid option [0-8].")
+                # Case Others
+                else:
+
+                    # User typed an invalid option
+                    print("Invalid choice. Please select a valid option [0-8].")
+
+            except CryostreamError as e:
+
+                print("Error: " + str(e))
 
     #============================
     #=== Terminal - Functions ===
@@ -1406,12 +2454,15 @@ class Cryostream800:
 
         runMode = self.getRunMode()
 
+        # Values converted to K and % by the snapshot
+        snapshot = self.getSnapshot()
+
         # Prepare variables into string format
-        sampleTemperature = str(self.getSampleTemperature()/100.0)
-        targetTemperature = str(self.getTargetTemperature()/100.0)
-        minTemperature    = str(self.getMinTemperature()/100.0)
-        maxTemperature    = str(self.getMaxTemperature()/100.0)
-        autofillLNLevel   = str(float(self.getAutofillLNLevel()/100.0))
+        sampleTemperature = str(snapshot.get("Sample temp"))
+        targetTemperature = str(snapshot.get("Target temp"))
+        minTemperature    = str(snapshot.get("Min temp"))
+        maxTemperature    = str(snapshot.get("Max temp"))
+        autofillLNLevel   = str(snapshot.get("AF LN level"))
         autofillMode      = self.getAutofillMode()
         turboMode         = str(self.getTurboMode())
 
@@ -1463,13 +2514,14 @@ class Cryostream800:
     # Case 04 - Get Ready, Set Target Temperature and Go
     def terminal_getReadySetTargetTemperatureAndGo(self):
 
-        # Retrieving limits to assist the user with the range
+        # Retrieving limits to assist the user with the range, in K
         # Altough, we will also check inside the function
-        minTemperature = self.getMinTemperature()
-        maxTemperature = self.getMaxTemperature()
+        snapshot = self.getSnapshot()
+        minTemperature = snapshot.get("Min temp")
+        maxTemperature = snapshot.get("Max temp")
 
         # User types desired temperature
-        targetTemperature = raw_input("Enter a target temperature in K between ["+str(minTemperature/100.0) + "," + str(maxTemperature/100.0) + "]: ")
+        targetTemperature = _input("Enter a target temperature in K between ["+str(minTemperature) + "," + str(maxTemperature) + "]: ")
 
         self.getReadySetTargetTemperatureAndGo(targetTemperature)
 
@@ -1485,17 +2537,17 @@ class Cryostream800:
         print("[1] Set to Auto.")
 
         # Captures user's choice
-        afmode = raw_input("Enter your Auto Fill mode: ")
+        afmode = _input("Enter your Auto Fill mode: ")
 
         self.setAutofillModeGeneral(afmode)
 
 
-    # Functions that tries to emulate Annealing via Stop, Start and Cool.
-    # Case 06 - Software Annealing
+    # Annealing, flow interrupt when the device can, otherwise emulated via Stop, Start and Cool.
+    # Case 06 - Annealing
     def terminal_softwareAnnealing(self):
 
-        #Stop, Get Ready and Cool
-        self.softwareAnnealing()
+        #Interrupt flow, or Stop, Get Ready and Cool
+        self.anneal()
 
 
 
@@ -1509,7 +2561,7 @@ class Cryostream800:
         print("[1] Set to On.")
 
         # Captures user's choice
-        turboMode = raw_input("Enter your turbo mode choice: ")
+        turboMode = _input("Enter your turbo mode choice: ")
 
         self.setTurboModeGeneral(turboMode)
 
@@ -1521,6 +2573,17 @@ class Cryostream800:
         # Exits gracefully with zero code
         sys.exit(0)
 
+# Controls Cryostream 1000 (Oxford Cryosystems)
+# Same driver as the Cryostream 800 (transport, status cache, confirmation, journal), with the 1000 series model:
+# anneal() uses the flow interrupt of the device, see cryostream_models.py
+class Cryostream1000(Cryostream800):
+
+    # Constructor
+    # Same options as Cryostream800, the model is "1000"
+    def __init__(self, ip, **options):
+        options.setdefault("model", "1000")
+        Cryostream800.__init__(self, ip, **options)
+
 
 
   
\ No newline at end of file
@@ -0,0 +1,221 @@
+import collections
+import math
+
+from cryostream_snapshot import readStatusValue
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Temperature control performance analytics for the Cryostream 800
+# The status history is split in events, one per commanded target temperature ("Target temp", ID #1056).
+# For each event we compute:
+# - Overshoot: how far the sample temperature went past the target, in the direction of the change (K)
+# - Settling time: time until the sample temperature enters the band around the target and stays there (s)
+# - Steady-state error: mean of sample minus target over the last part of the event, once settled (K)
+# - Ramp tracking RMS: RMS of sample minus "Set temp" (ID #1050) while the setpoint is still moving (K)
+#
+# The history is processed in a single streaming pass, memory does not grow with the length of the history.
+#
+# Usage:
+# analyzer = SetpointAnalyzer()
+# for timestamp, status in history:          # status: StatusSnapshot, or dict or StatusPacketView with raw values
+#     event = analyzer.add(timestamp, status)
+#     if event is not None:
+#         print(event.toDict())
+# last = analyzer.finish()
+
+# Performance figures of one setpoint change
+class SetpointEvent:
+
+    # Constructor
+    def __init__(self, startTime, startTemp, targetTemp):
+
+        # Time (s) and sample temperature (K) when the new target was seen
+        self.startTime = startTime
+        self.startTemp = startTemp
+
+        # Commanded target temperature (K)
+        self.targetTemp = targetTemp
+
+        # Time of the last sample of the event
+        self.endTime = startTime
+
+        # Overshoot past the target (K), 0 if the sample never crossed the target
+        self.overshoot = 0.0
+
+        # Seconds from startTime until the sample stays within the band, None if never settled
+        self.settlingTime = None
+
+        # Mean of (sample - target) over the steady-state window (K), None if never settled
+        self.steadyStateError = None
+
+        # RMS of (sample - set temp) while ramping (K), None if the event had no ramp
+        self.rampTrackingRMS = None
+
+        # Number of status samples in the event
+        self.samples = 0
+
+    # Returns the event as a dictionary, useful to export or print
+    def toDict(self):
+        return {
+            "startTime":        self.startTime,
+            "endTime":          self.endTime,
+            "startTemp":        self.startTemp,
+            "targetTemp":       self.targetTemp,
+            "overshoot":        self.overshoot,
+            "settlingTime":     self.settlingTime,
+            "steadyStateError": self.steadyStateError,
+            "rampTrackingRMS":  self.rampTrackingRMS,
+            "samples":          self.samples,
+        }
+
+# Streaming analyzer: splits the status history by target temperature and measures each event
+class SetpointAnalyzer:
+
+    # Constructor
+    # settlingBand: the sample is settled while |sample - target| <= settlingBand (K)
+    # steadyStateWindow: seconds at the end of an event used for the steady-state error
+    def __init__(self, settlingBand = 0.5, steadyStateWindow = 60.0):
+
+        self._settlingBand      = settlingBand
+        self._steadyStateWindow = steadyStateWindow
+
+        self._event = None
+
+    # Adds one status sample
+    # timestamp: seconds
+    # status: StatusSnapshot, or dict or StatusPacketView with raw values, with "Sample temp", "Target temp" and "Set temp"
+    # Returns the SetpointEvent that just finished, if the target changed, otherwise None
+    def add(self, timestamp, status):
+
+        # In K, whatever the units of the status
+        sampleTemp = readStatusValue(status, "Sample temp")
+        targetTemp = readStatusValue(status, "Target temp")
+        setTemp    = readStatusValue(status, "Set temp")
+
+        # Incomplete status, ignored
+        if sampleTemp is None or targetTemp is None:
+            return None
+
+        finished = None
+
+        if self._event is None or targetTemp != self._event.targetTemp:
+            finished = self.finish()
+            self._startEvent(timestamp, sampleTemp, targetTemp)
+
+        self._update(timestamp, sampleTemp, setTemp)
+
+        return finished
+
+    # Closes the current event and returns it (None if there is no event)
+    def finish(self):
+
+        event = self._event
+
+        if event is None:
+            return None
+
+        # Settling time: the sample entered the band after its last excursion out of it
+        if self._lastOutOfBand is None:
+            event.settlingTime = 0.0
+        elif self._settledSince is not None:
+            event.settlingTime = self._settledSince - event.startTime
+
+        # Steady-state error: mean error over the last seconds of the settled part
+        if event.settlingTime is not None and len(self._window) > 0:
+            event.steadyStateError = self._windowSum / len(self._window)
+
+        if self._rampCount > 0:
+            event.rampTrackingRMS = math.sqrt(self._rampSquares / self._rampCount)
+
+        self._event = None
+
+        return event
+
+    def _startEvent(self, timestamp, sampleTemp, targetTemp):
+
+        self._event = SetpointEvent(timestamp, sampleTemp, targetTemp)
+
+        # Direction of the change: -1 cooling, +1 warming
+        self._direction = -1 if targetTemp < sampleTemp else 1
+
+        # Settling tracking
+        self._lastOutOfBand = None
+        self._settledSince  = timestamp
+
+        # Steady-state window: (timestamp, error) pairs of the last steadyStateWindow seconds
+        self._window    = collections.deque()
+        self._windowSum = 0.0
+
+        # Ramp tracking
+        self._rampSquares = 0.0
+        self._rampCount   = 0
+
+    def _update(self, timestamp, sampleTemp, setTemp):
+
+        event = self._event
+
+        event.endTime  = timestamp
+        event.samples += 1
+
+        error = sampleTemp - event.targetTemp
+
+        # Overshoot: distance past the target in the direction of the change
+        past = error * self._direction
+        if past > event.overshoot:
+            event.overshoot = past
+
+        # Settling
+        if abs(error) > self._settlingBand:
+            self._lastOutOfBand = timestamp
+            self._settledSince  = None
+            self._window.clear()
+            self._windowSum = 0.0
+        else:
+            if self._settledSince is None:
+                self._settledSince = timestamp
+            self._window.append((timestamp, error))
+            self._windowSum += error
+            while self._window and timestamp - self._window[0][0] > self._steadyStateWindow:
+                self._windowSum -= self._window.popleft()[1]
+
+        # Ramp tracking: the setpoint is still moving towards the target
+        if setTemp is not None and setTemp != event.targetTemp:
+            trackingError = sampleTemp - setTemp
+            self._rampSquares += trackingError * trackingError
+            self._rampCount   += 1
+
+# Analyzes a whole history in one pass
+# history: iterable of (timestamp, status)
+# Returns the list of SetpointEvent
+def analyzeHistory(history, settlingBand = 0.5, steadyStateWindow = 60.0):
+
+    analyzer = SetpointAnalyzer(settlingBand, steadyStateWindow)
+    events   = []
+
+    for timestamp, status in history:
+        event = analyzer.add(timestamp, status)
+        if event is not None:
+            events.append(event)
+
+    event = analyzer.finish()
+    if event is not None:
+        events.append(event)
+
+    return events
+
+# Summarizes a list of events, useful to compare devices or track one device over time
+# Returns a dictionary with the number of events and the mean of each figure
+def summarizeEvents(events):
+
+    summary = {"events": len(events)}
+
+    for figure in ("overshoot", "settlingTime", "steadyStateError", "rampTrackingRMS"):
+        values = [getattr(e, figure) for e in events if getattr(e, figure) is not None]
+        summary[figure] = sum(values) / len(values) if values else None
+
+    # Events that never settled are a sign of a degrading coldhead or nozzle
+    summary["unsettled"] = len([e for e in events if e.settlingTime is None])
+
+    return summary
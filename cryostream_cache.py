@@ -0,0 +1,216 @@
+from __future__ import print_function
+
+import binascii
+import json
+import os
+import threading
+import time
+
+from cryostream_catalog import getPropertyId, getPropertyName, scaleValue
+from cryostream_snapshot import PacketLayout
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Warm-start status cache of the Cryostream 800
+# A new Cryostream800 waits for a status broadcast before any getter works, and relearns the packet layout.
+# The cache keeps, per device, in a small JSON file:
+# - the last status packet and the time it was received
+# - the field offsets of the packets (PacketLayout)
+# - the static properties (limits, firmware versions, serial numbers), each with the time it was last seen
+# A restarted Cryostream800 starts from the cached packet, so static queries and command validation
+# (e.g. Min temp / Max temp) work at once, while the first live status is read in the background.
+# Values from the cache keep their real age: getStatusAge() and getStaticProperty() tell how old they are.
+#
+# The file is replaced in one step (same as DeviceRegistry.save()), a crash while saving leaves the previous one.
+# It is written when a static property changes, and otherwise at most every saveInterval seconds.
+#
+# Usage:
+# cache      = StatusCache()                                  # ~/.cryostream_cache/<ip>.json
+# cryostream = Cryostream800("10.0.0.5", statusCache = cache)  # Returns at once if the device is in the cache
+# cryostream.getStaticProperty("Max temp")                     # (400.0, 3600.2): value in K, age in seconds
+
+_defaultCacheDirectory = os.path.join(os.path.expanduser("~"), ".cryostream_cache")
+
+_cacheVersion = 1
+
+# Properties that only change with a firmware update, a new part or a new configuration
+_staticProperties = ("Device", "Hardware", "Min temp", "Max temp", "Control firmware", "Controller number",
+                     "Coldhead number", "Commissioning date", "Sensor 1 number", "Sensor 2 number", "Sensor 3 number",
+                     "FC Firmware", "FC Serial", "FC Device type", "AF Serial", "AF Firmware",
+                     "FP Ethernet Firmware", "CD Serial", "CD Firmware", "PU Serial", "PU Firmware",
+                     "FP Serial", "FP Firmware", "AP Firmware", "DAU Serial", "DAU Firmware",
+                     "SRB Serial number", "SRB Firmware")
+
+_staticIds = tuple(getPropertyId(name) for name in _staticProperties)
+
+# Status of a device read from the cache
+class CachedStatus:
+
+    # Constructor
+    # packet: last status packet (bytes), packetTime: time it was received
+    # layout: PacketLayout of the packets of the device
+    # static: property id -> (raw value, time it was last seen)
+    def __init__(self, ip, packet, packetTime, layout, static):
+        self._ip         = ip
+        self._packet     = packet
+        self._packetTime = packetTime
+        self._layout     = layout
+        self._static     = static
+
+    # Returns the IP of the device
+    def getIP(self):
+        return self._ip
+
+    # Returns the last status packet (bytes)
+    def getPacket(self):
+        return self._packet
+
+    # Returns the time the last status packet was received
+    def getTime(self):
+        return self._packetTime
+
+    # Returns the age (s) of the last status packet
+    def getAge(self):
+        return time.time() - self._packetTime
+
+    # Returns the PacketLayout learned from the packets of the device
+    def getLayout(self):
+        return self._layout
+
+    # Returns (value in output units, age in seconds) of a static property, (None, None) if it was never seen
+    def getStatic(self, prop):
+        propId = getPropertyId(prop)
+        if propId not in self._static:
+            return None, None
+        raw, seen = self._static[propId]
+        return scaleValue(propId, raw), time.time() - seen
+
+    # Returns every static property seen, name -> (value in output units, age in seconds)
+    def getStaticProperties(self):
+        return dict((getPropertyName(propId), self.getStatic(propId)) for propId in self._static)
+
+# Cache of the last status of every device, one file per device
+class StatusCache:
+
+    # Constructor
+    # directory: folder of the cache files, created on the first save
+    # saveInterval: longest time (s) between two saves of the last packet
+    def __init__(self, directory = None, saveInterval = 60.0):
+
+        self._directory    = directory or _defaultCacheDirectory
+        self._saveInterval = saveInterval
+        self._lock         = threading.Lock()
+
+        # ip -> {"packet", "time", "layout", "static", "saved"}, what the next save writes
+        self._entries = dict()
+
+    # Returns the cache file of a device
+    def getPath(self, ip):
+        return os.path.join(self._directory, ip + ".json")
+
+    # Reads the cache of a device
+    # Returns a CachedStatus, or None if the device is not in the cache or the file is damaged or from another version
+    def load(self, ip):
+
+        try:
+            with open(self.getPath(ip)) as cacheFile:
+                data = json.load(cacheFile)
+            if data.get("version") != _cacheVersion or data.get("ip") != ip:
+                return None
+            packet  = binascii.unhexlify(data["packet"].encode("ascii"))
+            offsets = dict((int(propId), offset) for propId, offset in data["layout"]["offsets"].items())
+            static  = dict((int(propId), (value[0], value[1])) for propId, value in data["static"].items())
+            layout  = PacketLayout()
+            layout.restore(data["layout"]["length"], offsets)
+        except (IOError, OSError, ValueError, KeyError, TypeError, IndexError, binascii.Error):
+            return None
+
+        with self._lock:
+            # Static properties stay known even if the next packets do not have them
+            # The entry has its own layout, the one returned belongs to the caller
+            if ip not in self._entries:
+                entryLayout = PacketLayout()
+                entryLayout.restore(layout.getLength(), offsets)
+                self._entries[ip] = {"packet": packet, "time": data["time"], "layout": entryLayout,
+                                     "static": dict(static), "saved": data["time"]}
+
+        return CachedStatus(ip, packet, data["time"], layout, static)
+
+    # Records a status packet received from a device
+    # Saves the cache if a static property changed or the last save is older than saveInterval
+    # A cache that cannot be written (disk full, read-only home) is reported, the status read goes on
+    def update(self, ip, packet, timestamp):
+
+        # memoryview.tobytes() works on Python 2.7 and 3, bytes(memoryview) does not on Python 2.7
+        if isinstance(packet, memoryview):
+            packet = packet.tobytes()
+        packet = bytes(packet)
+
+        with self._lock:
+
+            entry = self._entries.get(ip)
+            if entry is None:
+                entry = {"packet": None, "time": None, "layout": PacketLayout(), "static": dict(), "saved": 0.0}
+                self._entries[ip] = entry
+
+            entry["packet"] = packet
+            entry["time"]   = timestamp
+            entry["layout"].learn(packet)
+
+            changed = False
+            for propId in _staticIds:
+                raw = entry["layout"].readRaw(packet, propId)
+                if raw is None:
+                    continue
+                previous = entry["static"].get(propId)
+                if previous is None or previous[0] != raw:
+                    changed = True
+                entry["static"][propId] = (raw, timestamp)
+
+            if changed or timestamp - entry["saved"] >= self._saveInterval:
+                try:
+                    self._save(ip, entry)
+                except (IOError, OSError) as e:
+                    entry["saved"] = timestamp
+                    print("Status cache: cannot save " + self.getPath(ip) + " (" + str(e) + ").")
+
+    # Writes the cache of a device now
+    def save(self, ip):
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is not None and entry["packet"] is not None:
+                self._save(ip, entry)
+
+    # Writes the cache file of a device, replaced in one step
+    def _save(self, ip, entry):
+
+        layout = entry["layout"]
+        data   = {
+            "version": _cacheVersion,
+            "ip":      ip,
+            "time":    entry["time"],
+            "packet":  binascii.hexlify(entry["packet"]).decode("ascii"),
+            "layout":  {"length": layout.getLength(), "offsets": dict((str(propId), layout.getOffset(propId)) for propId in layout.getIds())},
+            "static":  dict((str(propId), list(value)) for propId, value in entry["static"].items()),
+        }
+
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        path          = self.getPath(ip)
+        temporaryPath = path + ".tmp"
+
+        with open(temporaryPath, "w") as cacheFile:
+            json.dump(data, cacheFile, sort_keys = True)
+            cacheFile.flush()
+            os.fsync(cacheFile.fileno())
+
+        # os.rename does not replace an existing file on Windows
+        if os.name == "nt" and os.path.exists(path):
+            os.remove(path)
+
+        os.rename(temporaryPath, path)
+
+        entry["saved"] = entry["time"]
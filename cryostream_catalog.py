@@ -0,0 +1,178 @@
+from cryostream800 import Cryostream800
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Catalog of every Cryostream 800 status property (~350, OxcryoProperties.xml and Cryostream.xml)
+# Names, units, unit conversions and enumeration labels are compiled once, at import, into lists indexed by
+# property ID, so decoding any field is an indexed lookup instead of branching code.
+#
+# Usage:
+# getPropertyId("CD Coldhead hours")          # 1434
+# scaleValue(1051, 10025)                     # 100.25 (K)
+# formatValue(1053, 3)                        # "Running"
+# getSubsystemIds("CD")                       # IDs of every Cryodrive property
+# isKnownProperty("Sampel temp")              # False
+
+# Property id -> name, name -> id, id -> (units, output units), id -> {value: label}
+_propertyNames = Cryostream800._buildOxCryoPropertiesInline()
+_propertyIds   = dict((name, propId) for propId, name in _propertyNames.items())
+_propertyUnits = Cryostream800._buildOxCryoUnitsInline()
+_propertyEnums = Cryostream800._buildOxCryoEnumsInline()
+
+# Divisor to convert from the units broadcast by the device to the output units
+# A division gives the nearest float (10025 / 100.0 is 100.25, 10025 * 0.01 is not)
+# Pairs not listed here (same units on both sides) are not converted
+_unitDivisors = {
+    ("cK", "K"):         100.0,
+    ("c%", "%"):         100.0,
+    ("cC", "C"):         100.0,
+    ("cV", "V"):         100.0,
+    ("cA", "A"):         100.0,
+    ("mA", "A"):         1000.0,
+    ("ds", "s"):         10.0,
+    ("dbar", "bar"):     10.0,
+    ("cbar", "mbar"):    0.1,
+    ("cl/min", "l/min"): 100.0,
+    ("dl/min", "l/min"): 10.0,
+}
+
+# Fields broadcast in two's complement (signed 16 bit)
+_signedProperties = frozenset([1052])
+
+# Subsystems, by property name prefix
+_subsystems = {
+    "FC":  "Flow controller",
+    "FP":  "Front panel",
+    "CD":  "Cryodrive",
+    "PU":  "Pump",
+    "AF":  "Autofill",
+    "DAU": "DAU",
+    "SRB": "SRB",
+}
+
+#===============================
+#=== Compiled Lookup Arrays ===
+#===============================
+
+# Lists indexed by property ID, IDs above the highest known ID are not in the catalog
+_arraySize = max(_propertyNames.keys()) + 1
+
+_nameArray    = [None] * _arraySize
+_unitsArray   = [""] * _arraySize
+_divisorArray = [None] * _arraySize
+_enumArray    = [None] * _arraySize
+_signedArray  = [False] * _arraySize
+
+for _propId, _name in _propertyNames.items():
+    _nameArray[_propId] = _name
+
+for _propId, _units in _propertyUnits.items():
+    _unitsArray[_propId]   = _units[1]
+    _divisorArray[_propId] = _unitDivisors.get(_units)
+
+for _propId, _labels in _propertyEnums.items():
+    # Enumeration as a list indexed by value, values are small integers
+    _enumArray[_propId] = [_labels.get(value) for value in range(max(_labels.keys()) + 1)]
+
+for _propId in _signedProperties:
+    _signedArray[_propId] = True
+
+# IDs of every subsystem, compiled once
+_subsystemIds = dict((prefix, sorted(propId for propId, name in _propertyNames.items() if name.startswith(prefix + " ")))
+                     for prefix in _subsystems)
+
+#=================
+#=== Functions ===
+#=================
+
+# Returns the id of a property given by name ("Sample temp") or id (1051)
+def getPropertyId(prop):
+    return _propertyIds.get(prop, prop)
+
+# True if propId is an id inside the lookup arrays (an unknown name is returned by getPropertyId as a str)
+def _isIndex(propId):
+    return isinstance(propId, int) and 0 <= propId < _arraySize
+
+# Returns True if a property given by name or id is in the catalog
+def isKnownProperty(prop):
+    propId = getPropertyId(prop)
+    return _isIndex(propId) and _nameArray[propId] is not None
+
+# Returns the name of a property given by id, None if unknown
+def getPropertyName(propId):
+    if _isIndex(propId):
+        return _nameArray[propId]
+    return None
+
+# Returns the IDs of every property in the catalog, sorted
+def getPropertyIds():
+    return sorted(_propertyNames.keys())
+
+# Returns the output units of a property ("" if it has none)
+def getPropertyUnits(prop):
+    propId = getPropertyId(prop)
+    if _isIndex(propId):
+        return _unitsArray[propId]
+    return ""
+
+# Converts a raw value broadcast by the device to the output units of the property
+def scaleValue(propId, raw):
+
+    if not _isIndex(propId):
+        return raw
+
+    if _signedArray[propId] and raw >= 0x8000:
+        raw = raw - 0x10000
+
+    divisor = _divisorArray[propId]
+    if divisor is None:
+        return raw
+
+    return raw / divisor
+
+# Returns the Python type of a property in output units: float if it is converted (cK -> K), int otherwise
+def getPropertyType(prop):
+    propId = getPropertyId(prop)
+    if _isIndex(propId) and _divisorArray[propId] is not None:
+        return float
+    return int
+
+# Returns the label of an enumeration value ("Running"), None if the property is not an enumeration
+# Values outside the table return "Unknown (<value>)"
+def decodeEnum(propId, raw):
+
+    if not _isIndex(propId) or _enumArray[propId] is None:
+        return None
+
+    labels = _enumArray[propId]
+    if raw < len(labels) and labels[raw] is not None:
+        return labels[raw]
+
+    return "Unknown (" + str(raw) + ")"
+
+# Returns a raw value as text: enumeration label, or value with its output units
+def formatValue(propId, raw):
+
+    label = decodeEnum(propId, raw)
+    if label is not None:
+        return label
+
+    value = scaleValue(propId, raw)
+    units = getPropertyUnits(propId)
+
+    if units:
+        return str(value) + " " + units
+
+    return str(value)
+
+# Returns the IDs of the properties of a subsystem ("FC", "CD", "PU", "AF", "DAU", ...)
+def getSubsystemIds(subsystem):
+    if subsystem not in _subsystemIds:
+        raise KeyError("Unknown subsystem: " + subsystem + ". Use one of " + ", ".join(sorted(_subsystems)) + ".")
+    return list(_subsystemIds[subsystem])
+
+# Returns a dictionary prefix -> description of the known subsystems
+def getSubsystems():
+    return dict(_subsystems)
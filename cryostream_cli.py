@@ -0,0 +1,365 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from cryostream800 import Cryostream800
+from cryostream_catalog import decodeEnum, getPropertyId, getPropertyUnits, isKnownProperty, scaleValue
+from cryostream_discovery import DeviceRegistry, resolveIP, resolveModel
+from cryostream_errors import CryostreamError
+from cryostream_listener import SharedStatusListener
+from cryostream_models import getModelSeries
+from cryostream_snapshot import FieldProjection
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Command line interface of the Cryostream 800, for scripts and shift operators
+# Every command runs on one or more devices at the same time, each in its own thread, with one shared status listener.
+# Devices are given by IP, or by name, controller number or coldhead number (cryostream_discovery.py).
+# The exit code is 0 if the command succeeded on every device, 1 otherwise.
+#
+# Usage:
+# python cryostream_cli.py -d 10.0.0.5 status --json
+# python cryostream_cli.py -d BL821 -d BL822 -d BL831 cool 100 --wait-stable
+# python cryostream_cli.py -d BL821 anneal --temp 100
+# python cryostream_cli.py -d BL822 --model 1000 anneal --duration 3
+# python cryostream_cli.py -d BL821 turbo on
+# python cryostream_cli.py -d BL821 autofill auto
+# python cryostream_cli.py -d BL821 -d BL822 watch --fields "Sample temp" "Gas flow"
+# python cryostream_cli.py -d BL821 record --duration 3600 --output-dir /data
+
+# Fields shown by status and watch when --fields is not given
+_defaultFields = ["Sample temp", "Target temp", "Run mode", "Gas flow", "Turbo mode", "AF Mode", "AF LN level"]
+
+_turboModes    = {"off": 0, "on": 1}
+_autofillModes = {"manual": 0, "auto": 1, "scheduled": 2}
+
+# Serializes the lines printed by the device threads
+_printLock = threading.Lock()
+
+#===============
+#=== Helpers ===
+#===============
+
+# Returns the fields of a status packet, name -> value in output units, or enumeration label
+# projection: FieldProjection of the fields, only they are decoded
+def _readFields(packet, projection):
+
+    values = dict()
+
+    for field, raw in zip(projection.getFields(), projection.read(packet)):
+        propId = getPropertyId(field)
+        if raw is None:
+            values[field] = None
+        else:
+            label = decodeEnum(propId, raw)
+            values[field] = label if label is not None else scaleValue(propId, raw)
+
+    return values
+
+# One line of text with the fields and their units
+def _formatFields(values, fields):
+
+    parts = []
+
+    for field in fields:
+        value = values[field]
+        units = getPropertyUnits(field)
+        if value is None:
+            parts.append(field + ": -")
+        elif units and not isinstance(value, str):
+            parts.append(field + ": " + str(value) + " " + units)
+        else:
+            parts.append(field + ": " + str(value))
+
+    return ", ".join(parts)
+
+def _print(line):
+    with _printLock:
+        print(line)
+        sys.stdout.flush()
+
+# Waits until the sample temperature stays within band (K) of the target for holdTime seconds
+# Returns False if it did not happen before the timeout (s)
+def _waitStable(device, targetTemp, band, holdTime, timeout):
+
+    stopTime    = time.time() + timeout
+    stableSince = None
+
+    while time.time() < stopTime:
+
+        device.refreshStatus()
+        sample = device.getSnapshot().get("Sample temp")
+
+        if sample is not None and abs(sample - targetTemp) <= band:
+            if stableSince is None:
+                stableSince = time.time()
+            if time.time() - stableSince >= holdTime:
+                return True
+        else:
+            stableSince = None
+
+    return False
+
+#================
+#=== Commands ===
+#================
+
+# Each command runs on one device (label: device as given by the user) and returns (succeeded, data shown to the user)
+
+def _commandStatus(device, label, args):
+    device.refreshStatus()
+    snapshot = device.getSnapshot()
+    values = _readFields(snapshot.getPacket(), FieldProjection(args.fields or _defaultFields))
+    values["ip"]  = device.getIP()
+    values["age"] = round(snapshot.getAge(), 3)
+    return True, values
+
+def _commandCool(device, label, args):
+
+    if not device.getReadySetTargetTemperatureAndGo(args.temperature):
+        return False, "target temperature not set"
+
+    if args.wait_stable:
+        if not _waitStable(device, float(args.temperature), args.band, args.hold, args.stable_timeout):
+            return False, "not stable within " + str(args.band) + " K after " + str(args.stable_timeout) + " s"
+        return True, "stable at " + str(args.temperature) + " K"
+
+    return True, "cooling to " + str(args.temperature) + " K"
+
+def _commandAnneal(device, label, args):
+    # Flow interrupt or software sequence, depending on the model of the device
+    method = device.getAnnealMethod()
+    if not device.anneal(args.temp, args.duration):
+        return False, "annealing failed (" + method + ")"
+    if method == "software":
+        return True, "annealed, cooling to " + str(args.temp) + " K"
+    return True, "annealed, flow interrupted for " + str(args.duration) + " s"
+
+def _commandTurbo(device, label, args):
+    if device.setTurboModeWithConfirmation(_turboModes[args.mode]):
+        return True, "turbo " + args.mode
+    return False, "turbo not set"
+
+def _commandAutofill(device, label, args):
+    if device.setAutofillModeWithConfirmation(_autofillModes[args.mode]):
+        return True, "autofill " + args.mode
+    return False, "autofill not set"
+
+def _commandStop(device, label, args):
+    if device.stopWithConfirmation():
+        return True, "stopped"
+    return False, "stop not confirmed"
+
+def _commandRestart(device, label, args):
+    if device.restartWithConfirmation():
+        return True, "ready"
+    return False, "restart not confirmed"
+
+# Prints the fields of every status packet until --count packets or Ctrl+C
+def _commandWatch(device, label, args):
+
+    fields     = args.fields or _defaultFields
+    projection = FieldProjection(fields)
+    count      = 0
+
+    while args.count is None or count < args.count:
+
+        device.refreshStatus()
+        values = _readFields(device.getSnapshot().getPacket(), projection)
+
+        if args.json:
+            values["ip"] = device.getIP()
+            values["timestamp"] = device.getSnapshot().getTimestamp()
+            _print(json.dumps(values))
+        else:
+            _print("[" + label + "] " + _formatFields(values, fields))
+
+        count += 1
+
+    return True, str(count) + " packets"
+
+# Records the raw status packets to <output dir>/<ip>.csr (cryostream_export.py)
+def _commandRecord(device, label, args):
+
+    from cryostream_export import recordDevice
+
+    path = os.path.join(args.output_dir, device.getIP() + ".csr")
+    records = recordDevice(device, path, args.duration)
+
+    return True, str(records) + " packets recorded to " + path
+
+#==============
+#=== Runner ===
+#==============
+
+# Runs a function on every device at the same time, returns {label: (succeeded, data)}
+def _runOnDevices(labels, function):
+
+    results = dict()
+    threads = []
+
+    def run(label):
+        # A failure on one device does not stop the others
+        try:
+            results[label] = function(label)
+        except Exception as e:
+            results[label] = (False, type(e).__name__ + ": " + str(e))
+
+    for label in labels:
+        thread = threading.Thread(target=run, args=(label,), name="Cryostream-" + label)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    # Joined with a timeout, so Ctrl+C reaches the main thread
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)
+
+    return results
+
+# Connects to every device, runs the command and prints the results
+# Returns the exit code
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description="Cryostream 800 command line")
+    parser.add_argument("-d", "--device", action="append", required=True,
+                        help="Device IP, name, controller number or coldhead number (repeat for several devices)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--registry", default=None, help="Discovery registry file")
+    parser.add_argument("--status-timeout", type=float, default=5.0, help="Seconds to wait for a status packet")
+    parser.add_argument("--model", choices=getModelSeries(), default=None,
+                        help="Model of the devices (default: from the discovery registry, 800 if unknown)")
+
+    commands = parser.add_subparsers(dest="command")
+
+    statusParser = commands.add_parser("status", help="Print the status")
+    statusParser.add_argument("--fields", nargs="+", default=None, help="Property names to print")
+
+    coolParser = commands.add_parser("cool", help="Get ready and cool to a temperature (K)")
+    coolParser.add_argument("temperature", help="Target temperature (K)")
+    coolParser.add_argument("--wait-stable", action="store_true", help="Wait until the sample temperature is stable")
+    coolParser.add_argument("--band", type=float, default=0.5, help="Stable band around the target (K)")
+    coolParser.add_argument("--hold", type=float, default=30.0, help="Seconds within the band to be stable")
+    coolParser.add_argument("--stable-timeout", type=float, default=1800.0, help="Seconds to wait for stability")
+
+    annealParser = commands.add_parser("anneal", help="Interrupt the flow, or stop, get ready and cool again (most 800s)")
+    annealParser.add_argument("--temp", type=float, default=100.0, help="Temperature after a software annealing (K)")
+    annealParser.add_argument("--duration", type=float, default=2.0, help="Seconds the flow is interrupted (0.1 to 60)")
+
+    turboParser = commands.add_parser("turbo", help="Set turbo mode")
+    turboParser.add_argument("mode", choices=sorted(_turboModes))
+
+    autofillParser = commands.add_parser("autofill", help="Set autofill mode")
+    autofillParser.add_argument("mode", choices=sorted(_autofillModes))
+
+    commands.add_parser("stop", help="Stop (shut down)")
+    commands.add_parser("restart", help="Get ready (restart)")
+
+    watchParser = commands.add_parser("watch", help="Print the status of every packet")
+    watchParser.add_argument("--fields", nargs="+", default=None, help="Property names to print")
+    watchParser.add_argument("--count", type=int, default=None, help="Packets to print (default: until Ctrl+C)")
+
+    recordParser = commands.add_parser("record", help="Record the raw status packets")
+    recordParser.add_argument("--duration", type=float, default=None, help="Seconds to record (default: until Ctrl+C)")
+    recordParser.add_argument("--output-dir", default=".", help="Folder of the recordings (<ip>.csr)")
+
+    args = parser.parse_args(argv)
+
+    handlers = {
+        "status":   _commandStatus,
+        "cool":     _commandCool,
+        "anneal":   _commandAnneal,
+        "turbo":    _commandTurbo,
+        "autofill": _commandAutofill,
+        "stop":     _commandStop,
+        "restart":  _commandRestart,
+        "watch":    _commandWatch,
+        "record":   _commandRecord,
+    }
+
+    if args.command not in handlers:
+        parser.print_help()
+        return 1
+
+    # Field names are checked before any device is contacted, a typo would otherwise fail on every packet
+    unknownFields = [field for field in getattr(args, "fields", None) or [] if not isKnownProperty(field)]
+    if unknownFields:
+        parser.error("unknown field(s): " + ", ".join(unknownFields))
+
+    # With --json, only the JSON goes to stdout, the progress messages of the library go to stderr
+    # watch prints its own JSON lines
+    stdout = sys.stdout
+    if args.json and args.command != "watch":
+        sys.stdout = sys.stderr
+
+    registry = DeviceRegistry(args.registry)
+    listener = SharedStatusListener()
+
+    results = dict()
+    ips     = dict()
+    devices = dict()
+
+    def connect(label):
+        ip     = ips[label]
+        device = Cryostream800(ip, raiseOnTimeout = True, statusTimeout = args.status_timeout, statusListener = listener,
+                               model = args.model or resolveModel(ip, registry))
+        devices[label] = device
+        return True, None
+
+    def execute(label):
+        return handlers[args.command](devices[label], label, args)
+
+    try:
+
+        # Names and numbers are resolved first, one after the other, before the listener opens port 30304:
+        # discovery listens on that port, and writes the registry file
+        for label in args.device:
+            try:
+                ips[label] = resolveIP(label, registry)
+            except CryostreamError as e:
+                results[label] = (False, type(e).__name__ + ": " + str(e))
+
+        listener.start()
+
+        results.update(_runOnDevices([label for label in args.device if label in ips], connect))
+        connected = [label for label in args.device if results[label][0]]
+        results.update(_runOnDevices(connected, execute))
+
+    except KeyboardInterrupt:
+        return 1
+    finally:
+        listener.stop()
+        sys.stdout = stdout
+
+    succeeded = all(results[label][0] for label in args.device)
+
+    if args.command == "watch":
+        pass
+    elif args.json:
+        print(json.dumps(dict((label, {"ok": results[label][0], "result": results[label][1]}) for label in args.device),
+                         indent = 1, sort_keys = True))
+    else:
+        for label in args.device:
+            ok, data = results[label]
+            if isinstance(data, dict):
+                fields = (args.fields or _defaultFields) if args.command == "status" else sorted(data)
+                data = _formatFields(data, fields)
+            print("[" + label + "] " + ("OK" if ok else "FAILED") + (": " + data if data else ""))
+
+    if args.command == "watch":
+        for label in args.device:
+            if not results[label][0]:
+                print("[" + label + "] FAILED: " + str(results[label][1]))
+
+    return 0 if succeeded else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
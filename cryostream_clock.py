@@ -0,0 +1,256 @@
+import calendar
+import collections
+import datetime
+import socket
+import struct
+import sys
+import time
+
+from cryostream_trend import LinearTrend
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Packet timestamps and device clock of the Cryostream 800
+#
+# Receive timestamps:
+# The time a status packet arrived is taken by the kernel (SO_TIMESTAMPNS, Linux, Python 3),
+# not by the program once the packet is read, so it does not depend on how long the program took to get to recv().
+# Timestamps are seconds since epoch (same clock as time.time()), time.time() is used where the kernel cannot stamp.
+#
+# Device clock:
+# Every status packet has the device clock in "Real time" (2511) and "Real date" (2512),
+# read here as the packed 16 bit time and date of FAT file systems (the controller keeps its log files this way):
+# - Real time: hours (5 bits), minutes (6 bits), seconds / 2 (5 bits)
+# - Real date: years since 1980 (7 bits), month (4 bits), day (5 bits)
+# The device clock counts in 2 s steps, and the packets come every second, so a single packet says little.
+# When the device clock steps between two packets, the step happened between their two receive timestamps.
+# Each step gives one interval that holds the offset (host time - device time), as wide as the time between the packets.
+# The offset is taken in the intersection of the intervals of the recent steps: as the broadcasts move relative
+# to the device clock, the intervals overlap less and the offset gets much tighter than the time between packets.
+# The drift is fitted on the middle of the intervals (least squares with exponential forgetting, LinearTrend),
+# and follows a slow change (temperature of the controller). It is used once the samples span an hour.
+# The network latency (well below 1 ms on a local network) is not corrected.
+# A device clock that jumps (set by the user, daylight saving) restarts the estimate.
+#
+# Usage:
+# clock = cryostream.getDeviceClock()
+# clock.getOffset()            # host time - device time (s), includes the time zone of the device
+# clock.getDrift()             # device clock error, s per s (1e-5 is 10 ppm, 0.86 s/day)
+# clock.toHostTime(t)          # device time (e.g. from a log file of the controller) -> time.time() scale
+
+# SO_TIMESTAMPNS is in the socket module from Python 3.7 on Linux, the value is 35 on every Linux architecture
+SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35 if sys.platform.startswith("linux") else None)
+
+# struct timespec of the kernel timestamp: seconds and nanoseconds, two native longs
+_timespec = struct.Struct("@ll")
+
+#=========================
+#=== Packet timestamps ===
+#=========================
+
+# Asks the kernel to stamp the packets received on a socket
+# Returns True if it will, False if the platform or the Python version cannot (then receiveStamped() uses time.time())
+def enableKernelTimestamps(s):
+
+    if SO_TIMESTAMPNS is None or not hasattr(s, "recvmsg"):
+        return False
+
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except socket.error:
+        return False
+
+    return True
+
+# Receives one packet with the time it arrived
+# kernelTimestamps: value returned by enableKernelTimestamps() for this socket
+# Returns (packet, address, timestamp)
+def receiveStamped(s, bufferSize, kernelTimestamps):
+
+    if not kernelTimestamps:
+        packet, address = s.recvfrom(bufferSize)
+        return packet, address, time.time()
+
+    packet, ancillary, flags, address = s.recvmsg(bufferSize, socket.CMSG_SPACE(_timespec.size))
+
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= _timespec.size:
+            seconds, nanoseconds = _timespec.unpack_from(data)
+            return packet, address, seconds + nanoseconds * 1e-9
+
+    return packet, address, time.time()
+
+#====================
+#=== Device clock ===
+#====================
+
+# Converts "Real time" and "Real date" (raw values) to seconds since epoch, reading the device clock as UTC
+# Returns None if the values are not a valid date
+def decodeDeviceClock(realTime, realDate):
+
+    try:
+        moment = datetime.datetime(1980 + (realDate >> 9), (realDate >> 5) & 0x0F, realDate & 0x1F,
+                                   realTime >> 11, (realTime >> 5) & 0x3F, (realTime & 0x1F) * 2)
+    except ValueError:
+        return None
+
+    return calendar.timegm(moment.timetuple())
+
+# Offset and drift of the device clock relative to the host clock
+class DeviceClock:
+
+    # Constructor
+    # decoder: function (realTime, realDate) -> device time in seconds, or None
+    # halfLife: a step of the device clock weighs half as much after halfLife seconds
+    # maxGap: steps seen across a longer time between packets (lost packets) are too vague to be used
+    # maxJump: a change of the device clock larger than this is a clock set, the estimate starts again
+    # minDriftSpan: the drift is used once the samples span this many seconds, before that it is mostly noise
+    #               (1 s of uncertainty per sample over a few minutes gives thousands of ppm)
+    # window: number of recent steps intersected to find the offset
+    def __init__(self, decoder = decodeDeviceClock, halfLife = 86400.0, maxGap = 1.5, maxJump = 10.0,
+                 minDriftSpan = 3600.0, window = 900):
+
+        self._decoder      = decoder
+        self._halfLife     = halfLife
+        self._maxGap       = maxGap
+        self._maxJump      = maxJump
+        self._minDriftSpan = minDriftSpan
+        self._window       = window
+
+        # Last device time and when it was seen
+        self._lastDeviceTime = None
+        self._lastHostTime   = None
+
+        # Offset samples, one per step of the device clock
+        self._resets = 0
+        self._reset()
+
+    # Adds a status packet
+    # hostTime: receive timestamp of the packet, realTime / realDate: raw values of 2511 / 2512 (None if missing)
+    # Returns True if the packet showed a step of the device clock (a new offset sample)
+    def add(self, hostTime, realTime, realDate):
+
+        if realTime is None or realDate is None:
+            return False
+
+        deviceTime = self._decoder(realTime, realDate)
+        if deviceTime is None:
+            return False
+
+        lastDeviceTime = self._lastDeviceTime
+        lastHostTime   = self._lastHostTime
+
+        self._lastDeviceTime = deviceTime
+        self._lastHostTime   = hostTime
+
+        if lastDeviceTime is None or deviceTime == lastDeviceTime:
+            return False
+
+        # Clock set, or going backwards: the samples so far are about another clock
+        if not 0 < deviceTime - lastDeviceTime <= self._maxJump:
+            self._reset()
+            self._resets += 1
+            return False
+
+        # The device clock stepped to deviceTime between the two packets
+        width = hostTime - lastHostTime
+        if width <= 0 or width > self._maxGap:
+            return False
+
+        if self._firstSampleTime is None:
+            self._firstSampleTime = deviceTime
+
+        # (device time, lowest offset, highest offset)
+        self._intervals.append((deviceTime, lastHostTime - deviceTime, hostTime - deviceTime))
+        self._trend.add(deviceTime, (lastHostTime + hostTime) / 2.0 - deviceTime)
+
+        return True
+
+    # Returns the offset (host time - device time, s) at a device time, by default the last one seen
+    # None before the first step of the device clock
+    def getOffset(self, deviceTime = None):
+
+        if self._firstSampleTime is None:
+            return None
+
+        if deviceTime is None:
+            deviceTime = self._lastDeviceTime
+
+        low, high = self._intersect(deviceTime)
+
+        return (low + high) / 2.0
+
+    # Returns the drift of the device clock, s per s (host - device offset change per second)
+    # None until the samples span minDriftSpan seconds
+    def getDrift(self):
+        if self._firstSampleTime is None or self._lastDeviceTime - self._firstSampleTime < self._minDriftSpan:
+            return None
+        return self._trend.getSlope()
+
+    # Returns the uncertainty (s) of the offset: half the width of the intersection of the intervals
+    # None before the first step of the device clock
+    def getUncertainty(self):
+        if self._firstSampleTime is None:
+            return None
+        low, high = self._intersect(self._lastDeviceTime)
+        return (high - low) / 2.0
+
+    # Returns the number of offset samples in the estimate
+    def getSampleCount(self):
+        return self._trend.getCount()
+
+    # Returns the number of times the device clock jumped and the estimate started again
+    def getResets(self):
+        return self._resets
+
+    # Returns the last device time seen (seconds since epoch, device clock read as UTC), None if never
+    def getDeviceTime(self):
+        return self._lastDeviceTime
+
+    # Converts a device time to the host clock (time.time() scale), None while the offset is unknown
+    def toHostTime(self, deviceTime):
+        offset = self.getOffset(deviceTime)
+        if offset is None:
+            return None
+        return deviceTime + offset
+
+    # Converts a host time (time.time() scale) to the device clock, None while the offset is unknown
+    def toDeviceTime(self, hostTime):
+        offset = self.getOffset()
+        if offset is None:
+            return None
+        # The offset depends on the device time through the drift, one correction is enough (drift << 1)
+        return hostTime - self.getOffset(hostTime - offset)
+
+    # Returns the state of the estimate, for display or logs
+    def toDict(self):
+        drift = self.getDrift()
+        return {"offset": self.getOffset(), "driftPpm": None if drift is None else drift * 1e6,
+                "uncertainty": self.getUncertainty(), "samples": self.getSampleCount(), "resets": self._resets}
+
+    # Forgets the samples
+    def _reset(self):
+        self._trend           = LinearTrend(self._halfLife)
+        self._intervals       = collections.deque(maxlen = self._window)
+        self._firstSampleTime = None
+
+    # Returns (lowest, highest) offset at a device time allowed by the recent intervals, moved by the drift
+    # From the newest interval back, up to the first one that does not overlap the others
+    # (an older interval is off by the drift not yet known, or by a late packet)
+    def _intersect(self, deviceTime):
+
+        drift = self.getDrift() or 0.0
+
+        low  = float("-inf")
+        high = float("inf")
+
+        for sampleTime, lowest, highest in reversed(self._intervals):
+            lowest  = max(low, lowest + drift * (deviceTime - sampleTime))
+            highest = min(high, highest + drift * (deviceTime - sampleTime))
+            if lowest > highest:
+                break
+            low, high = lowest, highest
+
+        return low, high
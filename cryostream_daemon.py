@@ -0,0 +1,351 @@
+import argparse
+import json
+import threading
+
+try:
+    # Python 2.7
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+from cryostream800 import Cryostream800
+from cryostream_catalog import getPropertyName
+from cryostream_fanout import FanoutPublisher
+from cryostream_listener import SharedStatusListener
+from cryostream_models import getModelSeries
+from cryostream_scheduler import CommandScheduler
+from cryostream_shm import SharedStatusWriter
+from cryostream_supervisor import SupervisedThread
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Local network control daemon for the Cryostream 800
+# One long-running process owns the device (status port 30304 and command port 30305)
+# and serves status snapshots and commands to many local clients over HTTP/JSON.
+# Port 30304 is opened once, by a SharedStatusListener, so the background status reads and the
+# confirmation loops of the commands wait for the same broadcasts instead of binding the port in turn.
+#
+# Endpoints:
+# GET  /status                      -> Last status snapshot (all fields)
+# GET  /status?fields=Run mode,...  -> Last status snapshot (selected fields)
+# GET  /health                      -> Model, listener restarts, last error, skipped packet counters and device clock offset
+# GET  /events                      -> Server-Sent Events stream with the fields that changed
+# POST /command/<name>              -> Runs a command, body {"args": [...], "wait": true}
+#                                      A command that runs longer than _maxCommandWait, and every profile,
+#                                      answers 202 and goes on running on the device
+#
+# With --fanout, every raw status packet is also forwarded to local consumers (see cryostream_fanout.py)
+# With --shm, the last status is kept in shared memory for lock-free local readers (see cryostream_shm.py)
+# With --model 1000, the device is driven as a Cryostream 1000, "anneal" interrupts the flow (see cryostream_models.py)
+#
+# Usage:
+# python cryostream_daemon.py --ip 121.223.76.47 --port 8800 [--fanout /tmp/cryostream.sock] [--shm /dev/shm/bl821.shm]
+
+# Commands available to clients, name -> Cryostream800 method
+# Commands with confirmation go through the command scheduler (serialized, single-flight)
+_daemonCommands = {
+    "cool":     "coolWithConfirmation",
+    "restart":  "restartWithConfirmation",
+    "stop":     "stopWithConfirmation",
+    "turbo":    "setTurboModeWithConfirmation",
+    "autofill": "setAutofillModeWithConfirmation",
+    "anneal":   "anneal",
+    "profile":  "runProfile",
+}
+
+# Commands that last for hours (one phase after the other), always answered with 202 without waiting
+_longCommands = frozenset(["profile"])
+
+# Longest time (s) a client waits for the result of a command, the HTTP thread is not held longer
+_maxCommandWait = 120.0
+
+# Owns a Cryostream 800 and keeps a status cache shared by every client
+class CryostreamDaemon:
+
+    # Constructor
+    # fanoutPath: optional Unix domain socket path where raw status packets are forwarded
+    # shmPath: optional shared memory segment path where the last status is kept ("" for the default path)
+    # model: model of the device (cryostream_models.py), None for the Cryostream 800
+    def __init__(self, ip, fanoutPath = None, shmPath = None, model = None):
+
+        # Receiver of the status broadcasts, open as long as the daemon runs
+        self._statusListener = SharedStatusListener()
+        self._statusListener.start()
+
+        # Device and command scheduler
+        try:
+            self._device = Cryostream800(ip, statusListener = self._statusListener, model = model)
+        except Exception:
+            self._statusListener.stop()
+            raise
+        self._scheduler = CommandScheduler(self._device)
+
+        # Raw packet fan-out to local consumers
+        self._fanout = None
+        if fanoutPath is not None:
+            self._fanout = FanoutPublisher(fanoutPath)
+
+        # Last status in shared memory
+        self._shm = None
+        if shmPath is not None:
+            self._shm = SharedStatusWriter(ip, shmPath or None)
+
+        # Status cache: version is incremented every time a status packet changes a field
+        self._status      = dict()
+        self._version     = 0
+        self._timestamp   = 0.0
+        self._changed     = dict()
+        self._statusReady = threading.Condition()
+
+        self._publish(self._device.getSnapshot())
+
+        # Background listener, one status read per broadcast (every second) for all clients
+        # Supervised, restarted automatically if reading or decoding the status fails
+        self._listener = SupervisedThread("CryostreamListener-" + ip, self._listenOnce)
+        self._listener.start()
+
+    # Returns the device (Cryostream800) served by this daemon
+    def getDevice(self):
+        return self._device
+
+    # Returns (version, timestamp, status) with the fields asked
+    # fields: list of property names, None returns every field
+    def getStatus(self, fields = None):
+        with self._statusReady:
+            if fields is None:
+                status = dict(self._status)
+            else:
+                status = dict((f, self._status[f]) for f in fields if f in self._status)
+            return self._version, self._timestamp, status
+
+    # Blocks until a status newer than version is available (or timeout)
+    # Returns (version, timestamp, changedFields)
+    # If the client fell behind more than one version, it receives the full status
+    def waitForChange(self, version, timeout = None):
+        with self._statusReady:
+            if self._version == version:
+                self._statusReady.wait(timeout)
+            if self._version == version:
+                return version, self._timestamp, dict()
+            if self._version == version + 1:
+                return self._version, self._timestamp, dict(self._changed)
+            return self._version, self._timestamp, dict(self._status)
+
+    # Runs a command on the device
+    # Returns a CommandFuture
+    def runCommand(self, name, args):
+        if name not in _daemonCommands:
+            raise KeyError("Unknown command: " + name)
+        return self._scheduler.submit(_daemonCommands[name], *args)
+
+    # Returns listener health: restarts, last error, skipped packets, packet integrity and device clock
+    def getHealth(self):
+        lastError = self._listener.getLastError()
+        return {
+            "model":            self._device.getModel().getName(),
+            "listenerRestarts": self._listener.getRestarts(),
+            "lastError":        None if lastError is None else type(lastError).__name__ + ": " + str(lastError),
+            "packetErrors":     self._device.getPacketErrorCounts(),
+            "packetIntegrity":  self._device.getPacketIntegrityStats(),
+            "deviceClock":      self._device.getDeviceClock().toDict(),
+        }
+
+    # Stops the listener and the scheduler
+    def close(self):
+        self._listener.stop(timeout = 0)
+        self._scheduler.close(wait = False)
+        self._statusListener.stop()
+        if self._fanout is not None:
+            self._fanout.close()
+        if self._shm is not None:
+            self._shm.close()
+
+    # Copies a status snapshot of the device into the cache and wakes up streaming clients
+    def _publish(self, snapshot):
+
+        status = dict()
+
+        # Names for known properties, the numeric id for the others, raw values
+        for propId in snapshot.getIds():
+            status[getPropertyName(propId) or str(propId)] = snapshot.getRaw(propId)
+
+        with self._statusReady:
+
+            changed = dict((k, v) for k, v in status.items() if self._status.get(k) != v)
+
+            # Receive time of the packet (stamped by the kernel when possible), not the time it was processed
+            self._timestamp = snapshot.getTimestamp()
+
+            if changed:
+                self._status  = status
+                self._changed = changed
+                self._version += 1
+                self._statusReady.notify_all()
+
+    # Updates the status cache with the next status packet broadcast by the device
+    # Called over and over by the supervisor
+    def _listenOnce(self):
+        self._device.refreshStatus()
+        snapshot = self._device.getSnapshot()
+        if self._fanout is not None:
+            self._fanout.publish(snapshot.getIP(), snapshot.getPacket(), snapshot.getTimestamp())
+        if self._shm is not None:
+            self._shm.publish(snapshot.getPacket(), snapshot.getTimestamp())
+        self._publish(snapshot)
+
+# Threaded HTTP server, one thread per client connection
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+# HTTP/JSON request handler
+class CryostreamRequestHandler(BaseHTTPRequestHandler):
+
+    # Keep-alive connections
+    protocol_version = "HTTP/1.1"
+
+    # Set by serve()
+    daemon = None
+
+    # Silences the default access log
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+
+        url = urlparse(self.path)
+
+        if url.path == "/status":
+            query  = parse_qs(url.query)
+            fields = None
+            if "fields" in query:
+                fields = [f for value in query["fields"] for f in value.split(",")]
+            version, timestamp, status = self.daemon.getStatus(fields)
+            self._sendJSON(200, {"ip": self.daemon.getDevice().getIP(), "version": version, "timestamp": timestamp, "age": self.daemon.getDevice().getStatusAge(), "status": status})
+
+        elif url.path == "/health":
+            self._sendJSON(200, self.daemon.getHealth())
+
+        elif url.path == "/events":
+            self._streamEvents()
+
+        else:
+            self._sendJSON(404, {"error": "Unknown path " + url.path})
+
+    def do_POST(self):
+
+        url = urlparse(self.path)
+
+        if not url.path.startswith("/command/"):
+            self._sendJSON(404, {"error": "Unknown path " + url.path})
+            return
+
+        name = url.path[len("/command/"):]
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body   = json.loads(self.rfile.read(length).decode("utf-8")) if length else dict()
+            future = self.daemon.runCommand(name, body.get("args", []))
+        except KeyError as e:
+            self._sendJSON(404, {"error": str(e)})
+            return
+        except Exception as e:
+            self._sendJSON(400, {"error": str(e)})
+            return
+
+        if not body.get("wait", True) or name in _longCommands:
+            self._sendJSON(202, {"command": name, "accepted": True})
+            return
+
+        try:
+            result = future.result(_maxCommandWait)
+        except Exception as e:
+            self._sendJSON(500, {"command": name, "error": str(e)})
+            return
+
+        # Still running, e.g. waiting behind a profile, the client gets its thread back
+        if not future.done():
+            self._sendJSON(202, {"command": name, "accepted": True, "running": True})
+            return
+
+        self._sendJSON(200, {"command": name, "result": result})
+
+    # Sends a JSON response
+    def _sendJSON(self, code, data):
+        payload = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Server-Sent Events: first the full status, then only the changed fields
+    def _streamEvents(self):
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        version, timestamp, status = self.daemon.getStatus()
+
+        try:
+            while True:
+                event = {"version": version, "timestamp": timestamp, "status": status}
+                self.wfile.write(("data: " + json.dumps(event) + "\n\n").encode("utf-8"))
+                self.wfile.flush()
+                # Keep-alive comment every 15 seconds without changes
+                while True:
+                    newVersion, timestamp, status = self.daemon.waitForChange(version, 15)
+                    if newVersion != version:
+                        version = newVersion
+                        break
+                    self.wfile.write(b": keep-alive\n\n")
+                    self.wfile.flush()
+        except (IOError, OSError):
+            # Client disconnected
+            pass
+
+# Starts the daemon and serves HTTP clients until interrupted
+def serve(ip, host = "127.0.0.1", port = 8800, fanoutPath = None, shmPath = None, model = None):
+
+    daemon = CryostreamDaemon(ip, fanoutPath, shmPath, model)
+
+    # Handler class bound to this daemon
+    class BoundRequestHandler(CryostreamRequestHandler):
+        pass
+    BoundRequestHandler.daemon = daemon
+
+    server = _ThreadingHTTPServer((host, port), BoundRequestHandler)
+
+    print(daemon.getDevice().getModel().getName() + " daemon for " + ip + " listening on http://" + host + ":" + str(port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Exiting program.")
+    finally:
+        server.server_close()
+        daemon.close()
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cryostream 800 local control daemon")
+    parser.add_argument("--ip", required=True, help="IP of the Cryostream 800")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to serve clients on")
+    parser.add_argument("--port", type=int, default=8800, help="HTTP port to serve clients on")
+    parser.add_argument("--fanout", default=None, help="Unix domain socket path to forward raw status packets to")
+    parser.add_argument("--shm", default=None, nargs="?", const="", help="Shared memory segment path for the last status (default: /dev/shm/cryostream-<ip>.shm)")
+    parser.add_argument("--model", choices=getModelSeries(), default=None, help="Model of the device (default: 800)")
+    args = parser.parse_args()
+
+    serve(args.ip, args.host, args.port, args.fanout, args.shm, args.model)
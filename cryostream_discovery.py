@@ -0,0 +1,324 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import select
+import socket
+import struct
+import threading
+import time
+
+from cryostream_errors import DeviceNotFoundError
+from cryostream_models import detectModel, getModel, getModelSeries
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Discovery of the Cryostreams on the subnetwork, and a registry of them cached on disk
+# Every device broadcasts:
+# - Port 30303 UDP: identification packets
+# - Port 30304 UDP: status packets, once per second
+# Discovery listens to both for a few seconds and records, per device IP:
+# - "device", "firmware", "controllerNumber", "coldheadNumber": status fields #1000, #1004, #1028 and #1029
+# - "identification": readable text of the identification packet (model name, ...)
+# - "lastSeen": time.time() of the last packet
+# - "model": model set by hand with setModel() ("800", "1000"), otherwise read from the identification text
+# The registry is saved as JSON, so scripts can connect by name or serial number without listening again.
+# Entries not seen for longer than the TTL are ignored until the device is discovered again.
+#
+# Usage:
+# cryostream = connect("821")                # Name given with setName(), controller or coldhead number, or IP
+#                                            # Cryostream800 driver with the model of the device (cryostream_models.py)
+# discover(duration = 3.0)                   # Listens and updates the registry
+#
+# Command line:
+# python cryostream_discovery.py                     # Lists the devices on the network
+# python cryostream_discovery.py --name 10.0.0.5 BL821
+# python cryostream_discovery.py --model 10.0.0.6 1000
+
+_identificationPort = 30303
+_statusPort         = 30304
+
+# Default registry file, and how long (s) an entry stays valid after the device was last seen
+_defaultRegistryPath = os.path.join(os.path.expanduser("~"), ".cryostream_registry.json")
+_defaultTTL          = 24 * 3600.0
+
+# Status fields copied into the registry
+_statusFields = {
+    1000: "device",
+    1004: "firmware",
+    1028: "controllerNumber",
+    1029: "coldheadNumber",
+}
+
+# Runs of 4 or more printable characters in the identification packet
+_printableText = re.compile(b"[\\x20-\\x7e]{4,}")
+
+_ipAddress = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")
+
+#================
+#=== Registry ===
+#================
+
+# Devices found on the network, cached in a JSON file
+class DeviceRegistry:
+
+    # Constructor
+    # path: JSON file, created on the first save()
+    # ttl: seconds an entry stays valid after the device was last seen
+    def __init__(self, path = None, ttl = _defaultTTL):
+
+        self._path    = path or _defaultRegistryPath
+        self._ttl     = ttl
+        self._devices = dict()
+        self._lock    = threading.Lock()
+
+        self.load()
+
+    # Reads the registry file, a missing or damaged file gives an empty registry
+    def load(self):
+
+        with self._lock:
+            try:
+                with open(self._path) as registryFile:
+                    self._devices = json.load(registryFile)
+            except (IOError, OSError, ValueError):
+                self._devices = dict()
+
+    # Writes the registry file
+    # The file is replaced in one step, a crash while saving leaves the previous registry
+    def save(self):
+
+        with self._lock:
+
+            temporaryPath = self._path + ".tmp"
+
+            with open(temporaryPath, "w") as registryFile:
+                json.dump(self._devices, registryFile, indent = 1, sort_keys = True)
+
+            # os.rename does not replace an existing file on Windows
+            if os.name == "nt" and os.path.exists(self._path):
+                os.remove(self._path)
+
+            os.rename(temporaryPath, self._path)
+
+    # Records what was seen from a device
+    def update(self, ip, **fields):
+
+        with self._lock:
+            entry = self._devices.setdefault(ip, {"ip": ip})
+            entry.update(fields)
+            entry["lastSeen"] = time.time()
+
+    # Gives a name to a device, kept even when the entry expires
+    def setName(self, ip, name):
+
+        with self._lock:
+            entry = self._devices.setdefault(ip, {"ip": ip, "lastSeen": 0.0})
+            entry["name"] = name
+
+    # Sets the model of a device ("800", "1000"), kept even when the entry expires
+    # For devices whose identification broadcast does not name the model
+    def setModel(self, ip, model):
+
+        with self._lock:
+            entry = self._devices.setdefault(ip, {"ip": ip, "lastSeen": 0.0})
+            entry["model"] = model
+
+    # Returns the entry of a device by name, controller number, coldhead number or IP, None if not found or expired
+    def find(self, key):
+
+        key = str(key)
+
+        with self._lock:
+
+            now = time.time()
+            devices = [entry for entry in self._devices.values() if now - entry.get("lastSeen", 0.0) <= self._ttl]
+
+            # In order of priority, the first match wins
+            for field in ("name", "ip", "controllerNumber", "coldheadNumber"):
+                for entry in devices:
+                    if field in entry and str(entry[field]) == key:
+                        return dict(entry)
+
+        return None
+
+    # Returns the entries seen within the TTL (or all of them)
+    def listDevices(self, includeExpired = False):
+
+        with self._lock:
+            now = time.time()
+            return [dict(entry) for entry in self._devices.values()
+                    if includeExpired or now - entry.get("lastSeen", 0.0) <= self._ttl]
+
+    # Returns the path of the registry file
+    def getPath(self):
+        return self._path
+
+#=================
+#=== Discovery ===
+#=================
+
+# Listens to identification and status broadcasts for the given seconds and updates the registry
+# stopWhen: optional function(registry) called after every packet, discovery ends early when it returns True
+# Returns the entries of the devices seen
+def discover(duration = 3.0, registry = None, stopWhen = None):
+
+    if registry is None:
+        registry = DeviceRegistry()
+
+    sockets = []
+    for port in (_identificationPort, _statusPort):
+        s = _openBroadcastSocket(port)
+        if s is not None:
+            sockets.append(s)
+
+    seen     = set()
+    deadline = time.time() + duration
+
+    try:
+        while sockets:
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            ready = select.select(sockets, [], [], remaining)[0]
+
+            for s in ready:
+                packet, address = s.recvfrom(8192)
+                ip = address[0]
+                if s.getsockname()[1] == _statusPort:
+                    registry.update(ip, **_readStatusFields(packet))
+                else:
+                    registry.update(ip, identification = _readIdentification(packet))
+                seen.add(ip)
+
+            if stopWhen is not None and stopWhen(registry):
+                break
+    finally:
+        for s in sockets:
+            s.close()
+
+    registry.save()
+
+    return [entry for entry in registry.listDevices() if entry["ip"] in seen]
+
+# Returns the IP of a device by name, controller number, coldhead number or IP
+# Looks in the registry first, and only listens to the network if the device is not there (or expired)
+# Raises DeviceNotFoundError if the device is not found within discoveryTimeout seconds
+def resolveIP(key, registry = None, discoveryTimeout = 3.0):
+
+    if registry is None:
+        registry = DeviceRegistry()
+
+    entry = registry.find(key)
+
+    # An IP not in the registry is used as it is, no need to listen
+    if entry is None and _ipAddress.match(str(key)):
+        return str(key)
+
+    if entry is None:
+        discover(discoveryTimeout, registry, stopWhen = lambda found: found.find(key) is not None)
+        entry = registry.find(key)
+
+    if entry is not None:
+        return str(entry["ip"])
+
+    raise DeviceNotFoundError(key)
+
+# Returns the model of a device by IP (cryostream_models.py), from the registry, the default model if unknown
+# Expired entries count, the model of a device does not change
+def resolveModel(ip, registry = None):
+
+    if registry is None:
+        registry = DeviceRegistry()
+
+    for entry in registry.listDevices(includeExpired = True):
+        if entry["ip"] == ip:
+            return detectModel(entry)
+
+    return detectModel(None)
+
+# Returns a Cryostream800 connected to a device given by name, controller number, coldhead number or IP
+# The model comes from the registry unless given (model = "1000")
+def connect(key, registry = None, discoveryTimeout = 3.0, **options):
+
+    # Imported here, cryostream800.py does not depend on discovery
+    from cryostream800 import Cryostream800
+
+    if registry is None:
+        registry = DeviceRegistry()
+
+    ip = resolveIP(key, registry, discoveryTimeout)
+
+    if options.get("model") is None:
+        options["model"] = resolveModel(ip, registry)
+
+    return Cryostream800(ip, **options)
+
+# Opens a socket receiving the broadcasts on a port, None if the port is already used by another program
+def _openBroadcastSocket(port):
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("0.0.0.0", port))
+    except socket.error as e:
+        print("Discovery: cannot listen on port " + str(port) + " (" + str(e) + ").")
+        s.close()
+        return None
+
+    return s
+
+# Reads the identification fields of a status packet
+def _readStatusFields(packet):
+
+    fields = dict()
+    words  = struct.unpack_from(">" + str(len(packet) // 4 * 2) + "H", packet)
+
+    for index in range(0, len(words), 2):
+        name = _statusFields.get(words[index])
+        if name is not None:
+            fields[name] = words[index + 1]
+
+    return fields
+
+# The layout of the identification packet is not documented, its readable text is kept
+def _readIdentification(packet):
+    return " ".join(text.decode("ascii").strip() for text in _printableText.findall(bytes(packet)))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cryostream discovery")
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds to listen")
+    parser.add_argument("--registry", default=None, help="Registry file (default: ~/.cryostream_registry.json)")
+    parser.add_argument("--name", nargs=2, metavar=("IP", "NAME"), default=None, help="Give a name to a device")
+    parser.add_argument("--model", nargs=2, metavar=("IP", "MODEL"), default=None,
+                        help="Set the model of a device (" + ", ".join(getModelSeries()) + ")")
+    args = parser.parse_args()
+
+    registry = DeviceRegistry(args.registry)
+
+    if args.name is not None:
+        registry.setName(args.name[0], args.name[1])
+        registry.save()
+
+    if args.model is not None:
+        registry.setModel(args.model[0], getModel(args.model[1]).getSeries())
+        registry.save()
+
+    devices = discover(args.duration, registry)
+
+    print(str(len(devices)) + " device(s) found, registry " + registry.getPath())
+
+    for entry in sorted(devices, key = lambda entry: entry["ip"]):
+        print(entry["ip"] + "  name: " + str(entry.get("name")) + "  model: " + detectModel(entry).getName() +
+              "  controller: " + str(entry.get("controllerNumber")) + "  coldhead: " + str(entry.get("coldheadNumber")) +
+              "  firmware: " + str(entry.get("firmware")) +
+              "  " + entry.get("identification", ""))
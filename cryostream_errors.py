@@ -0,0 +1,90 @@
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Exceptions raised by the Cryostream controller
+# The library never calls sys.exit(), errors are raised so long-running services can recover.
+# Every exception derives from CryostreamError, so callers can catch all of them at once.
+
+# Base class of every Cryostream error
+class CryostreamError(Exception):
+    pass
+
+# Status packets keep arriving from a device other than the one we are talking to
+# Usually a wrong IP in the script, or another Cryostream broadcasting on the same subnetwork
+class ForeignSourceError(CryostreamError):
+
+    # Constructor
+    # interestIP: IP of the device we want to talk to
+    # foreignIP: IP the last status packet came from
+    def __init__(self, interestIP, foreignIP):
+
+        self.interestIP = interestIP
+        self.foreignIP  = foreignIP
+
+        message  = "The UDP packets captured from the subnetwork are coming from " + foreignIP + ". "
+        message += "You are trying to communicate with " + interestIP + ". "
+        message += "Check the IP settings of the Cryostream and that you are connecting to the right device."
+
+        CryostreamError.__init__(self, message)
+
+# No status packet arrived from the device before the deadline
+# The device is powered off, unplugged, or its broadcast is filtered
+class StatusTimeout(CryostreamError):
+
+    # Constructor
+    # ip: IP of the device
+    # deadline: time.time() value that expired
+    def __init__(self, ip, deadline):
+
+        self.ip       = ip
+        self.deadline = deadline
+
+        CryostreamError.__init__(self, "No status packet received from " + ip + " before the deadline.")
+
+# A status packet could not be decoded (truncated or corrupted datagram)
+class MalformedPacketError(CryostreamError):
+    pass
+
+# A command was not built correctly (wrong number of bytes, values out of range)
+class InvalidCommandError(CryostreamError, ValueError):
+    pass
+
+# A command with confirmation was not confirmed by the device status in time
+class ConfirmationTimeout(CryostreamError):
+
+    # Constructor
+    # commandType: "Cool", "Ramp", "Plat", "Hold", "End", "Stop", "Restart", "Turbo", "Autofill", "Interrupt time" or "Interrupt"
+    # attempts: number of times the command was sent
+    # elapsed: seconds spent trying
+    def __init__(self, commandType, attempts, elapsed):
+
+        self.commandType = commandType
+        self.attempts    = attempts
+        self.elapsed     = elapsed
+
+        message = commandType + " was not confirmed after " + str(attempts) + " attempts (" + str(round(elapsed, 1)) + " s)."
+
+        CryostreamError.__init__(self, message)
+
+# No device matches the name, serial or IP given, in the registry or on the network
+class DeviceNotFoundError(CryostreamError):
+
+    # Constructor
+    # key: name, controller number, coldhead number or IP that was looked up
+    def __init__(self, key):
+
+        self.key = key
+
+        CryostreamError.__init__(self, "No Cryostream matching " + str(key) + " was found on the network.")
+
+# A Cryostream model that is not in cryostream_models.py was asked for
+class UnknownModelError(CryostreamError, ValueError):
+
+    # Constructor
+    # model: series or name that was looked up
+    def __init__(self, model):
+
+        self.model = model
+
+        CryostreamError.__init__(self, "Unknown Cryostream model: " + str(model) + ".")
@@ -0,0 +1,372 @@
+from __future__ import print_function
+
+import argparse
+import csv
+import datetime
+import os
+import struct
+import sys
+import time
+
+from cryostream_catalog import getPropertyId, getPropertyName, getPropertyType
+from cryostream_errors import CryostreamError
+from cryostream_snapshot import FieldProjection, PacketLayout, StatusSnapshot
+
+# pyarrow is optional, without it the history is exported as CSV
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Recording and batch export of the Cryostream 800 status history
+# The recorder appends every raw status packet, with its receive time, to a recording file.
+# The exporter streams a recording (or any iterable of (timestamp, packet)) to:
+# - Parquet (columnar, compressed) or Arrow IPC, in record batches, if pyarrow is installed
+# - CSV, written in chunks, otherwise
+# Only one batch of rows is kept in memory, so memory use does not grow with the length of the history.
+#
+# Recording file format (big endian):
+# [0:4]   Magic "CSR1"
+# Then one record per status packet:
+# [0:8]   Receive timestamp (double, seconds since epoch)
+# [8:10]  Packet length (uint16)
+# [10:]   Raw status packet, exactly as broadcast by the device
+#
+# Usage:
+# recordDevice(cryostream, "history.csr", duration = 3600)
+# exportRecording("history.csr", "history.parquet", columns = ["Sample temp", "Gas flow"], start = t0, end = t1)
+#
+# Command line:
+# python cryostream_export.py record --ip 192.168.1.10 history.csr --duration 3600
+# python cryostream_export.py export history.csr history.parquet --columns "Sample temp" "Gas flow"
+
+_recordingMagic  = b"CSR1"
+_recordingHeader = struct.Struct(">dH")
+
+# Output formats by file extension
+_formatsByExtension = {
+    ".parquet": "parquet",
+    ".arrow":   "arrow",
+    ".feather": "arrow",
+    ".csv":     "csv",
+}
+
+#=================
+#=== Recording ===
+#=================
+
+# Appends raw status packets to a recording file
+class StatusRecorder:
+
+    # Constructor
+    # path: recording file, created if it does not exist, appended to otherwise
+    def __init__(self, path):
+
+        self._path = path
+        self._file = open(path, "ab")
+        self._records = 0
+
+        # New file, write the magic
+        if self._file.tell() == 0:
+            self._file.write(_recordingMagic)
+
+    # Appends one packet
+    # packet: raw status packet (bytes)
+    # timestamp: time.time() when the packet was received
+    def record(self, packet, timestamp):
+        self._file.write(_recordingHeader.pack(timestamp, len(packet)))
+        self._file.write(packet)
+        self._records += 1
+
+    # Appends the packet of a StatusSnapshot
+    def recordSnapshot(self, snapshot):
+        self.record(snapshot.getPacket(), snapshot.getTimestamp())
+
+    # Returns the number of packets recorded by this recorder
+    def getRecords(self):
+        return self._records
+
+    # Writes the buffered records to disk
+    def flush(self):
+        self._file.flush()
+
+    # Closes the recording file
+    def close(self):
+        self._file.close()
+
+# Records the status of a device until the duration (s) expires, or forever if duration is None
+# Status timeouts are reported and recording goes on
+def recordDevice(cryostream, path, duration = None):
+
+    recorder = StatusRecorder(path)
+    stopTime = None if duration is None else time.time() + duration
+
+    try:
+        while stopTime is None or time.time() < stopTime:
+            try:
+                cryostream.refreshStatus()
+            except CryostreamError as e:
+                print("Recording: " + str(e))
+                continue
+            recorder.recordSnapshot(cryostream.getSnapshot())
+            recorder.flush()
+    except KeyboardInterrupt:
+        print("Recording stopped.")
+    finally:
+        recorder.close()
+
+    return recorder.getRecords()
+
+# Reads a recording file, one (timestamp, packet) at a time
+# start, end: only packets received in [start, end] (seconds since epoch) are returned, None for no limit
+def readRecordedPackets(path, start = None, end = None):
+
+    with open(path, "rb") as recording:
+
+        if recording.read(len(_recordingMagic)) != _recordingMagic:
+            raise CryostreamError(path + " is not a Cryostream status recording.")
+
+        while True:
+
+            header = recording.read(_recordingHeader.size)
+
+            # End of the file, or a record cut short by a crash while recording
+            if len(header) < _recordingHeader.size:
+                return
+
+            timestamp, length = _recordingHeader.unpack(header)
+            packet = recording.read(length)
+
+            if len(packet) < length:
+                return
+
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                continue
+
+            yield timestamp, packet
+
+# Reads a recording file, one (timestamp, StatusSnapshot) at a time, values in output units (K, ...)
+# Can be passed directly to cryostream_analytics.analyzeHistory() and to the other analyzers
+def readRecording(path, start = None, end = None, ip = None):
+    layout = PacketLayout()
+    for timestamp, packet in readRecordedPackets(path, start, end):
+        yield timestamp, StatusSnapshot(packet, timestamp, layout, ip)
+
+#==============
+#=== Export ===
+#==============
+
+# Exports a status history to a file, streaming
+# history: iterable of (timestamp, raw status packet), e.g. readRecordedPackets()
+# path: output file, the format is taken from the extension (.parquet, .arrow, .feather, .csv) unless given
+# columns: property names ("Sample temp") or IDs to export, None for every property of the first packet
+# start, end: only packets received in [start, end] (seconds since epoch), None for no limit
+# outputFormat: "parquet", "arrow" or "csv"
+# batchSize: rows kept in memory before they are written
+# compression: Parquet compression codec
+# Returns (path written, number of rows)
+# Without pyarrow, Parquet and Arrow exports are written as CSV next to the requested path
+def exportHistory(history, path, columns = None, start = None, end = None, outputFormat = None,
+                  batchSize = 10000, compression = "zstd"):
+
+    if outputFormat is None:
+        outputFormat = _formatsByExtension.get(os.path.splitext(path)[1].lower(), "csv")
+
+    if outputFormat not in ("parquet", "arrow", "csv"):
+        raise ValueError("Unknown export format: " + str(outputFormat) + ". Use parquet, arrow or csv.")
+
+    if outputFormat != "csv" and pyarrow is None:
+        path = os.path.splitext(path)[0] + ".csv"
+        outputFormat = "csv"
+        print("pyarrow is not installed, exporting as CSV to " + path + ".")
+
+    propIds = None if columns is None else _resolveColumns(columns)
+    layout     = PacketLayout()
+    projection = None
+    writer     = None
+    batch      = None
+    rows       = 0
+
+    try:
+        for timestamp, packet in history:
+
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp > end:
+                continue
+
+            # The columns are fixed by the first packet, so every batch has the same schema
+            # Only the exported columns are decoded (FieldProjection), the rest of the packet is skipped
+            if writer is None:
+                if propIds is None:
+                    layout.learn(packet)
+                    propIds = sorted(layout.getIds())
+                projection = FieldProjection(propIds)
+                writer     = _createWriter(outputFormat, path, propIds, compression)
+                batch      = _emptyBatch(propIds)
+
+            batch[0].append(timestamp)
+            for column, value in enumerate(projection.readValues(packet)):
+                batch[column + 1].append(value)
+
+            rows += 1
+
+            if len(batch[0]) >= batchSize:
+                writer.write(batch)
+                batch = _emptyBatch(propIds)
+
+        # Nothing in the time range, the file still gets its header
+        if writer is None:
+            writer = _createWriter(outputFormat, path, propIds or [], compression)
+            batch  = _emptyBatch(propIds or [])
+
+        if batch[0]:
+            writer.write(batch)
+
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return path, rows
+
+# Exports a recording file (see StatusRecorder), streaming
+def exportRecording(recordingPath, path, columns = None, start = None, end = None, outputFormat = None,
+                    batchSize = 10000, compression = "zstd"):
+    return exportHistory(readRecordedPackets(recordingPath, start, end), path, columns, start, end,
+                         outputFormat, batchSize, compression)
+
+# Property names or IDs -> IDs, unknown names are an error
+def _resolveColumns(columns):
+
+    propIds = []
+
+    for column in columns:
+        propId = getPropertyId(column)
+        # IDs given as text, e.g. on the command line
+        if not isinstance(propId, int) and str(propId).isdigit():
+            propId = int(propId)
+        if not isinstance(propId, int):
+            raise KeyError("Unknown property: " + str(column) + ". See _buildOxCryoPropertiesInline() for the names.")
+        propIds.append(propId)
+
+    return propIds
+
+# Column name of a property, the ID if it has no name
+def _columnName(propId):
+    return getPropertyName(propId) or str(propId)
+
+# One list per column, timestamp first
+def _emptyBatch(propIds):
+    return [[] for _ in range(len(propIds) + 1)]
+
+def _createWriter(outputFormat, path, propIds, compression):
+    if outputFormat == "csv":
+        return _CSVWriter(path, propIds)
+    return _ArrowWriter(outputFormat, path, propIds, compression)
+
+# Writes batches as CSV rows
+# Timestamps are written in seconds since epoch, missing fields as empty cells
+class _CSVWriter:
+
+    # Constructor
+    def __init__(self, path, propIds):
+
+        # The csv module wants binary files on Python 2.7 and text files without newline translation on Python 3
+        if sys.version_info[0] < 3:
+            self._file = open(path, "wb")
+        else:
+            self._file = open(path, "w", newline = "")
+
+        self._writer = csv.writer(self._file)
+        self._writer.writerow(["timestamp"] + [_columnName(propId) for propId in propIds])
+
+    # Writes one batch (list of columns) and flushes it
+    def write(self, batch):
+        self._writer.writerows(zip(*[["" if value is None else value for value in column] for column in batch]))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+# Writes batches as Arrow record batches to a Parquet or Arrow IPC file
+# Timestamps are written as UTC timestamps (microseconds), fields in output units, missing fields as nulls
+class _ArrowWriter:
+
+    # Constructor
+    def __init__(self, outputFormat, path, propIds, compression):
+
+        fields = [pyarrow.field("timestamp", pyarrow.timestamp("us", tz = "UTC"))]
+        for propId in propIds:
+            arrowType = pyarrow.float64() if getPropertyType(propId) is float else pyarrow.int32()
+            fields.append(pyarrow.field(_columnName(propId), arrowType))
+
+        self._schema = pyarrow.schema(fields)
+
+        if outputFormat == "parquet":
+            self._writer = pyarrow.parquet.ParquetWriter(path, self._schema, compression = compression)
+        else:
+            self._writer = pyarrow.ipc.new_file(path, self._schema)
+
+    # Converts one batch (list of columns) to a record batch and writes it
+    def write(self, batch):
+
+        timestamps = [int(round(timestamp * 1000000)) for timestamp in batch[0]]
+        arrays = [pyarrow.array(timestamps, type = self._schema.field(0).type)]
+
+        for column, values in enumerate(batch[1:]):
+            arrays.append(pyarrow.array(values, type = self._schema.field(column + 1).type))
+
+        self._writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema = self._schema))
+
+    def close(self):
+        self._writer.close()
+
+# Converts a time given on the command line (seconds since epoch, or ISO "2024-05-01T12:00:00" in local time)
+def _parseTime(text):
+
+    if text is None:
+        return None
+
+    try:
+        return float(text)
+    except ValueError:
+        moment = datetime.datetime.strptime(text, "%Y-%m-%dT%H:%M:%S")
+        return time.mktime(moment.timetuple())
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cryostream 800 status recording and export")
+    commands = parser.add_subparsers(dest="command")
+
+    recordParser = commands.add_parser("record", help="Record the status of a device to a file")
+    recordParser.add_argument("--ip", required=True, help="IP of the Cryostream 800")
+    recordParser.add_argument("recording", help="Recording file (appended to if it exists)")
+    recordParser.add_argument("--duration", type=float, default=None, help="Seconds to record (default: until Ctrl+C)")
+
+    exportParser = commands.add_parser("export", help="Export a recording to Parquet, Arrow or CSV")
+    exportParser.add_argument("recording", help="Recording file")
+    exportParser.add_argument("output", help="Output file (.parquet, .arrow, .feather or .csv)")
+    exportParser.add_argument("--columns", nargs="+", default=None, help="Property names to export (default: all)")
+    exportParser.add_argument("--start", default=None, help="Start time (epoch seconds or YYYY-MM-DDTHH:MM:SS)")
+    exportParser.add_argument("--end", default=None, help="End time (epoch seconds or YYYY-MM-DDTHH:MM:SS)")
+    exportParser.add_argument("--format", default=None, choices=["parquet", "arrow", "csv"], help="Output format (default: from the extension)")
+
+    args = parser.parse_args()
+
+    if args.command == "record":
+        from cryostream800 import Cryostream800
+        records = recordDevice(Cryostream800(args.ip), args.recording, args.duration)
+        print(str(records) + " status packets recorded to " + args.recording + ".")
+    elif args.command == "export":
+        written, rows = exportRecording(args.recording, args.output, args.columns, _parseTime(args.start), _parseTime(args.end), args.format)
+        print(str(rows) + " rows exported to " + written + ".")
+    else:
+        parser.print_help()
@@ -0,0 +1,245 @@
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from cryostream_catalog import getPropertyId
+from cryostream_snapshot import PacketLayout
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Fan-out of raw Cryostream 800 status packets to local consumers
+# A single listener receives the UDP broadcasts on port 30304 and forwards the raw datagram bytes,
+# tagged with the device IP and the receive time, to every subscriber over a Unix domain socket.
+# Subscribers decode only the fields they need, by offset, without building the full status dictionary.
+#
+# Wire format of one message (big endian):
+# [0:4]   Magic "CSFO"
+# [4:8]   Device IP (4 bytes, IPv4)
+# [8:16]  Receive timestamp (double, seconds since epoch)
+# [16:18] Payload length (uint16)
+# [18:]   Raw status packet, exactly as broadcast by the device
+#
+# Usage:
+# publisher = FanoutPublisher("/tmp/cryostream.sock")
+# publisher.runListener()                        # In the process that owns port 30304
+# subscriber = FanoutSubscriber("/tmp/cryostream.sock")
+# ip, timestamp, view = subscriber.receive()     # In every consumer process
+# view.get("Sample temp")
+
+_fanoutMagic  = b"CSFO"
+_fanoutHeader = struct.Struct(">4s4sdH")
+
+# Maximum size of a status packet (same as the buffer in _getBinaryStatusPacket)
+_maxPacketSize = 8192
+
+# Read-only view over a raw status packet
+# Fields are decoded on access by precomputed offset, nothing else is decoded
+class StatusPacketView:
+
+    # Constructor
+    # packet: bytes, bytearray or memoryview with the raw status packet
+    # layout: PacketLayout shared by every packet of the same device
+    def __init__(self, packet, layout):
+        self._packet = memoryview(packet)
+        self._layout = layout
+        self._layout.learn(self._packet)
+
+    # Returns the value of a property, by id (1051) or name ("Sample temp")
+    # Returns default if the property is not in the packet
+    def get(self, prop, default = None):
+        value = self._layout.readRaw(self._packet, getPropertyId(prop))
+        if value is None:
+            return default
+        return value
+
+    def __getitem__(self, prop):
+        value = self.get(prop)
+        if value is None:
+            raise KeyError(prop)
+        return value
+
+    def __contains__(self, prop):
+        return self._layout.getOffset(getPropertyId(prop)) is not None
+
+    # Returns the raw packet (memoryview)
+    def getRaw(self):
+        return self._packet
+
+# Forwards raw status packets to subscribers connected to a Unix domain socket
+class FanoutPublisher:
+
+    # Constructor
+    # path: path of the Unix domain socket subscribers connect to
+    def __init__(self, path):
+
+        self._path = path
+
+        # Removes a socket file left by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(16)
+
+        self._subscribers     = []
+        self._subscribersLock = threading.Lock()
+
+        # Counters, useful to monitor the fan-out
+        self._published = 0
+        self._dropped   = 0
+
+        self._running  = True
+        self._acceptor = threading.Thread(target=self._acceptLoop, name="FanoutAcceptor")
+        self._acceptor.daemon = True
+        self._acceptor.start()
+
+    # Sends one raw status packet to every subscriber
+    # A subscriber that cannot keep up (socket buffer full) is disconnected instead of slowing the others
+    def publish(self, ip, packet, timestamp = None):
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        # memoryview.tobytes() works on Python 2.7 and 3, bytes(memoryview) does not on Python 2.7
+        if isinstance(packet, memoryview):
+            packet = packet.tobytes()
+
+        message = _fanoutHeader.pack(_fanoutMagic, socket.inet_aton(ip), timestamp, len(packet)) + bytes(packet)
+
+        with self._subscribersLock:
+            subscribers = list(self._subscribers)
+
+        for subscriber in subscribers:
+            try:
+                sent = subscriber.send(message)
+                if sent != len(message):
+                    raise socket.error(errno.EAGAIN, "Partial send")
+            except socket.error:
+                self._drop(subscriber)
+
+        self._published += 1
+
+    # Receives the status broadcasts on port 30304 and publishes them until close() is called
+    # ips: optional list of device IPs to forward, None forwards every device
+    def runListener(self, ips = None, port = 30304):
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        s.bind(("0.0.0.0", port))
+        s.settimeout(1.0)
+
+        buf  = bytearray(_maxPacketSize)
+        view = memoryview(buf)
+
+        try:
+            while self._running:
+                try:
+                    size, address = s.recvfrom_into(buf)
+                except socket.timeout:
+                    continue
+                if ips is None or address[0] in ips:
+                    self.publish(address[0], view[:size])
+        finally:
+            s.close()
+
+    # Returns the number of connected subscribers
+    def getSubscriberCount(self):
+        with self._subscribersLock:
+            return len(self._subscribers)
+
+    # Returns (published packets, dropped subscribers)
+    def getCounters(self):
+        return self._published, self._dropped
+
+    # Disconnects every subscriber and removes the socket file
+    def close(self):
+        self._running = False
+        self._server.close()
+        with self._subscribersLock:
+            for subscriber in self._subscribers:
+                subscriber.close()
+            self._subscribers = []
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def _acceptLoop(self):
+        while self._running:
+            try:
+                subscriber, address = self._server.accept()
+            except socket.error:
+                break
+            subscriber.setblocking(0)
+            with self._subscribersLock:
+                self._subscribers.append(subscriber)
+
+    def _drop(self, subscriber):
+        with self._subscribersLock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+                self._dropped += 1
+        subscriber.close()
+
+# Receives raw status packets from a FanoutPublisher
+# Packets are received into a buffer allocated once and returned as views, without copies
+class FanoutSubscriber:
+
+    # Constructor
+    # path: path of the publisher's Unix domain socket
+    def __init__(self, path):
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+
+        self._buffer = bytearray(_fanoutHeader.size + _maxPacketSize)
+        self._view   = memoryview(self._buffer)
+
+        # One layout per device, offsets are shared by every packet of the same device
+        self._layouts = dict()
+
+    # Blocks until the next packet arrives (or timeout, in seconds, expires)
+    # Returns (ip, timestamp, StatusPacketView), or None on timeout
+    # The view is only valid until the next call to receive()
+    def receive(self, timeout = None):
+
+        if timeout is not None:
+            ready = select.select([self._socket], [], [], timeout)[0]
+            if not ready:
+                return None
+
+        self._receiveExactly(0, _fanoutHeader.size)
+
+        magic, rawIP, timestamp, length = _fanoutHeader.unpack_from(self._buffer, 0)
+
+        if magic != _fanoutMagic:
+            raise IOError("Invalid fan-out message, the stream is out of sync.")
+
+        self._receiveExactly(_fanoutHeader.size, length)
+
+        ip = socket.inet_ntoa(bytes(rawIP))
+
+        if ip not in self._layouts:
+            self._layouts[ip] = PacketLayout()
+
+        packet = self._view[_fanoutHeader.size:_fanoutHeader.size + length]
+
+        return ip, timestamp, StatusPacketView(packet, self._layouts[ip])
+
+    # Closes the connection to the publisher
+    def close(self):
+        self._socket.close()
+
+    # Fills the buffer from start with exactly size bytes
+    def _receiveExactly(self, start, size):
+        received = 0
+        while received < size:
+            count = self._socket.recv_into(self._view[start + received:start + size], size - received)
+            if count == 0:
+                raise IOError("Fan-out publisher closed the connection.")
+            received += count
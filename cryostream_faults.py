@@ -0,0 +1,407 @@
+from __future__ import print_function
+
+import argparse
+import heapq
+import itertools
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+from cryostream800 import Cryostream800
+from cryostream_fleet import makeStatusPacket
+from cryostream_listener import SharedStatusListener
+from cryostream_supervisor import SupervisedThread
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Network fault injection, to test the commands with confirmation against a bad network
+# Commands get lost, status packets arrive late, twice, out of order or cut: the retry logic exists for that.
+# This module makes it reproducible, on loopback, without a device:
+# - FaultProfile: probabilities of loss, duplication, reordering and truncation, plus latency and jitter
+# - FaultInjectingTransport: transport of a Cryostream800 (transport = ...) that applies one profile to
+#   the status packets and another one to the commands. Given a seed, the same packets meet the same faults.
+# - LoopbackCryostream: minimal simulated device on 127.0.0.1 (run mode, target temperature, turbo, autofill)
+# - measureConfirmation(): time to confirmation of coolWithConfirmation, restartWithConfirmation and
+#   softwareAnnealing as the loss grows
+#
+# Usage:
+# device    = LoopbackCryostream(statusPort = 40304, commandPort = 40305)
+# transport = FaultInjectingTransport(FaultProfile(loss = 0.2), FaultProfile(loss = 0.2, delay = 0.05),
+#                                     seed = 1, statusPort = 40304, commandPort = 40305)
+# device.start(); transport.start()
+# cryostream = Cryostream800("127.0.0.1", transport = transport)
+#
+# Command line:
+# python cryostream_faults.py --loss 0 0.1 0.3 0.5 --trials 5 --seed 1
+
+#===============
+#=== Profile ===
+#===============
+
+# Faults applied to the packets of one direction
+class FaultProfile:
+
+    # Constructor
+    # loss, duplicate, reorder, truncate: probability for each packet (0 to 1)
+    # delay: latency added to every packet (s), jitter: random extra latency, up to jitter (s)
+    # reorderDelay: extra latency of a reordered packet (s), later packets overtake it
+    def __init__(self, loss = 0.0, delay = 0.0, jitter = 0.0, duplicate = 0.0, reorder = 0.0, truncate = 0.0,
+                 reorderDelay = 1.5):
+
+        for name, probability in (("loss", loss), ("duplicate", duplicate), ("reorder", reorder), ("truncate", truncate)):
+            if not 0.0 <= probability <= 1.0:
+                raise ValueError("Probability of " + name + " must be between 0 and 1.")
+
+        self.loss         = loss
+        self.delay        = delay
+        self.jitter       = jitter
+        self.duplicate    = duplicate
+        self.reorder      = reorder
+        self.truncate     = truncate
+        self.reorderDelay = reorderDelay
+
+    # Returns the profile as a dictionary
+    def toDict(self):
+        return {"loss": self.loss, "delay": self.delay, "jitter": self.jitter, "duplicate": self.duplicate,
+                "reorder": self.reorder, "truncate": self.truncate, "reorderDelay": self.reorderDelay}
+
+# Applies a profile to the packets of one direction
+# Decisions come from a random generator of their own, so they only depend on the seed and the packet order
+class _FaultyChannel:
+
+    # Constructor
+    # deliver: function(packet, destination) called when a packet is due
+    def __init__(self, profile, seed, deliver):
+
+        self._profile = profile
+        self._random  = random.Random(seed)
+        self._deliver = deliver
+
+        # (due time, order, packet, destination)
+        self._pending  = []
+        self._order    = itertools.count()
+        self._lock     = threading.Lock()
+
+        self._counters = {"packets": 0, "lost": 0, "duplicated": 0, "reordered": 0, "truncated": 0, "delivered": 0}
+
+    # Takes a packet, it is delivered later by poll(), or never
+    def push(self, packet, destination):
+
+        profile = self._profile
+        draw    = self._random
+
+        with self._lock:
+
+            self._counters["packets"] += 1
+
+            # Every draw is taken for every packet, so one fault does not shift the decisions of the others
+            lost, duplicated, reordered, truncated = [draw.random() for index in range(4)]
+            latencies = [profile.delay + draw.random() * profile.jitter for index in range(2)]
+            cut = draw.randint(0, max(0, len(packet) - 1))
+
+            if lost < profile.loss:
+                self._counters["lost"] += 1
+                return
+
+            if truncated < profile.truncate:
+                self._counters["truncated"] += 1
+                packet = packet[:cut]
+
+            if reordered < profile.reorder:
+                self._counters["reordered"] += 1
+                latencies[0] += profile.reorderDelay
+
+            copies = 2 if duplicated < profile.duplicate else 1
+            if copies == 2:
+                self._counters["duplicated"] += 1
+
+            now = time.time()
+            for index in range(copies):
+                heapq.heappush(self._pending, (now + latencies[index], next(self._order), packet, destination))
+
+    # Delivers the packets that are due, returns the time of the next one (None if nothing is pending)
+    def poll(self):
+
+        while True:
+
+            with self._lock:
+                if not self._pending:
+                    return None
+                if self._pending[0][0] > time.time():
+                    return self._pending[0][0]
+                due, order, packet, destination = heapq.heappop(self._pending)
+                self._counters["delivered"] += 1
+
+            self._deliver(packet, destination)
+
+    def getCounters(self):
+        with self._lock:
+            return dict(self._counters)
+
+#=================
+#=== Transport ===
+#=================
+
+# Transport of a Cryostream800 with faults on the status packets and on the commands
+# Receives the status broadcasts like SharedStatusListener, so several Cryostream800 objects can share it
+class FaultInjectingTransport(SharedStatusListener):
+
+    # Constructor
+    # statusFaults, commandFaults: FaultProfile of each direction, None for no fault
+    # seed: seed of the fault decisions, None for a different run every time
+    # statusPort: port the status is received on
+    # commandPort: port the commands are sent to, None keeps the port given by the Cryostream800 (30305)
+    # commandIP: IP the commands are sent to, None keeps the IP of the Cryostream800
+    def __init__(self, statusFaults = None, commandFaults = None, seed = None, statusPort = 30304,
+                 commandPort = None, commandIP = None):
+
+        SharedStatusListener.__init__(self, statusPort)
+
+        seeds = random.Random(seed)
+
+        self._statusChannel  = _FaultyChannel(statusFaults or FaultProfile(), seeds.random(), lambda packet, ip: self._deliver(ip, packet))
+        self._commandChannel = _FaultyChannel(commandFaults or FaultProfile(), seeds.random(), self._sendNow)
+
+        self._commandPort   = commandPort
+        self._commandIP     = commandIP
+        self._commandSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        # Packets wait in the channels, the receive timeout is shortened to deliver them on time
+        self._supervisor = SupervisedThread("CryostreamFaultInjection", self._receiveOnce)
+
+    # Stops the transport, pending packets are dropped
+    def stop(self):
+        SharedStatusListener.stop(self)
+        self._commandSocket.close()
+
+    # Sends a command through the command channel, called by Cryostream800._submitBinaryCommand
+    def sendCommand(self, packet, address):
+        ip, port = address
+        self._commandChannel.push(packet, (self._commandIP or ip, self._commandPort or port))
+
+    # Returns the faults applied so far, {"status": {...}, "command": {...}}
+    def getCounters(self):
+        return {"status": self._statusChannel.getCounters(), "command": self._commandChannel.getCounters()}
+
+    def _sendNow(self, packet, address):
+        self._commandSocket.sendto(packet, address)
+
+    # Receives one packet, delivers the packets that are due
+    def _receiveOnce(self):
+
+        dues = [due for due in (self._statusChannel.poll(), self._commandChannel.poll()) if due is not None]
+        wait = min(dues) - time.time() if dues else 0.1
+
+        self._socket.settimeout(min(0.1, max(0.001, wait)))
+
+        try:
+            packet, address = self._socket.recvfrom(8192)
+        except socket.timeout:
+            return
+
+        self._statusChannel.push(packet, address[0])
+
+#=================
+#=== Simulator ===
+#=================
+
+# Minimal Cryostream 800 on loopback: broadcasts its status and follows the commands it understands
+# Restart (10) -> Ready, Cool (14) / Ramp (11) -> Running, Plat (12), Stop (19) -> Shut down, Turbo (20), Autofill (202)
+class LoopbackCryostream:
+
+    # Constructor
+    # period: seconds between two status broadcasts (the real device uses 1 s)
+    # restartTime: seconds the device takes to become Ready after Restart
+    def __init__(self, ip = "127.0.0.1", statusPort = 30304, commandPort = 30305, period = 1.0, restartTime = 2.0):
+
+        self._ip          = ip
+        self._statusPort  = statusPort
+        self._commandPort = commandPort
+        self._period      = period
+        self._restartTime = restartTime
+
+        # Raw status, property ID -> value
+        self._status = {1002: 8000, 1003: 40000, 1050: 29000, 1051: 29000, 1053: 2, 1054: 3, 1055: 0,
+                        1056: 29000, 1060: 500, 1068: 0, 1209: 0}
+        self._readyAt  = None
+        self._sequence = 0
+        self._lock     = threading.Lock()
+
+        # Commands received, as (command ID, parameter 1, parameter 2)
+        self._commands = []
+
+        self._sender   = SupervisedThread("LoopbackCryostreamStatus", self._broadcastOnce)
+        self._receiver = SupervisedThread("LoopbackCryostreamCommands", self._receiveOnce)
+
+    # Starts broadcasting and receiving commands
+    def start(self):
+
+        self._statusSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._statusSocket.bind((self._ip, 0))
+
+        self._commandSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._commandSocket.bind((self._ip, self._commandPort))
+        self._commandSocket.settimeout(0.1)
+
+        self._sender.start()
+        self._receiver.start()
+
+    def stop(self):
+        self._sender.stop(timeout = 1.0)
+        self._receiver.stop(timeout = 1.0)
+        self._statusSocket.close()
+        self._commandSocket.close()
+
+    # Returns the commands received, as (command ID, parameter 1, parameter 2)
+    def getCommands(self):
+        with self._lock:
+            return list(self._commands)
+
+    # Sets raw status values, e.g. setStatus({1053: 5}) for a shut down device
+    def setStatus(self, values):
+        with self._lock:
+            self._status.update(values)
+
+    def _broadcastOnce(self):
+
+        with self._lock:
+            if self._readyAt is not None and time.time() >= self._readyAt:
+                self._status[1053] = 2
+                self._readyAt = None
+            self._sequence += 1
+            packet = makeStatusPacket(sorted(self._status.items()), self._sequence)
+
+        self._statusSocket.sendto(packet, (self._ip, self._statusPort))
+        time.sleep(self._period)
+
+    def _receiveOnce(self):
+
+        try:
+            packet = self._commandSocket.recv(64)
+        except socket.timeout:
+            return
+
+        # Truncated or corrupted commands are ignored, like the real device does
+        if len(packet) != 7 or sum(bytearray(packet[:6])) % 256 != bytearray(packet)[6]:
+            return
+
+        command, param1, param2 = struct.unpack(">HHH", packet[:6])
+
+        with self._lock:
+
+            self._commands.append((command, param1, param2))
+            status   = self._status
+            runnable = status[1053] in (2, 3)
+
+            if command == 10 and status[1053] in (5, 6):
+                self._readyAt = time.time() + self._restartTime
+            elif command == 14 and runnable:
+                status.update({1053: 3, 1054: 1, 1050: param1, 1056: param1})
+            elif command == 11 and runnable:
+                status.update({1053: 3, 1054: 0, 1055: param1, 1056: param2})
+            elif command == 12 and status[1053] == 3:
+                status[1054] = 2
+            elif command == 19:
+                status.update({1053: 5, 1054: 3})
+                self._readyAt = None
+            elif command == 20:
+                status[1068] = param1
+            elif command == 202:
+                status[1209] = param1
+
+#===================
+#=== Measurement ===
+#===================
+
+# Operations measured by measureConfirmation(), each returns True when confirmed
+_operations = {
+    "cool":    lambda cryostream: cryostream.coolWithConfirmation(100.0 if cryostream.getTargetTemperature() != 10000 else 120.0),
+    "restart": lambda cryostream: cryostream.stopWithConfirmation() and cryostream.restartWithConfirmation(),
+    "anneal":  lambda cryostream: cryostream.softwareAnnealing(100.0),
+}
+
+# Measures the time to confirmation of the commands as the loss grows
+# lossRates: loss probabilities applied to both directions
+# operations: names in "cool", "restart" (stop then restart) and "anneal"
+# period, restartTime: of the simulated device, shorter than the real device to keep the run short
+# profile: optional function(loss) returning (statusFaults, commandFaults), for delay, reordering, ...
+# Returns a list of {"loss", "operation", "trials", "confirmed", "times"} with the seconds of each confirmed trial
+def measureConfirmation(lossRates = (0.0, 0.1, 0.3, 0.5), operations = ("cool", "restart", "anneal"), trials = 5,
+                        seed = 0, period = 0.2, restartTime = 0.5, statusPort = 40304, commandPort = 40305, profile = None):
+
+    results = []
+
+    for loss in lossRates:
+
+        if profile is not None:
+            statusFaults, commandFaults = profile(loss)
+        else:
+            statusFaults, commandFaults = FaultProfile(loss = loss), FaultProfile(loss = loss)
+
+        device    = LoopbackCryostream("127.0.0.1", statusPort, commandPort, period, restartTime)
+        transport = FaultInjectingTransport(statusFaults, commandFaults, seed, statusPort, commandPort)
+
+        device.start()
+        transport.start()
+
+        try:
+            cryostream = Cryostream800("127.0.0.1", statusTimeout = max(5.0, 20 * period), transport = transport)
+
+            for operation in operations:
+
+                times = []
+
+                for trial in range(trials):
+                    startTime = time.time()
+                    if _operations[operation](cryostream):
+                        times.append(time.time() - startTime)
+
+                results.append({"loss": loss, "operation": operation, "trials": trials,
+                                "confirmed": len(times), "times": times})
+        finally:
+            transport.stop()
+            device.stop()
+
+    return results
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time to confirmation of the Cryostream commands under packet loss")
+    parser.add_argument("--loss", nargs="+", type=float, default=[0.0, 0.1, 0.3, 0.5], help="Loss probabilities")
+    parser.add_argument("--operations", nargs="+", default=["cool", "restart", "anneal"], choices=sorted(_operations))
+    parser.add_argument("--trials", type=int, default=5, help="Trials per loss and operation")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the fault decisions")
+    parser.add_argument("--delay", type=float, default=0.0, help="Latency added to every packet (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random extra latency (s)")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="Probability of duplication")
+    parser.add_argument("--reorder", type=float, default=0.0, help="Probability of reordering")
+    parser.add_argument("--truncate", type=float, default=0.0, help="Probability of truncation")
+    parser.add_argument("--period", type=float, default=0.2, help="Status period of the simulated device (s)")
+    args = parser.parse_args()
+
+    def profile(loss):
+        faults = FaultProfile(loss, args.delay, args.jitter, args.duplicate, args.reorder, args.truncate)
+        return faults, faults
+
+    # The library prints every attempt, only the table is wanted here
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        results = measureConfirmation(args.loss, args.operations, args.trials, args.seed, args.period, profile = profile)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print("loss   operation  confirmed  median (s)  max (s)")
+    for result in results:
+        times = sorted(result["times"])
+        median = times[len(times) // 2] if times else None
+        print(str(result["loss"]).ljust(7) + result["operation"].ljust(11) +
+              (str(result["confirmed"]) + "/" + str(result["trials"])).ljust(11) +
+              (str(round(median, 2)) if median is not None else "-").ljust(12) +
+              (str(round(times[-1], 2)) if times else "-"))
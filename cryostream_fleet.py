@@ -0,0 +1,512 @@
+from __future__ import print_function
+
+import argparse
+import ctypes
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from cryostream_catalog import getPropertyId, getPropertyIds, getPropertyName, scaleValue
+from cryostream_errors import MalformedPacketError
+from cryostream_integrity import PacketValidator
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Fleet analytics: decodes the status broadcasts of many Cryostreams on one host, using every core
+# One receiver thread reads the UDP broadcasts and copies each raw datagram into a shared memory ring of a worker
+# process, chosen by device IP (every packet of a device goes to the same worker, so its state stays in one place).
+# Only the slot number, length, IP and receive time travel through the queue, never the packet itself.
+# Each worker, for its devices:
+# - Checks the packet integrity (cryostream_integrity.py)
+# - Decodes every field and compares it with the previous packet of the same device
+# - Evaluates the alarm rules
+# - Appends the raw packet to the device history (cryostream_export.py recording format), if enabled
+# and sends the changed fields and raised alarms back to the main process.
+# Workers share nothing, so throughput grows with the number of cores until the receiver thread is saturated.
+# When a ring is full, the packet is dropped and counted, the receiver never waits for a worker.
+#
+# Usage:
+# pool = FleetPool(workers = 4, rules = [AlarmRule("Sample temp", maximum = 120.0)], onResult = handle)
+# pool.start()
+# pool.runListener()                 # Blocks, Ctrl+C to stop
+# pool.close()
+#
+# Command line:
+# python cryostream_fleet.py listen --workers 4 --history /data/cryostreams
+# python cryostream_fleet.py bench --devices 48 --workers 4 --seconds 10
+
+# Maximum size of a status packet (same as the buffer in _getBinaryStatusPacket)
+_slotSize = 8192
+
+# Work queue message that stops a worker
+_stopMessage = None
+
+#===================
+#=== Alarm Rules ===
+#===================
+
+# Alarm when a property leaves [minimum, maximum] (output units), or equals one of the given raw values
+# Rules are sent to the worker processes, so they only hold plain data
+class AlarmRule:
+
+    # Constructor
+    # prop: property name ("Sample temp") or ID
+    # minimum, maximum: limits in output units (K, l/min, ...), None for no limit
+    # values: raw values that raise the alarm, e.g. Run mode 6 (Shut down with error)
+    # name: text of the alarm, built from the limits if not given
+    def __init__(self, prop, minimum = None, maximum = None, values = None, name = None):
+
+        self.propId  = getPropertyId(prop)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.values  = None if values is None else frozenset(values)
+
+        if name is None:
+            name = str(getPropertyName(self.propId) or self.propId)
+            if minimum is not None:
+                name += " < " + str(minimum)
+            if maximum is not None:
+                name += " > " + str(maximum)
+            if values is not None:
+                name += " in " + str(sorted(values))
+
+        self.name = name
+
+    # Returns True if the alarm is raised by this decoded status (id -> raw value)
+    # A property missing from the packet does not raise the alarm
+    def evaluate(self, status):
+
+        raw = status.get(self.propId)
+
+        if raw is None:
+            return False
+
+        if self.values is not None and raw in self.values:
+            return True
+
+        if self.minimum is None and self.maximum is None:
+            return False
+
+        value = scaleValue(self.propId, raw)
+
+        return (self.minimum is not None and value < self.minimum) or (self.maximum is not None and value > self.maximum)
+
+#==============
+#=== Worker ===
+#==============
+
+# Device state kept by the worker that owns the device
+class _DeviceState:
+
+    def __init__(self):
+        self.status    = dict()
+        self.alarms    = frozenset()
+        self.validator = PacketValidator()
+        self.recorder  = None
+
+# Main loop of a worker process
+# Reads the packets of its shard from the shared ring, in order, and frees each slot once done
+def _workerMain(buffer, slots, workQueue, freeSlots, resultQueue, counters, index, rules, historyDir, sendResults):
+
+    address = ctypes.addressof(buffer)
+    devices = dict()
+
+    while True:
+
+        message = workQueue.get()
+
+        if message is _stopMessage:
+            break
+
+        slot, size, ip, timestamp = message
+
+        # Copies the packet out of the ring, so the slot can be reused right away
+        packet = ctypes.string_at(address + slot * _slotSize, size)
+        freeSlots.release()
+
+        device = devices.get(ip)
+        if device is None:
+            device = devices[ip] = _DeviceState()
+            if historyDir is not None:
+                from cryostream_export import StatusRecorder
+                device.recorder = StatusRecorder(os.path.join(historyDir, ip + ".csr"))
+
+        # Corrupted and late packets are rejected
+        try:
+            valid = device.validator.check(packet)
+            words = struct.unpack_from(">" + str(size // 2) + "H", packet)
+        except (MalformedPacketError, struct.error):
+            valid = False
+
+        if not valid:
+            counters[index * 2 + 1] += 1
+            continue
+
+        status   = dict(zip(words[0::2], words[1::2]))
+        previous = device.status
+        changes  = [(propId, raw) for propId, raw in status.items() if previous.get(propId) != raw]
+        alarms   = frozenset(rule.name for rule in rules if rule.evaluate(status))
+
+        raised  = alarms - device.alarms
+        cleared = device.alarms - alarms
+
+        device.status = status
+        device.alarms = alarms
+
+        if device.recorder is not None:
+            device.recorder.record(packet, timestamp)
+
+        counters[index * 2] += 1
+
+        if sendResults and (changes or raised or cleared):
+            resultQueue.put({
+                "ip":        ip,
+                "timestamp": timestamp,
+                "changes":   dict((getPropertyName(propId) or propId, scaleValue(propId, raw)) for propId, raw in changes),
+                "raised":    sorted(raised),
+                "cleared":   sorted(cleared),
+            })
+
+    for device in devices.values():
+        if device.recorder is not None:
+            device.recorder.close()
+
+#============
+#=== Pool ===
+#============
+
+# Pool of worker processes, one shared memory ring per worker
+class FleetPool:
+
+    # Constructor
+    # workers: number of worker processes, one per core if None
+    # rules: list of AlarmRule evaluated on every packet
+    # onResult: function called in this process with every result (changed fields and alarms), None to discard them
+    # historyDir: folder where each device history is appended (<ip>.csr), None for no history
+    # slots: packets that can wait in the ring of each worker
+    def __init__(self, workers = None, rules = None, onResult = None, historyDir = None, slots = 256):
+
+        self._workerCount = workers or multiprocessing.cpu_count()
+        self._rules       = list(rules or [])
+        self._onResult    = onResult
+        self._historyDir  = historyDir
+        self._slots       = slots
+
+        # Per worker: shared ring, next slot to write, free slot count and queue of written slots
+        self._buffers    = [multiprocessing.RawArray("B", slots * _slotSize) for _ in range(self._workerCount)]
+        self._addresses  = [ctypes.addressof(buffer) for buffer in self._buffers]
+        self._heads      = [0] * self._workerCount
+        self._freeSlots  = [multiprocessing.Semaphore(slots) for _ in range(self._workerCount)]
+        self._workQueues = [multiprocessing.Queue() for _ in range(self._workerCount)]
+
+        # Processed and rejected packets per worker, written by the workers
+        self._counters = multiprocessing.RawArray("l", self._workerCount * 2)
+
+        self._resultQueue = multiprocessing.Queue()
+        self._processes   = []
+        self._collector   = None
+
+        self._submitted = 0
+        self._dropped   = 0
+        self._running   = False
+
+    # Starts the worker processes and the result collector
+    def start(self):
+
+        self._running = True
+
+        for index in range(self._workerCount):
+            process = multiprocessing.Process(target=_workerMain, name="CryostreamFleetWorker-" + str(index),
+                                              args=(self._buffers[index], self._slots, self._workQueues[index],
+                                                    self._freeSlots[index], self._resultQueue, self._counters, index,
+                                                    self._rules, self._historyDir, self._onResult is not None))
+            process.daemon = True
+            process.start()
+            self._processes.append(process)
+
+        if self._onResult is not None:
+            self._collector = threading.Thread(target=self._collect, name="CryostreamFleetCollector")
+            self._collector.daemon = True
+            self._collector.start()
+
+    # Hands a raw status packet to the worker of its device
+    # packet: bytes, or a ctypes char array / bytearray pointer for zero copy from the receive buffer
+    # Returns False if the worker is behind and the packet was dropped
+    def submit(self, ip, packet, size = None, timestamp = None):
+
+        if size is None:
+            size = len(packet)
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        if size > _slotSize:
+            self._dropped += 1
+            return False
+
+        shard = self._getShard(ip)
+
+        if not self._freeSlots[shard].acquire(False):
+            self._dropped += 1
+            return False
+
+        slot = self._heads[shard]
+        self._heads[shard] = (slot + 1) % self._slots
+
+        ctypes.memmove(self._addresses[shard] + slot * _slotSize, packet, size)
+        self._workQueues[shard].put((slot, size, ip, timestamp))
+
+        self._submitted += 1
+
+        return True
+
+    # Receives the broadcasts of every device on the network and hands them to the workers
+    # ips: list of device IPs to keep, None for every device
+    # Blocks until stop() or Ctrl+C
+    def runListener(self, ips = None, port = 30304):
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        s.bind(("0.0.0.0", port))
+        s.settimeout(1.0)
+
+        buf     = bytearray(_slotSize)
+        pointer = (ctypes.c_char * _slotSize).from_buffer(buf)
+
+        try:
+            while self._running:
+                try:
+                    size, address = s.recvfrom_into(buf)
+                except socket.timeout:
+                    continue
+                if ips is None or address[0] in ips:
+                    self.submit(address[0], pointer, size)
+        except KeyboardInterrupt:
+            print("Exiting program.")
+        finally:
+            s.close()
+
+    # Stops runListener() after the current packet
+    def stop(self):
+        self._running = False
+
+    # Returns the counters: submitted, dropped (ring full), processed and rejected (per worker and total)
+    def getStats(self):
+        processed = [self._counters[index * 2] for index in range(self._workerCount)]
+        rejected  = [self._counters[index * 2 + 1] for index in range(self._workerCount)]
+        return {
+            "workers":   self._workerCount,
+            "submitted": self._submitted,
+            "dropped":   self._dropped,
+            "processed": sum(processed),
+            "rejected":  sum(rejected),
+            "perWorker": processed,
+        }
+
+    # Waits until the workers have handled every submitted packet, or the timeout (s) expires
+    # Returns True if they caught up
+    def drain(self, timeout = None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            stats = self.getStats()
+            if stats["processed"] + stats["rejected"] >= stats["submitted"]:
+                return True
+            if deadline is not None and time.time() > deadline:
+                return False
+            time.sleep(0.01)
+
+    # Stops the workers, after they handled the packets already submitted
+    def close(self, timeout = 5.0):
+
+        self._running = False
+
+        for workQueue in self._workQueues:
+            workQueue.put(_stopMessage)
+
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+        if self._collector is not None:
+            self._resultQueue.put(_stopMessage)
+            self._collector.join(timeout)
+
+    # Same device, same worker: a stable hash of the IP (hash() of a string changes between processes on Python 3)
+    def _getShard(self, ip):
+        return (zlib.crc32(ip.encode("ascii")) & 0xFFFFFFFF) % self._workerCount
+
+    # Calls onResult with every result sent by the workers
+    def _collect(self):
+        while True:
+            result = self._resultQueue.get()
+            if result is _stopMessage:
+                return
+            try:
+                self._onResult(result)
+            except Exception as e:
+                print("Fleet result handler failed (" + type(e).__name__ + ": " + str(e) + ").")
+
+#======================
+#=== Load Generator ===
+#======================
+
+# Synthetic status packets of many devices, with every property of OxcryoProperties.xml
+# Values follow a random walk, and the packet id and integrity fields are filled like the device does
+class LoadGenerator:
+
+    # Constructor
+    # devices: number of simulated devices, IPs 10.0.x.y
+    # changesPerPacket: fields that change between two packets of the same device
+    # seed: random seed, so runs can be repeated
+    def __init__(self, devices = 48, changesPerPacket = 20, seed = 800):
+
+        self._random  = random.Random(seed)
+        self._ids     = [propId for propId in getPropertyIds() if propId not in (5000, 5001, 5002)]
+        self._changes = changesPerPacket
+        self._ips     = ["10.0." + str(1 + n // 250) + "." + str(1 + n % 250) for n in range(devices)]
+        self._values  = dict((ip, [self._random.randint(0, 30000) for _ in self._ids]) for ip in self._ips)
+        self._sequence = dict((ip, 0) for ip in self._ips)
+
+    # Returns the simulated device IPs
+    def getIPs(self):
+        return list(self._ips)
+
+    # Returns the next packet of a device
+    def nextPacket(self, ip):
+        body, bodySum = self._nextBody(ip)
+        return self._finishPacket(ip, body, bodySum)
+
+    # Returns the fields of the next packet of a device, without the integrity fields, and the sum of their bytes
+    def _nextBody(self, ip):
+
+        values = self._values[ip]
+        for _ in range(self._changes):
+            index = self._random.randrange(len(values))
+            values[index] = (values[index] + self._random.randint(-50, 50)) & 0xFFFF
+
+        body = b"".join(struct.pack(">HH", propId, value) for propId, value in zip(self._ids, values))
+
+        return body, sum(bytearray(body))
+
+    # Adds the size, packet id and checksum fields to the fields of a packet, with the next packet id of the device
+    def _finishPacket(self, ip, body, bodySum):
+        self._sequence[ip] = (self._sequence[ip] + 1) & 0xFFFF
+        return _finishStatusPacket(body, bodySum, self._sequence[ip])
+
+    # Yields (ip, packet), one packet per device in turn, forever
+    def packets(self):
+        while True:
+            for ip in self._ips:
+                yield ip, self.nextPacket(ip)
+
+    # Submits packets to a pool for the given seconds, returns the packets per second handled by the workers
+    # variants: packets built per device before the clock starts, sent in turn
+    # Building a packet field by field takes longer than decoding it, so only the packet id
+    # and the checksum are set during the run, and the rate measured is the rate of the workers
+    def run(self, pool, seconds = 10.0, variants = 16):
+
+        bodies = [(ip,) + self._nextBody(ip) for _ in range(variants) for ip in self._ips]
+
+        start = time.time()
+        stop  = start + seconds
+
+        index = 0
+        while time.time() < stop:
+            ip, body, bodySum = bodies[index]
+            pool.submit(ip, self._finishPacket(ip, body, bodySum))
+            index = (index + 1) % len(bodies)
+
+        pool.drain(timeout = 30.0)
+        elapsed = time.time() - start
+
+        return pool.getStats()["processed"] / elapsed
+
+    # Sends packets over UDP from 127.0.0.x source addresses, one per device (Linux loopback accepts any 127.x.y.z)
+    # Useful to load test runListener(). rate: packets per second, all devices together
+    def replay(self, seconds = 10.0, rate = 1000.0, host = "127.0.0.1", port = 30304):
+
+        sockets = dict()
+        for n, ip in enumerate(self._ips):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind(("127.0." + str(1 + n // 250) + "." + str(2 + n % 250), 0))
+            sockets[ip] = s
+
+        packets = self.packets()
+        sent    = 0
+        start   = time.time()
+
+        try:
+            while time.time() < start + seconds:
+                ip, packet = next(packets)
+                sockets[ip].sendto(packet, (host, port))
+                sent += 1
+                wait = start + sent / rate - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+        finally:
+            for s in sockets.values():
+                s.close()
+
+        return sent
+
+# Builds a status packet from (id, raw value) pairs, with size, id and checksum fields (IDs #5000, #5001, #5002)
+def makeStatusPacket(fields, sequence):
+    body = b"".join(struct.pack(">HH", propId, value & 0xFFFF) for propId, value in fields)
+    return _finishStatusPacket(body, sum(bytearray(body)), sequence)
+
+# Adds the size, id and checksum fields to the fields of a status packet
+# bodySum: sum of the bytes of body, so a body sent many times is summed once
+def _finishStatusPacket(body, bodySum, sequence):
+
+    size    = len(body) + 12
+    trailer = struct.pack(">HHHHH", 5000, size, 5001, sequence & 0xFFFF, 5002)
+    total   = (bodySum + sum(bytearray(trailer))) & 0xFFFF
+
+    return body + trailer + struct.pack(">H", total)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cryostream fleet analytics")
+    commands = parser.add_subparsers(dest="command")
+
+    listenParser = commands.add_parser("listen", help="Decode the broadcasts of every Cryostream on the network")
+    listenParser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    listenParser.add_argument("--history", default=None, help="Folder to append each device history to")
+    listenParser.add_argument("--port", type=int, default=30304, help="Status broadcast port")
+
+    benchParser = commands.add_parser("bench", help="Measure throughput with synthetic packets")
+    benchParser.add_argument("--devices", type=int, default=48, help="Simulated devices")
+    benchParser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    benchParser.add_argument("--seconds", type=float, default=10.0, help="Duration of the run")
+
+    args = parser.parse_args()
+
+    if args.command == "listen":
+        # Alarms are printed, changed fields are not
+        def printAlarms(result):
+            for alarm in result["raised"]:
+                print(result["ip"] + ": " + alarm)
+            for alarm in result["cleared"]:
+                print(result["ip"] + ": cleared " + alarm)
+        rules = [AlarmRule("Run mode", values = [6], name = "Shut down"), AlarmRule("Alarm code", minimum = 0, maximum = 0, name = "Alarm")]
+        pool = FleetPool(args.workers, rules, printAlarms, args.history)
+        pool.start()
+        pool.runListener(port = args.port)
+        pool.close()
+    elif args.command == "bench":
+        pool = FleetPool(args.workers)
+        pool.start()
+        rate = LoadGenerator(args.devices).run(pool, args.seconds)
+        stats = pool.getStats()
+        pool.close()
+        print(str(stats["workers"]) + " workers: " + str(int(rate)) + " packets/s, " + str(stats["dropped"]) + " dropped, per worker " + str(stats["perWorker"]))
+    else:
+        parser.print_help()
@@ -0,0 +1,245 @@
+import struct
+import threading
+
+from cryostream_errors import MalformedPacketError
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Integrity checks of the Cryostream 800 status packets
+# Every status packet carries three fields about itself (OxcryoProperties.xml):
+# - "Comms packet size"     (ID #5000): length of the packet
+# - "Comms packet id"       (ID #5001): sequence number, incremented on every broadcast
+# - "Comms packet checksum" (ID #5002): 16 bit sum of the bytes of the packet, except the checksum value itself
+# Truncated packets and packets with a wrong checksum are rejected (MalformedPacketError).
+# Gaps and repeated packet ids are counted, so the loss rate of the network can be monitored.
+#
+# The offsets of the three fields are found once and reused, and the checksum is a single sum() over the bytes,
+# so a check costs a few microseconds per packet.
+#
+# The meaning of the size and the checksum is not in the documentation, so each check is only enforced
+# once _confirmRun packets in a row have matched it: a 16 bit sum matches by chance about once in 65536 packets,
+# 16 chance matches in a row do not happen. Until then, mismatches are counted as "unverified" and the packet is
+# accepted. A confirmed check that fails _dropRun packets in a row is dropped again (the guess did not hold,
+# or the firmware changed), fewer than the malformed packets Cryostream800 skips before it gives up.
+#
+# Usage:
+# validator = PacketValidator()
+# validator.check(packet)        # Raises MalformedPacketError if the packet is corrupted, False if it arrived late
+# validator.getStats()
+
+_sizeId     = 5000
+_sequenceId = 5001
+_checksumId = 5002
+
+# Jumps of the packet id larger than this are a restart of the device, not lost packets
+_maxGap = 1024
+
+# Packets up to this many ids behind the last one are late (reordered), further back is a restart of the device
+_reorderWindow = 64
+
+# Late packets in a row, each id following the previous one, that are a restart of the device to a lower id
+# Reordered packets arrive between newer ones, a restart keeps counting up from its new id
+_resetRun = 3
+
+# Packets in a row that must match a check before it is enforced
+_confirmRun = 16
+
+# Packets in a row that fail an enforced check before it is dropped, they are rejected until then
+# Below Cryostream800._maxSkippedPackets (10), so a wrong guess never stops the status reads
+_dropRun = 8
+
+# Validates status packets of one device
+class PacketValidator:
+
+    # Constructor
+    def __init__(self):
+
+        # Byte offsets of the size, id and checksum groups, found on the first packet
+        self._offsets = None
+        self._length  = -1
+
+        # A check is enforced once _confirmRun packets in a row have passed it
+        # Packets in a row that passed and failed each check, to confirm it or to drop it
+        self._confirmed  = {"size": False, "checksum": False}
+        self._matches    = {"size": 0, "checksum": 0}
+        self._mismatches = {"size": 0, "checksum": 0}
+
+        # Id of the last accepted packet
+        self._lastSequence = None
+
+        # Id of the last late packet, and the number of late packets in a row that followed each other
+        self._lateSequence = None
+        self._lateRun      = 0
+
+        self._lock  = threading.Lock()
+        self._stats = {
+            "packets":    0,  # Packets checked
+            "truncated":  0,  # Rejected, shorter than announced
+            "checksum":   0,  # Rejected, wrong checksum
+            "lost":       0,  # Packet ids never received
+            "duplicates": 0,  # Packet id received twice
+            "reordered":  0,  # Packet id older than the last one
+            "resyncs":    0,  # Jumps of the packet id (device restarted)
+            "unchecked":  0,  # Packets without integrity fields
+            "unverified": 0,  # Size or checksum mismatches before the check was confirmed
+            "dropped":    0,  # Confirmed checks dropped after failing _dropRun packets in a row
+        }
+
+    # Checks a raw status packet
+    # Raises MalformedPacketError if the packet is truncated or its checksum is wrong
+    # Returns False if the packet is older than the last one (arrived late), True otherwise
+    # Gaps and duplicates are only counted, the packet is still valid
+    def check(self, packet):
+
+        with self._lock:
+
+            self._stats["packets"] += 1
+
+            offsets = self._findOffsets(packet)
+
+            if offsets is None:
+                # Once the device sent the integrity fields, a packet without them is missing its end
+                if self._confirmed["size"]:
+                    self._stats["truncated"] += 1
+                    raise MalformedPacketError("The status packet has no integrity fields, it is truncated (" + str(len(packet)) + " bytes).")
+                self._stats["unchecked"] += 1
+                return True
+
+            sizeOffset, sequenceOffset, checksumOffset = offsets
+
+            self._checkSize(packet, struct.unpack_from(">H", packet, sizeOffset + 2)[0])
+            self._checkSum(packet, checksumOffset)
+
+            return self._countSequence(struct.unpack_from(">H", packet, sequenceOffset + 2)[0])
+
+    # Returns the counters and the loss rate (lost / expected packets)
+    def getStats(self):
+
+        with self._lock:
+
+            stats = dict(self._stats)
+            expected = stats["packets"] - stats["truncated"] - stats["checksum"] + stats["lost"]
+
+            stats["lossRate"]          = stats["lost"] / float(expected) if expected > 0 else 0.0
+            stats["sizeConfirmed"]     = self._confirmed["size"]
+            stats["checksumConfirmed"] = self._confirmed["checksum"]
+
+            return stats
+
+    # Returns the offsets of the three integrity groups, None if the packet does not have them
+    # The offsets are kept while the packet length and the ids at the offsets do not change
+    def _findOffsets(self, packet):
+
+        if self._offsets is not None and len(packet) == self._length:
+            sizeOffset, sequenceOffset, checksumOffset = self._offsets
+            if (struct.unpack_from(">H", packet, sizeOffset)[0] == _sizeId and
+                struct.unpack_from(">H", packet, sequenceOffset)[0] == _sequenceId and
+                struct.unpack_from(">H", packet, checksumOffset)[0] == _checksumId):
+                return self._offsets
+
+        # Layout changed, or first packet: look for the groups
+        found = dict()
+        words = struct.unpack_from(">" + str(len(packet) // 2) + "H", packet)
+        for index in range(0, len(words) - 1, 2):
+            if words[index] in (_sizeId, _sequenceId, _checksumId):
+                found[words[index]] = index * 2
+
+        if len(found) < 3:
+            return None
+
+        self._offsets = (found[_sizeId], found[_sequenceId], found[_checksumId])
+        self._length  = len(packet)
+
+        return self._offsets
+
+    # The size may be in bytes or in groups of 4 bytes
+    def _checkSize(self, packet, size):
+
+        if self._isRejected("size", size == len(packet) or size * 4 == len(packet)):
+            self._stats["truncated"] += 1
+            raise MalformedPacketError("The status packet has " + str(len(packet)) + " bytes, the device announced " + str(size) + ".")
+
+    # 16 bit sum of every byte except the two bytes of the checksum value
+    def _checkSum(self, packet, checksumOffset):
+
+        data = bytearray(packet)
+        expected = (data[checksumOffset + 2] << 8) | data[checksumOffset + 3]
+        computed = (sum(data) - data[checksumOffset + 2] - data[checksumOffset + 3]) & 0xFFFF
+
+        if self._isRejected("checksum", computed == expected):
+            self._stats["checksum"] += 1
+            raise MalformedPacketError("The status packet checksum is wrong (" + str(computed) + ", expected " + str(expected) + ").")
+
+    # Counts a packet that passed or failed a check ("size" or "checksum")
+    # Returns True if the packet failed an enforced check and must be rejected
+    def _isRejected(self, name, matched):
+
+        if matched:
+            self._mismatches[name] = 0
+            self._matches[name]   += 1
+            if self._matches[name] >= _confirmRun:
+                self._confirmed[name] = True
+            return False
+
+        self._matches[name] = 0
+
+        if self._confirmed[name]:
+            self._mismatches[name] += 1
+            if self._mismatches[name] < _dropRun:
+                return True
+
+            # Every packet fails it for a while: the check is wrong, not the packets
+            self._confirmed[name]  = False
+            self._mismatches[name] = 0
+            self._stats["dropped"] += 1
+
+        self._stats["unverified"] += 1
+        return False
+
+    # Counts lost, repeated and late packets from the 16 bit packet id
+    # Returns False for a late packet
+    def _countSequence(self, sequence):
+
+        last = self._lastSequence
+
+        if last is None:
+            self._lastSequence = sequence
+            return True
+
+        step = (sequence - last) & 0xFFFF
+
+        if step >= 0x10000 - _reorderWindow:
+
+            # Late packets counting up one after the other: the device restarted a little behind the last id
+            if self._lateSequence is not None and sequence == (self._lateSequence + 1) & 0xFFFF:
+                self._lateRun += 1
+            else:
+                self._lateRun = 1
+            self._lateSequence = sequence
+
+            if self._lateRun >= _resetRun:
+                self._stats["resyncs"] += 1
+                self._lastSequence = sequence
+                self._lateSequence = None
+                self._lateRun      = 0
+                return True
+
+            # Late packet, older than the last one, the last id is kept
+            self._stats["reordered"] += 1
+            return False
+
+        self._lateSequence = None
+        self._lateRun      = 0
+
+        if step == 0:
+            self._stats["duplicates"] += 1
+        elif step <= _maxGap:
+            self._stats["lost"] += step - 1
+            self._lastSequence = sequence
+        else:
+            self._stats["resyncs"] += 1
+            self._lastSequence = sequence
+
+        return True
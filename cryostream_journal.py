@@ -0,0 +1,190 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Crash-safe journal of the multi-step sequences of the Cryostream 800
+# shutdownAndGetReady(), softwareAnnealing() and getReadySetTargetTemperatureAndGo() send several commands in a row.
+# If the controlling process dies between Stop and Restart, the device stays shut down until someone notices.
+# The journal is an append-only file of JSON lines:
+# - {"type": "begin", "id", "ip", "time", "sequence", "args", "before"}: a sequence starts, with the state before it
+# - {"type": "command", "id", "time", "code", "params"}: a command of the sequence is sent
+# - {"type": "end", "id", "time", "result"}: the sequence finished ("done", "failed", "recovered", ...)
+# "begin" and the first command of each kind are written to disk (fsync) before the command leaves,
+# the other records are batched and written with the next forced record, or after syncInterval seconds.
+# A sequence with no "end" was interrupted. The Cryostream800 reconciles it with the first status at startup
+# (see Cryostream800.recoverJournal()). Finished sequences are removed from the file when the journal is opened.
+#
+# Usage:
+# journal    = CommandJournal("/var/lib/cryostream/bl821.journal")
+# cryostream = Cryostream800("10.0.0.5", journal = journal)      # Resumes an interrupted sequence, if any
+#
+# One journal file per controlling process.
+
+_defaultJournalPath = os.path.join(os.path.expanduser("~"), ".cryostream_journal.jsonl")
+
+class CommandJournal:
+
+    # Constructor
+    # path: journal file, created if missing
+    # syncInterval: longest time (s) a batched record waits before it is written to disk
+    # maxAge: interrupted sequences older than maxAge seconds are not resumed, only reported
+    def __init__(self, path = None, syncInterval = 1.0, maxAge = 3600.0):
+
+        self._path         = path or _defaultJournalPath
+        self._syncInterval = syncInterval
+        self._maxAge       = maxAge
+        self._lock         = threading.Lock()
+
+        # Sequences without an end, id -> {"id", "ip", "time", "sequence", "args", "before", "commands"}
+        # "commands": codes of the commands sent, in order
+        self._open = dict()
+
+        # Records written since the last fsync
+        self._dirty    = False
+        self._lastSync = time.time()
+
+        self._load()
+        self._compact()
+
+        self._file = open(self._path, "a")
+
+    # Records the start of a sequence, written to disk before returning
+    # before: state of the device before the sequence, used to roll it back
+    # Returns the id of the sequence
+    def begin(self, ip, sequence, args, before):
+
+        record = {"type": "begin", "id": uuid.uuid4().hex, "ip": ip, "time": time.time(),
+                  "sequence": sequence, "args": list(args), "before": before}
+
+        with self._lock:
+            self._apply(record)
+            self._write(record, True)
+
+        return record["id"]
+
+    # Records a command of a sequence
+    # The first command with a given code is written to disk before returning, the retries are batched
+    def command(self, sequenceId, code, p1, p2):
+
+        record = {"type": "command", "id": sequenceId, "time": time.time(), "code": code, "params": [p1, p2]}
+
+        with self._lock:
+            entry = self._open.get(sequenceId)
+            force = entry is not None and code not in entry["commands"]
+            self._apply(record)
+            self._write(record, force)
+
+    # Records the end of a sequence, batched
+    # result: "done", "failed", "aborted", "recovered", "rolledBack", "superseded", "abandoned"
+    def end(self, sequenceId, result):
+
+        record = {"type": "end", "id": sequenceId, "time": time.time(), "result": result}
+
+        with self._lock:
+            self._apply(record)
+            self._write(record, False)
+
+    # Returns the interrupted sequences (no end recorded), oldest first, optionally of one device only
+    def getInterrupted(self, ip = None):
+
+        with self._lock:
+            entries = [dict(entry, commands = list(entry["commands"])) for entry in self._open.values()
+                       if ip is None or entry["ip"] == ip]
+
+        return sorted(entries, key = lambda entry: entry["time"])
+
+    # Returns the age (s) beyond which interrupted sequences are not resumed
+    def getMaxAge(self):
+        return self._maxAge
+
+    # Returns the path of the journal file
+    def getPath(self):
+        return self._path
+
+    # Writes the batched records to disk
+    def sync(self):
+        with self._lock:
+            self._sync()
+
+    # Writes the batched records and closes the file
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    # Reads the journal, a line cut by a crash while writing is ignored
+    def _load(self):
+
+        try:
+            journalFile = open(self._path)
+        except (IOError, OSError):
+            return
+
+        with journalFile:
+            for line in journalFile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._apply(record)
+
+    # Rewrites the journal with the interrupted sequences only, in one step (same as DeviceRegistry.save())
+    def _compact(self):
+
+        temporaryPath = self._path + ".tmp"
+
+        with open(temporaryPath, "w") as journalFile:
+            for entry in sorted(self._open.values(), key = lambda entry: entry["time"]):
+                begin = dict((key, entry[key]) for key in ("id", "ip", "time", "sequence", "args", "before"))
+                begin["type"] = "begin"
+                journalFile.write(json.dumps(begin) + "\n")
+                for code in entry["commands"]:
+                    journalFile.write(json.dumps({"type": "command", "id": entry["id"], "time": entry["time"],
+                                                  "code": code, "params": []}) + "\n")
+            journalFile.flush()
+            os.fsync(journalFile.fileno())
+
+        # os.rename does not replace an existing file on Windows
+        if os.name == "nt" and os.path.exists(self._path):
+            os.remove(self._path)
+
+        os.rename(temporaryPath, self._path)
+
+    # Updates the open sequences with one record
+    def _apply(self, record):
+
+        recordType = record.get("type")
+
+        if recordType == "begin":
+            entry = dict((key, record.get(key)) for key in ("id", "ip", "time", "sequence", "args", "before"))
+            entry["commands"] = []
+            self._open[record["id"]] = entry
+        elif recordType == "command" and record.get("id") in self._open:
+            self._open[record["id"]]["commands"].append(record["code"])
+        elif recordType == "end":
+            self._open.pop(record.get("id"), None)
+
+    def _write(self, record, force):
+
+        self._file.write(json.dumps(record) + "\n")
+        self._dirty = True
+
+        if force or time.time() - self._lastSync >= self._syncInterval:
+            self._sync()
+
+    def _sync(self):
+
+        if not self._dirty:
+            return
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+        self._dirty    = False
+        self._lastSync = time.time()
@@ -0,0 +1,118 @@
+import socket
+import threading
+import time
+
+from cryostream_clock import enableKernelTimestamps, receiveStamped
+from cryostream_errors import StatusTimeout
+from cryostream_supervisor import SupervisedThread
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Status listener shared by several Cryostream800 objects in the same process
+# Only one socket can receive on port 30304, so when several devices are controlled at once,
+# one background thread receives every broadcast and hands each packet to the object of its device.
+#
+# Usage:
+# listener = SharedStatusListener()
+# listener.start()
+# bl821 = Cryostream800("10.0.0.5", statusListener = listener)
+# bl822 = Cryostream800("10.0.0.6", statusListener = listener)
+# ...
+# listener.stop()
+
+# Maximum size of a status packet (same as the buffer in _getBinaryStatusPacket)
+_bufferSize = 8192
+
+# Receives the status broadcasts of every device and keeps the last packet of each one
+class SharedStatusListener:
+
+    # Constructor
+    # port: status broadcast port
+    def __init__(self, port = 30304):
+
+        self._port = port
+
+        # IP -> (packet number, packet, receive timestamp), the number grows with every packet of the device
+        self._packets   = dict()
+        self._condition = threading.Condition()
+
+        self._socket           = None
+        self._kernelTimestamps = False
+        self._supervisor = SupervisedThread("CryostreamSharedListener", self._receiveOnce)
+
+    # Opens the socket and starts receiving in the background
+    def start(self):
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        s.bind(("0.0.0.0", self._port))
+
+        # Short timeout, so stop() is not kept waiting by a silent network
+        s.settimeout(0.5)
+
+        # Packets stamped by the kernel when they arrive (cryostream_clock.py)
+        self._kernelTimestamps = enableKernelTimestamps(s)
+
+        self._socket = s
+        self._supervisor.start()
+
+    # Stops receiving and closes the socket
+    def stop(self):
+        self._supervisor.stop(timeout = 1.0)
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    # Returns the IPs that broadcast since start()
+    def getIPs(self):
+        with self._condition:
+            return list(self._packets.keys())
+
+    # Waits for the next packet of a device, received after this call (same as _getBinaryStatusPacket)
+    # deadline: time.time() value after which StatusTimeout is raised, None waits forever
+    def waitForPacket(self, ip, deadline = None):
+        return self.waitForStampedPacket(ip, deadline)[0]
+
+    # Same as waitForPacket(), returns (packet, receive timestamp)
+    def waitForStampedPacket(self, ip, deadline = None):
+
+        with self._condition:
+
+            number = self._packets.get(ip, (0, None, None))[0]
+
+            while self._packets.get(ip, (0, None, None))[0] == number:
+
+                if deadline is None:
+                    self._condition.wait(1.0)
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise StatusTimeout(ip, deadline)
+                self._condition.wait(remaining)
+
+            return self._packets[ip][1:]
+
+    # Receives one packet, run over and over by the supervisor
+    def _receiveOnce(self):
+
+        try:
+            packet, address, timestamp = receiveStamped(self._socket, _bufferSize, self._kernelTimestamps)
+        except socket.timeout:
+            return
+
+        self._deliver(address[0], packet, timestamp)
+
+    # Keeps a packet as the last one of its device and wakes up the readers waiting for it
+    # timestamp: receive time of the packet, now if not given
+    def _deliver(self, ip, packet, timestamp = None):
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self._condition:
+            number = self._packets.get(ip, (0, None, None))[0]
+            self._packets[ip] = (number + 1, packet, timestamp)
+            self._condition.notify_all()
@@ -0,0 +1,333 @@
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+from cryostream_snapshot import readStatusValue
+from cryostream_trend import LinearTrend
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Predictive maintenance of the Cryostream 800: Cryodrive, coldhead, pump and regeneration
+# Tracks, from the status stream, in a single pass and with constant memory per device:
+# - Hour counters: "Total hours", "CD Hours since service", "CD Coldhead hours", "CD Adsorber hours", ...
+# - Minute counters split in two 16 bit fields ("PU Run mins lo" / "hi", ...), stitched into 32 bit values
+#   and reported in hours ("PU Run hours (mins)", "PU Total hours (mins)", ...), apart from the hour counters of the
+#   same name, which the device rounds on its own
+# - "Days since regen", and the number of regenerations seen (the counter going back to 0)
+# - Degradation trends, fitted by least squares with exponential forgetting (recent behaviour counts more):
+#   - "CD He supply pressure" and "CD He return pressure" over time
+#   - "Evap heat" over time at a constant setpoint, while running (one trend per setpoint)
+# and forecasts when each counter reaches its service interval, and when each trend crosses its limit.
+#
+# Service intervals and limits depend on the model and on the site, they are given by the user.
+#
+# Usage:
+# tracker = MaintenanceTracker(serviceIntervals = {"CD Hours since service": 10000},
+#                              limits = {"CD He supply pressure": (15.0, None)})
+# for timestamp, status in history:          # status: StatusSnapshot, or dict or StatusPacketView with raw values
+#     tracker.add(timestamp, status)
+# tracker.forecast()
+#
+# Command line, on recordings (cryostream_export.py):
+# python cryostream_maintenance.py /data/*.csr --service "CD Hours since service=10000" --min "CD He supply pressure=15"
+
+# Counters in hours
+_hourCounters = ["Total hours", "CD Hours since service", "CD Total hours", "CD Coldhead hours",
+                 "CD Adsorber hours", "PU Total hours", "DAU Total hours"]
+
+# Counters in minutes, as (lo, hi) 16 bit halves, reported in hours under their own name
+# The names must differ from the hour counters: "PU Total hours" (1519) is ahead of "PU Total mins" / 60 by up to
+# an hour, sharing one slot would count every packet as a reset
+_minuteCounters = {
+    "PU Run hours (mins)":    ("PU Run mins lo", "PU Run mins hi"),
+    "PU Total hours (mins)":  ("PU Total mins lo", "PU Total mins hi"),
+    "DAU Run hours (mins)":   ("DAU Run mins lo", "DAU Run min hi"),
+    "DAU Total hours (mins)": ("DAU Total mins lo", "DAU Total mins hi"),
+}
+
+# Signals fitted over time
+_pressureSignals = ["CD He supply pressure", "CD He return pressure"]
+
+# "Run mode" value while running (see _buildOxCryoEnumsInline())
+_runModeRunning = 3
+
+_secondsPerDay = 86400.0
+
+#===============
+#=== Tracker ===
+#===============
+
+# Maintenance counters and degradation trends of one device
+class MaintenanceTracker:
+
+    # Constructor
+    # serviceIntervals: counter name -> hours at which service is due, e.g. {"CD Hours since service": 10000}
+    # limits: signal name -> (minimum, maximum) in output units, None for no limit on one side
+    #         Signals: "CD He supply pressure", "CD He return pressure", "Evap heat"
+    # halfLife: seconds after which a sample weighs half as much in the trends (default 30 days)
+    # sampleInterval: seconds between two samples fed to the trends, the counters are read on every status
+    # stableSetpointTime: seconds the setpoint must stay the same before evap heat is fitted
+    def __init__(self, serviceIntervals = None, limits = None, halfLife = 30 * _secondsPerDay,
+                 sampleInterval = 60.0, stableSetpointTime = 600.0):
+
+        self._serviceIntervals   = dict(serviceIntervals or {})
+        self._limits             = dict(limits or {})
+        self._halfLife           = halfLife
+        self._sampleInterval     = sampleInterval
+        self._stableSetpointTime = stableSetpointTime
+
+        # Counter name -> last value (hours, days for "Days since regen")
+        self._counters = dict()
+
+        # Counter name -> times the counter went back (service, regeneration, replacement)
+        self._resets = dict()
+
+        # Counter name -> LinearTrend of the counter over time, its slope is the usage rate
+        self._usage = dict()
+
+        # Signal name -> LinearTrend of the signal over time
+        self._trends = dict()
+
+        self._lastSample    = None
+        self._lastTimestamp = None
+        self._setpoint      = None
+        self._setpointSince = None
+
+    # Adds one status
+    # timestamp: seconds since epoch
+    # status: StatusSnapshot, or dict or StatusPacketView with raw values, as broadcast by the device
+    def add(self, timestamp, status):
+
+        self._lastTimestamp = timestamp
+
+        # Counters, every status, so resets are never missed
+        for name in _hourCounters:
+            self._updateCounter(timestamp, name, status.get(name))
+
+        for name, (lo, hi) in _minuteCounters.items():
+            loValue = status.get(lo)
+            hiValue = status.get(hi)
+            if loValue is not None and hiValue is not None:
+                self._updateCounter(timestamp, name, ((hiValue << 16) | loValue) / 60.0)
+
+        self._updateCounter(timestamp, "Days since regen", status.get("Days since regen"))
+
+        self._updateSetpoint(timestamp, status)
+
+        # Trends, once per sample interval
+        if self._lastSample is not None and timestamp - self._lastSample < self._sampleInterval:
+            return
+
+        self._lastSample = timestamp
+
+        for name in self._counters:
+            self._getTrend(self._usage, name).add(timestamp, self._counters[name])
+
+        for name in _pressureSignals:
+            value = readStatusValue(status, name)
+            if value is not None:
+                self._getTrend(self._trends, name).add(timestamp, value)
+
+        evapHeat = status.get("Evap heat")
+        if evapHeat is not None and self._isSetpointStable(timestamp, status):
+            self._getTrend(self._trends, "Evap heat at " + str(self._setpoint) + " K").add(timestamp, evapHeat)
+
+    # Returns the last value of every counter, hours (days for "Days since regen")
+    def getCounters(self):
+        return dict(self._counters)
+
+    # Returns how many times each counter went back (service done, regeneration, part replaced)
+    def getResets(self):
+        return dict(self._resets)
+
+    # Returns every trend: name -> {"value": fitted value now, "slopePerDay": change per day, "samples": count}
+    def getTrends(self):
+
+        trends = dict()
+
+        for name, trend in self._trends.items():
+            slope = trend.getSlope()
+            trends[name] = {
+                "value":       trend.getValue(self._lastTimestamp) if slope is not None else None,
+                "slopePerDay": slope * _secondsPerDay if slope is not None else None,
+                "samples":     trend.getCount(),
+            }
+
+        return trends
+
+    # Forecasts the services due and the limits that will be crossed
+    # Returns a list of {"item", "reason", "date" (seconds since epoch), "days" (from now)}, soonest first
+    # Items without a forecast (unused counter, trend moving away from its limit) are not listed
+    def forecast(self, now = None):
+
+        if now is None:
+            now = self._lastTimestamp if self._lastTimestamp is not None else time.time()
+
+        forecasts = []
+
+        for name, interval in self._serviceIntervals.items():
+
+            current = self._counters.get(name)
+            if current is None:
+                continue
+
+            # Usage rate: counter hours per wall clock second
+            rate = self._usage[name].getSlope() if name in self._usage else None
+
+            if current >= interval:
+                date = now
+            elif rate is not None and rate > 0:
+                date = now + (interval - current) / rate
+            else:
+                continue
+
+            forecasts.append(self._makeForecast(name, "service interval " + str(interval) + " h, now " + str(round(current, 1)) + " h", date, now))
+
+        for name, trend in self._trends.items():
+
+            limit = self._limits.get(name)
+
+            # Evap heat limits apply to every setpoint
+            if limit is None and name.startswith("Evap heat at "):
+                limit = self._limits.get("Evap heat")
+
+            if limit is None:
+                continue
+
+            minimum, maximum = limit
+
+            value = trend.getValue(now)
+
+            for threshold, side in ((minimum, "minimum"), (maximum, "maximum")):
+                if threshold is None:
+                    continue
+                # Already beyond the limit: due now
+                if value is not None and (value < threshold if side == "minimum" else value > threshold):
+                    crossing = now
+                else:
+                    crossing = trend.getCrossing(threshold)
+                if crossing is not None:
+                    forecasts.append(self._makeForecast(name, side + " " + str(threshold), max(crossing, now), now))
+
+        return sorted(forecasts, key = lambda forecast: forecast["date"])
+
+    def _makeForecast(self, item, reason, date, now):
+        return {"item": item, "reason": reason, "date": date, "days": (date - now) / _secondsPerDay}
+
+    def _getTrend(self, trends, name):
+        if name not in trends:
+            trends[name] = LinearTrend(self._halfLife)
+        return trends[name]
+
+    # A counter going back means the part was serviced or replaced, its usage trend starts again
+    def _updateCounter(self, timestamp, name, value):
+
+        if value is None:
+            return
+
+        previous = self._counters.get(name)
+
+        if previous is not None and value < previous:
+            self._resets[name] = self._resets.get(name, 0) + 1
+            self._usage.pop(name, None)
+
+        self._counters[name] = value
+
+    # Follows the setpoint ("Set temp", K rounded to 0.1 K) while running
+    def _updateSetpoint(self, timestamp, status):
+
+        setTemp = readStatusValue(status, "Set temp")
+        running = status.get("Run mode") == _runModeRunning
+
+        if setTemp is None or not running:
+            self._setpoint      = None
+            self._setpointSince = None
+            return
+
+        setpoint = round(setTemp, 1)
+
+        if setpoint != self._setpoint:
+            self._setpoint      = setpoint
+            self._setpointSince = timestamp
+
+    def _isSetpointStable(self, timestamp, status):
+        return self._setpoint is not None and timestamp - self._setpointSince >= self._stableSetpointTime
+
+#=============
+#=== Fleet ===
+#=============
+
+# One tracker per device, and the forecasts of the whole fleet
+class FleetMaintenance:
+
+    # Constructor
+    # Arguments are given to the MaintenanceTracker of every device
+    def __init__(self, **trackerOptions):
+        self._trackerOptions = trackerOptions
+        self._trackers = dict()
+
+    # Adds one status of a device
+    def add(self, ip, timestamp, status):
+        tracker = self._trackers.get(ip)
+        if tracker is None:
+            tracker = self._trackers[ip] = MaintenanceTracker(**self._trackerOptions)
+        tracker.add(timestamp, status)
+
+    # Returns the tracker of a device, None if it was never seen
+    def getTracker(self, ip):
+        return self._trackers.get(ip)
+
+    # Returns the forecasts of every device, soonest first, each with its "ip"
+    def forecast(self, now = None):
+
+        forecasts = []
+
+        for ip, tracker in self._trackers.items():
+            for forecast in tracker.forecast(now):
+                forecast["ip"] = ip
+                forecasts.append(forecast)
+
+        return sorted(forecasts, key = lambda forecast: forecast["date"])
+
+# "Name=value" given on the command line
+def _parseAssignment(text):
+    name, value = text.rsplit("=", 1)
+    return name.strip(), float(value)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cryostream maintenance forecast from recordings")
+    parser.add_argument("recordings", nargs="+", help="Recording files (cryostream_export.py), one per device, named <ip>.csr")
+    parser.add_argument("--service", action="append", default=[], help="Service interval, e.g. \"CD Hours since service=10000\"")
+    parser.add_argument("--min", action="append", default=[], help="Lower limit, e.g. \"CD He supply pressure=15\"")
+    parser.add_argument("--max", action="append", default=[], help="Upper limit, e.g. \"Evap heat=80\"")
+    args = parser.parse_args()
+
+    from cryostream_export import readRecording
+
+    limits = dict()
+    for name, value in map(_parseAssignment, args.min):
+        limits[name] = (value, limits.get(name, (None, None))[1])
+    for name, value in map(_parseAssignment, args.max):
+        limits[name] = (limits.get(name, (None, None))[0], value)
+
+    fleet = FleetMaintenance(serviceIntervals = dict(map(_parseAssignment, args.service)), limits = limits)
+
+    for path in args.recordings:
+        ip = os.path.splitext(os.path.basename(path))[0]
+        for timestamp, status in readRecording(path):
+            fleet.add(ip, timestamp, status)
+
+    for ip in sorted(args.recordings):
+        ip = os.path.splitext(os.path.basename(ip))[0]
+        tracker = fleet.getTracker(ip)
+        if tracker is not None:
+            print(ip + " counters: " + str(tracker.getCounters()) + " resets: " + str(tracker.getResets()))
+
+    for forecast in fleet.forecast():
+        print(forecast["ip"] + "  " + forecast["item"] + ": " + forecast["reason"] + ", in " + str(round(forecast["days"], 1)) +
+              " days (" + time.strftime("%Y-%m-%d", time.localtime(forecast["date"])) + ")")
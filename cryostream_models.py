@@ -0,0 +1,123 @@
+import re
+
+from cryostream_errors import UnknownModelError
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Cryostream models driven by the Cryostream800 class
+# The Cryostream 800 and the Cryostream 1000 series speak the same Oxford Cryosystems Ethernet protocol:
+# status broadcast on port 30304 (OxcryoProperties.xml), commands on port 30305 (Cryostream.xml).
+# One driver (transport, status cache, confirmation, journal, metrics) serves both,
+# a CryostreamModel tells it what differs between them:
+# - the name of the model, in messages and in the registry
+# - how a sample is annealed (gas flow stopped for a moment), chosen when anneal() is called:
+#   "native":        Cryostream 1000, flow interrupt commands ("Set flow interrupt time", "Interrupt flow now")
+#   "flowInterrupt": Cryostream 800 whose flow controller reports the interrupt fields (FC Interrupt count),
+#                    same commands
+#   "software":      other Cryostream 800, Stop, Restart and Cool (softwareAnnealing())
+#
+# Usage:
+# cryostream = Cryostream1000("10.0.0.6")                      # Or Cryostream800("10.0.0.6", model = "1000")
+# cryostream.getModel().getName()                              # "Cryostream 1000"
+# cryostream.getAnnealMethod()                                 # "native"
+# cryostream.anneal(100.0, duration = 3.0)                     # Flow stopped 3 s on the 1000, software sequence on most 800s
+# cryostream = connect("BL822")                                # Model from the registry (cryostream_discovery.py)
+
+# Status field that shows the flow controller can interrupt the flow, counts the interrupts
+_flowInterruptField = "FC Interrupt count"
+
+# Protocol differences of one model
+class CryostreamModel:
+
+    # Constructor
+    # name: name of the model, e.g. "Cryostream 1000"
+    # series: short name, used in the registry and on the command line ("800", "1000")
+    # nativeAnneal: True if every device of the model anneals with the flow interrupt commands
+    # identification: regular expression of the model in the identification broadcast (cryostream_discovery.py)
+    def __init__(self, name, series, nativeAnneal, identification):
+        self._name           = name
+        self._series         = series
+        self._nativeAnneal   = nativeAnneal
+        self._identification = re.compile(identification)
+
+    def __str__(self):
+        return self._name
+
+    # Returns the name of the model
+    def getName(self):
+        return self._name
+
+    # Returns the short name of the model ("800", "1000")
+    def getSeries(self):
+        return self._series
+
+    # Returns True if every device of the model anneals with the flow interrupt commands
+    def hasNativeAnneal(self):
+        return self._nativeAnneal
+
+    # Returns True if the identification text of a device names this model
+    def matches(self, identification):
+        return self._identification.search(identification) is not None
+
+    # Returns how a device of this model anneals: "native", "flowInterrupt" or "software"
+    # snapshot: last StatusSnapshot of the device, the flow controller of some 800s reports the interrupt fields
+    def getAnnealMethod(self, snapshot):
+
+        if self._nativeAnneal:
+            return "native"
+
+        if snapshot is not None and _flowInterruptField in snapshot:
+            return "flowInterrupt"
+
+        return "software"
+
+# Models known, by series
+# Both accept the whole command book, the flow interrupt commands are only sent to an 800 whose status reports them
+_models = {
+    "800":  CryostreamModel("Cryostream 800", "800", False, r"(?<!\d)800(?!\d)"),
+    "1000": CryostreamModel("Cryostream 1000", "1000", True, r"(?<!\d)1000(?!\d)"),
+}
+
+# Model of a device nothing is known about, the model this driver was written for
+_defaultSeries = "800"
+
+# Returns a CryostreamModel by series ("1000"), name ("Cryostream 1000") or model, the default model for None
+# Raises UnknownModelError if the model is not known
+def getModel(model = None):
+
+    if model is None:
+        return _models[_defaultSeries]
+
+    if isinstance(model, CryostreamModel):
+        return model
+
+    for candidate in _models.values():
+        if str(model) in (candidate.getSeries(), candidate.getName()):
+            return candidate
+
+    raise UnknownModelError(model)
+
+# Returns the series of every known model
+def getModelSeries():
+    return sorted(_models, key = int)
+
+# Returns the model of a registry entry (cryostream_discovery.py), the default model if it cannot tell
+# A model set by hand ("model") wins over the identification broadcast
+def detectModel(entry):
+
+    if entry is None:
+        return getModel()
+
+    if entry.get("model"):
+        return getModel(entry["model"])
+
+    identification = entry.get("identification", "")
+
+    # The longest series first, "1000" before "800"
+    for series in sorted(_models, key = len, reverse = True):
+        if _models[series].matches(identification):
+            return _models[series]
+
+    return getModel()
@@ -0,0 +1,408 @@
+from __future__ import print_function
+
+import argparse
+import math
+import time
+
+from cryostream_catalog import decodeEnum, getPropertyId
+from cryostream_snapshot import readStatusValue
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Setpoint trajectory planner for the Cryostream 800
+# Cool (command 14) changes the temperature as fast as possible, which may overshoot or shock the sample.
+# Ramp (command 11) moves the setpoint at a given rate, Plat (command 12) holds the temperature for a while.
+# The planner chooses between them from a thermal model of the device, fitted on its recorded status history:
+# - Cooling and warming rates: how fast the sample temperature moves under Cool, far from the target (K/hour)
+# - Time constant: how fast the sample follows the setpoint once close to it (first order lag, s)
+# - Overshoot ratio: overshoot after Cool, per K of temperature change (cryostream_analytics.py)
+# Given a target, an optional deadline and a maximum rate, it returns the gentlest sequence that arrives in time:
+# the slowest ramp rate that meets the deadline, or the fastest allowed change when there is no deadline.
+# executePlan() sends the sequence with confirmation, follows the phases in the status ("Phase id"),
+# and reports the predicted and the actual arrival times.
+#
+# Usage:
+# model = fitThermalModel(readRecording("/data/10.0.0.5.csr"))
+# plan  = planTrajectory(model, cryostream.getSnapshot().get("Sample temp"), 100.0, deadline = 1800, maxRate = 360)
+# result = executePlan(cryostream, plan)
+#
+# Command line:
+# python cryostream_planner.py 10.0.0.5 100 --history /data/10.0.0.5.csr --deadline 1800 --max-rate 360
+
+# Ramp rates accepted by the device (K/hour)
+_minRampRate = 1
+_maxRampRate = 360
+
+# Plat durations accepted by the device (min)
+_maxPlatDuration = 1440
+
+# "Phase id" value of the Cool phase (see _buildOxCryoEnumsInline())
+_phaseCool = 1
+
+#=============
+#=== Model ===
+#=============
+
+# Thermal response of one device
+class ThermalModel:
+
+    # Constructor
+    # coolingRate, warmingRate: sample temperature change under Cool, far from the target (K/hour)
+    # timeConstant: first order lag of the sample behind the setpoint (s)
+    # overshootRatio: overshoot after Cool, per K of temperature change
+    def __init__(self, coolingRate, warmingRate, timeConstant, overshootRatio = 0.0):
+
+        self.coolingRate    = coolingRate
+        self.warmingRate    = warmingRate
+        self.timeConstant   = timeConstant
+        self.overshootRatio = overshootRatio
+
+    # Returns the fastest rate (K/hour) from startTemp towards targetTemp
+    def getMaxRate(self, startTemp, targetTemp):
+        return self.coolingRate if targetTemp < startTemp else self.warmingRate
+
+    # Predicts (seconds until the sample is within band of the target, overshoot in K)
+    # rate: ramp rate (K/hour), None for Cool
+    def predict(self, startTemp, targetTemp, rate = None, band = 0.5):
+
+        change  = abs(targetTemp - startTemp)
+        maxRate = self.getMaxRate(startTemp, targetTemp)
+
+        if change <= band:
+            return 0.0, 0.0
+
+        speed = maxRate if rate is None else min(rate, maxRate)
+
+        # The setpoint (or the sample, under Cool) travels at speed, the sample lags it by speed * timeConstant
+        travelTime = change / speed * 3600.0
+        lag        = min(change, speed / 3600.0 * self.timeConstant)
+
+        # Then the lag decays exponentially into the band
+        settleTime = self.timeConstant * math.log(max(1.0, lag / band))
+
+        # Cool overshoots in proportion to the change, a ramp only in proportion to its lag
+        overshoot = self.overshootRatio * (change if rate is None else lag)
+
+        return travelTime + settleTime, overshoot
+
+    # Returns the model as a dictionary
+    def toDict(self):
+        return {
+            "coolingRate":    self.coolingRate,
+            "warmingRate":    self.warmingRate,
+            "timeConstant":   self.timeConstant,
+            "overshootRatio": self.overshootRatio,
+        }
+
+# Fits a ThermalModel on a status history, in a single streaming pass
+class ThermalModelFitter:
+
+    # Constructor
+    # farBand: the sample is "far" from the target beyond farBand (K), there it moves at the Cool rate
+    # nearBand: the time constant is fitted while the sample is within nearBand (K) of the setpoint
+    # maxGap: consecutive samples further apart than maxGap seconds are not compared
+    def __init__(self, farBand = 5.0, nearBand = 5.0, maxGap = 10.0):
+
+        # Imported here, analytics is only needed to fit a model
+        from cryostream_analytics import SetpointAnalyzer
+
+        self._farBand  = farBand
+        self._nearBand = nearBand
+        self._maxGap   = maxGap
+
+        self._analyzer = SetpointAnalyzer()
+
+        # Sums of the rates under Cool, towards the target (K/s)
+        self._cooling = [0.0, 0]
+        self._warming = [0.0, 0]
+
+        # Least squares of d(sample)/dt = (set - sample) / timeConstant
+        self._sumErrorSlope  = 0.0
+        self._sumErrorSquare = 0.0
+
+        # Overshoot per K of change, per setpoint change larger than farBand
+        self._overshoot = [0.0, 0]
+
+        self._last = None
+
+    # Adds one status
+    # status: StatusSnapshot, or dict or StatusPacketView with raw values, as broadcast by the device
+    def add(self, timestamp, status):
+
+        sample   = self._get(status, "Sample temp")
+        target   = self._get(status, "Target temp")
+        setpoint = self._get(status, "Set temp")
+        phase    = status.get("Phase id")
+
+        if sample is None or target is None:
+            self._last = None
+            return
+
+        self._addEvent(self._analyzer.add(timestamp, status))
+
+        last = self._last
+        self._last = (timestamp, sample, target, setpoint, phase)
+
+        if last is None or not (0 < timestamp - last[0] <= self._maxGap):
+            return
+
+        lastTime, lastSample, lastTarget, lastSetpoint, lastPhase = last
+        slope = (sample - lastSample) / (timestamp - lastTime)
+
+        # Full speed under Cool, far from the target
+        if lastPhase == _phaseCool and abs(lastTarget - lastSample) > self._farBand:
+            if lastTarget < lastSample:
+                self._cooling[0] += -slope
+                self._cooling[1] += 1
+            else:
+                self._warming[0] += slope
+                self._warming[1] += 1
+
+        # First order lag, close to the setpoint
+        if lastSetpoint is not None:
+            error = lastSetpoint - lastSample
+            if 0.05 < abs(error) < self._nearBand:
+                self._sumErrorSlope  += error * slope
+                self._sumErrorSquare += error * error
+
+    # Returns the fitted ThermalModel
+    # Raises ValueError if the history does not contain enough Cool phases or approaches to a setpoint
+    def getModel(self):
+
+        self._addEvent(self._analyzer.finish())
+
+        if self._cooling[1] == 0 and self._warming[1] == 0:
+            raise ValueError("The history has no Cool phase far from its target, the rates cannot be fitted.")
+
+        if self._sumErrorSlope <= 0:
+            raise ValueError("The history has no approach to a setpoint, the time constant cannot be fitted.")
+
+        # Without one direction in the history, the other one is used
+        coolingRate = self._cooling[0] / self._cooling[1] * 3600.0 if self._cooling[1] else None
+        warmingRate = self._warming[0] / self._warming[1] * 3600.0 if self._warming[1] else None
+
+        overshootRatio = self._overshoot[0] / self._overshoot[1] if self._overshoot[1] else 0.0
+
+        return ThermalModel(coolingRate or warmingRate, warmingRate or coolingRate,
+                            self._sumErrorSquare / self._sumErrorSlope, overshootRatio)
+
+    def _addEvent(self, event):
+        if event is not None and abs(event.targetTemp - event.startTemp) > self._farBand:
+            self._overshoot[0] += event.overshoot / abs(event.targetTemp - event.startTemp)
+            self._overshoot[1] += 1
+
+    def _get(self, status, name):
+        return readStatusValue(status, name)
+
+# Fits a ThermalModel on a status history
+# history: iterable of (timestamp, status), e.g. cryostream_export.readRecording()
+def fitThermalModel(history, farBand = 5.0, nearBand = 5.0):
+
+    fitter = ThermalModelFitter(farBand, nearBand)
+
+    for timestamp, status in history:
+        fitter.add(timestamp, status)
+
+    return fitter.getModel()
+
+#================
+#=== Planning ===
+#================
+
+# Sequence of commands to reach a target, with its prediction
+class TrajectoryPlan:
+
+    # Constructor
+    def __init__(self, startTemp, targetTemp, steps, rate, predictedArrival, predictedOvershoot, feasible, reason):
+
+        self.startTemp          = startTemp
+        self.targetTemp         = targetTemp
+
+        # Steps in the format of Cryostream800.runProfile(), e.g. [["ramp", 120, 100.0], ["plat", 10]]
+        self.steps              = steps
+
+        # Ramp rate (K/hour), None for Cool
+        self.rate               = rate
+
+        # Seconds from the start until the sample is within the band, and overshoot (K)
+        self.predictedArrival   = predictedArrival
+        self.predictedOvershoot = predictedOvershoot
+
+        # False if the deadline or overshoot limit cannot be met, the plan is then the best effort
+        self.feasible           = feasible
+        self.reason             = reason
+
+    # Returns the plan as a dictionary
+    def toDict(self):
+        return {
+            "startTemp":          self.startTemp,
+            "targetTemp":         self.targetTemp,
+            "steps":              self.steps,
+            "rate":               self.rate,
+            "predictedArrival":   self.predictedArrival,
+            "predictedOvershoot": self.predictedOvershoot,
+            "feasible":           self.feasible,
+            "reason":             self.reason,
+        }
+
+# Plans the commands to go from startTemp to targetTemp (K)
+# deadline: seconds to arrive within the band, None for as fast as allowed
+# maxRate: highest rate allowed for the sample (K/hour), None for no limit (Cool allowed)
+# maxOvershoot: highest overshoot allowed (K), None for no limit
+# dwell: minutes to hold the temperature after arrival (Plat), None for no Plat
+# band: the sample has arrived when within band (K) of the target
+# With a deadline, the slowest ramp that arrives in time is chosen, it is the gentlest for the sample
+def planTrajectory(model, startTemp, targetTemp, deadline = None, maxRate = None, maxOvershoot = None,
+                   dwell = None, band = 0.5):
+
+    def meets(arrival, overshoot):
+        return (deadline is None or arrival <= deadline) and (maxOvershoot is None or overshoot <= maxOvershoot)
+
+    # Cool is only allowed if the model says it stays within the rate limit
+    coolAllowed = maxRate is None or maxRate >= model.getMaxRate(startTemp, targetTemp)
+    coolArrival, coolOvershoot = model.predict(startTemp, targetTemp, None, band)
+
+    # Ramp rates within the limits that meet the deadline and overshoot limit, fastest first
+    fastest = _maxRampRate if maxRate is None else max(_minRampRate, min(_maxRampRate, int(maxRate)))
+    rates   = [rate for rate in range(fastest, _minRampRate - 1, -1) if meets(*model.predict(startTemp, targetTemp, rate, band))]
+
+    rate     = None
+    feasible = True
+
+    if deadline is None and coolAllowed and meets(coolArrival, coolOvershoot):
+        reason = "Cool, fastest within the limits"
+    elif rates:
+        rate   = rates[-1] if deadline is not None else rates[0]
+        reason = "Ramp at " + str(rate) + " K/hour, " + ("slowest in time" if deadline is not None else "fastest within the limits")
+    elif coolAllowed and meets(coolArrival, coolOvershoot):
+        reason = "Cool, no ramp arrives in time"
+    else:
+        # Best effort: as fast as allowed
+        feasible = False
+        if coolAllowed and (maxOvershoot is None or coolOvershoot <= maxOvershoot):
+            reason = "Cool, the deadline cannot be met"
+        else:
+            rate   = fastest
+            reason = "Ramp at " + str(rate) + " K/hour, the deadline or overshoot limit cannot be met"
+
+    if rate is None:
+        steps = [["cool", targetTemp]]
+        arrival, overshoot = coolArrival, coolOvershoot
+    else:
+        steps = [["ramp", rate, targetTemp]]
+        arrival, overshoot = model.predict(startTemp, targetTemp, rate, band)
+
+    if dwell:
+        steps.append(["plat", max(1, min(_maxPlatDuration, int(dwell)))])
+
+    return TrajectoryPlan(startTemp, targetTemp, steps, rate, arrival, overshoot, feasible, reason)
+
+#=================
+#=== Execution ===
+#=================
+
+# Sends a plan to a device with confirmation and follows it until the sample arrives
+# hold: seconds the sample must stay within the band to count as arrived
+# timeout: seconds to wait for the arrival, None waits three times the predicted arrival (at least 10 min)
+# Returns {"plan", "sent", "predictedArrival", "actualArrival" (None if not arrived), "overshoot", "phases"}
+# "phases": (seconds from the start, phase name) every time "Phase id" changed
+def executePlan(cryostream, plan, band = 0.5, hold = 10.0, timeout = None):
+
+    if timeout is None:
+        timeout = max(600.0, 3.0 * plan.predictedArrival)
+
+    result = {"plan": plan.toDict(), "sent": False, "predictedArrival": plan.predictedArrival,
+              "actualArrival": None, "overshoot": 0.0, "phases": []}
+
+    # Same preparation as getReadySetTargetTemperatureAndGo()
+    cryostream.refreshStatus()
+    if cryostream.getRunMode() not in ("Ready", "Running") and not cryostream.restartWithConfirmation():
+        return result
+
+    startTime = time.time()
+
+    # The Plat of the plan is sent once the sample arrived, it holds the temperature reached
+    for step in plan.steps:
+        if step[0] == "cool" and not cryostream.coolWithConfirmation(step[1]):
+            return result
+        if step[0] == "ramp" and not cryostream.rampWithConfirmation(step[1], step[2]):
+            return result
+
+    result["sent"] = True
+
+    direction   = 1.0 if plan.targetTemp >= plan.startTemp else -1.0
+    lastPhase   = None
+    insideSince = None
+
+    while time.time() - startTime < timeout:
+
+        cryostream.refreshStatus()
+        snapshot = cryostream.getSnapshot()
+        sample   = snapshot.get("Sample temp")
+        phase    = snapshot.getRaw("Phase id")
+        elapsed  = time.time() - startTime
+
+        if phase != lastPhase and phase is not None:
+            result["phases"].append((elapsed, decodeEnum(getPropertyId("Phase id"), phase)))
+            lastPhase = phase
+
+        if sample is None:
+            continue
+
+        result["overshoot"] = max(result["overshoot"], (sample - plan.targetTemp) * direction)
+
+        if abs(sample - plan.targetTemp) <= band:
+            if insideSince is None:
+                insideSince = elapsed
+            if elapsed - insideSince >= hold:
+                result["actualArrival"] = insideSince
+                break
+        else:
+            insideSince = None
+
+    for step in plan.steps:
+        if step[0] == "plat" and result["actualArrival"] is not None:
+            cryostream.platWithConfirmation(step[1])
+
+    return result
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cryostream setpoint trajectory planner")
+    parser.add_argument("ip")
+    parser.add_argument("target", type=float, help="Target temperature (K)")
+    parser.add_argument("--history", nargs="+", required=True, help="Recordings (cryostream_export.py) to fit the thermal model")
+    parser.add_argument("--deadline", type=float, default=None, help="Seconds to arrive")
+    parser.add_argument("--max-rate", type=float, default=None, help="Highest rate for the sample (K/hour)")
+    parser.add_argument("--max-overshoot", type=float, default=None, help="Highest overshoot (K)")
+    parser.add_argument("--dwell", type=float, default=None, help="Minutes to hold after arrival")
+    parser.add_argument("--band", type=float, default=0.5, help="Arrival band around the target (K)")
+    parser.add_argument("--plan-only", action="store_true", help="Print the plan, do not send it")
+    args = parser.parse_args()
+
+    from cryostream_export import readRecording
+    from cryostream800 import Cryostream800
+
+    fitter = ThermalModelFitter()
+    for path in args.history:
+        for timestamp, status in readRecording(path):
+            fitter.add(timestamp, status)
+    model = fitter.getModel()
+
+    print("Thermal model: " + str(model.toDict()))
+
+    cryostream = Cryostream800(args.ip)
+    cryostream.refreshStatus()
+
+    plan = planTrajectory(model, cryostream.getSnapshot().get("Sample temp"), args.target, args.deadline,
+                          args.max_rate, args.max_overshoot, args.dwell, args.band)
+
+    print("Plan: " + plan.reason + ", steps " + str(plan.steps) + ", arrival in " + str(int(plan.predictedArrival)) +
+          " s, overshoot " + str(round(plan.predictedOvershoot, 2)) + " K")
+
+    if not args.plan_only:
+        result = executePlan(cryostream, plan, args.band)
+        print("Predicted arrival: " + str(int(result["predictedArrival"])) + " s, actual: " + str(result["actualArrival"]) +
+              " s, overshoot " + str(round(result["overshoot"], 2)) + " K")
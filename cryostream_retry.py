@@ -0,0 +1,140 @@
+import collections
+import random
+import threading
+import time
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Adaptive retry policy for the commands with confirmation
+# Every Cryostream800 object (one per device) owns one policy, so the numbers are per device and per command type.
+# The policy records how long each command type takes from the send to the confirmation in the status packet,
+# and derives from the 95th percentile (p95):
+# - Resend interval: how long to wait for a confirmation before sending the command again
+# - Deadline: how long to keep trying before giving up, the sum of the resend intervals of maxRetries attempts
+#   (maxRetries is the number of attempts, however long the device takes to confirm)
+# Until enough confirmations are observed, the fixed waits used before this policy existed are used.
+# Resends back off exponentially with jitter, and sends are spaced so retries never flood the command port.
+
+# Fixed waits (seconds) used before the policy has learned anything, per command type
+_defaultIntervals = {
+    "Restart":        4.0,
+    "Cool":           1.0,
+    "Ramp":           1.0,
+    "Plat":           1.0,
+    "Hold":           1.0,
+    "End":            1.0,
+    "Stop":           1.0,
+    "Turbo":          3.0,
+    "Autofill":       4.0,
+    "Interrupt time": 1.0,
+    "Interrupt":      1.0,
+}
+
+# Latency statistics of one command type
+class LatencyStats:
+
+    # Constructor
+    # size: number of most recent confirmations kept
+    def __init__(self, size = 200):
+        self._samples = collections.deque(maxlen = size)
+
+    # Records a send -> confirmation latency (seconds)
+    def add(self, latency):
+        self._samples.append(latency)
+
+    # Number of recorded latencies
+    def count(self):
+        return len(self._samples)
+
+    # Returns the given percentile (0-100) of the recorded latencies, None if there are none
+    def percentile(self, percent):
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = int(round((percent / 100.0) * (len(ordered) - 1)))
+        return ordered[index]
+
+# Retry policy learned from the observed confirmation latencies of one device
+class AdaptiveRetryPolicy:
+
+    # Constructor
+    # minSamples: confirmations needed before the learned values replace the defaults
+    # minInterval: shortest resend interval (s), the device only broadcasts its status once per second
+    # maxInterval: longest resend interval (s), even after many backoffs
+    # backoff: multiplier applied to the resend interval after every failed attempt
+    # jitter: resend intervals are randomized by +/- jitter (fraction)
+    # minSendSpacing: minimum time (s) between two commands sent to the device
+    def __init__(self, minSamples = 5, minInterval = 1.0, maxInterval = 15.0, backoff = 1.5, jitter = 0.2,
+                 minSendSpacing = 0.25):
+
+        self._minSamples     = minSamples
+        self._minInterval    = minInterval
+        self._maxInterval    = maxInterval
+        self._backoff        = backoff
+        self._jitter         = jitter
+        self._minSendSpacing = minSendSpacing
+
+        self._stats    = dict()
+        self._lock     = threading.Lock()
+        self._lastSend = 0.0
+
+    # Records the latency of a confirmed command
+    def recordConfirmation(self, commandType, latency):
+        with self._lock:
+            if commandType not in self._stats:
+                self._stats[commandType] = LatencyStats()
+            self._stats[commandType].add(latency)
+
+    # Returns the p95 latency of a command type, or None if not enough confirmations were observed
+    def getP95(self, commandType):
+        with self._lock:
+            stats = self._stats.get(commandType)
+            if stats is None or stats.count() < self._minSamples:
+                return None
+            return stats.percentile(95)
+
+    # Returns how long to wait for a confirmation after the given attempt (0 is the first send)
+    def getResendInterval(self, commandType, attempt):
+
+        # Jitter so several clients do not resend in lockstep
+        interval = self._getBackedOffInterval(commandType, attempt)
+        interval = interval * random.uniform(1.0 - self._jitter, 1.0 + self._jitter)
+
+        return max(self._minInterval, interval)
+
+    # Returns how long (s) to keep retrying a command before giving up
+    # Long enough for maxRetries attempts with the longest jitter, and the spacing between the sends
+    def getDeadline(self, commandType, maxRetries):
+        return sum(max(self._minInterval, self._getBackedOffInterval(commandType, attempt) * (1.0 + self._jitter)) +
+                   self._minSendSpacing for attempt in range(maxRetries))
+
+    # Resend interval after the given attempt, before jitter: learned (or default) interval, backed off exponentially, capped
+    def _getBackedOffInterval(self, commandType, attempt):
+
+        p95 = self.getP95(commandType)
+
+        if p95 is None:
+            base = _defaultIntervals.get(commandType, self._minInterval)
+        else:
+            base = max(self._minInterval, p95 * 1.2)
+
+        return min(self._maxInterval, base * (self._backoff ** attempt))
+
+    # Blocks until the device's command port can receive a new command
+    # Spaces the commands by at least minSendSpacing, even with many threads retrying
+    def waitForSendSlot(self):
+        with self._lock:
+            now  = time.time()
+            wait = self._lastSend + self._minSendSpacing - now
+            if wait > 0:
+                time.sleep(wait)
+                now += wait
+            self._lastSend = now
+
+    # Returns a dictionary with the number of confirmations, p50 and p95 (s) per command type
+    def getStats(self):
+        with self._lock:
+            return dict((commandType, {"count": stats.count(), "p50": stats.percentile(50), "p95": stats.percentile(95)})
+                        for commandType, stats in self._stats.items())
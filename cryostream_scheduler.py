@@ -0,0 +1,284 @@
+import itertools
+import json
+import numbers
+import threading
+
+try:
+    # Python 2.7
+    import Queue as queue
+except ImportError:
+    # Python 3
+    import queue
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Priorities used by the command scheduler.
+# Lower numbers are served first, so a Stop always jumps ahead of queued Cool/Restart commands.
+PRIORITY_EMERGENCY = 0
+PRIORITY_STOP      = 10
+PRIORITY_NORMAL    = 50
+PRIORITY_LOW       = 90
+
+# Default priority for each high level command of the Cryostream 800 class.
+# Commands not listed here are scheduled with PRIORITY_NORMAL.
+_defaultPriorities = {
+    "stop":                   PRIORITY_EMERGENCY,
+    "stopWithConfirmation":   PRIORITY_STOP,
+    "shutdownAndGetReady":    PRIORITY_STOP,
+    "hold":                   PRIORITY_STOP,
+}
+
+# Result of a command submitted to the scheduler.
+# Minimal future (Python 2.7 has no concurrent.futures), can be shared by many callers.
+class CommandFuture:
+
+    # Constructor
+    def __init__(self, methodName, args):
+
+        # Name of the Cryostream800 method and its arguments, useful for debugging
+        self._methodName = methodName
+        self._args       = args
+
+        # Set once the command has finished (successfully or not)
+        self._event     = threading.Event()
+        self._result    = None
+        self._exception = None
+        self._callbacks = []
+        self._lock      = threading.Lock()
+
+    def __str__(self):
+        state = "done" if self.done() else "pending"
+        return "CommandFuture(" + self._methodName + str(self._args) + ", " + state + ")"
+
+    # Returns True if the command has already finished
+    def done(self):
+        return self._event.is_set()
+
+    # Blocks until the command finishes and returns its result
+    # Raises the exception raised by the command, if any
+    # Returns None if timeout (seconds) expires before completion
+    def result(self, timeout = None):
+        if not self._event.wait(timeout):
+            return None
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    # Blocks until the command finishes and returns the exception raised by it (or None)
+    def exception(self, timeout = None):
+        self._event.wait(timeout)
+        return self._exception
+
+    # Calls fn(future) once the command finishes
+    # If it already finished, fn is called immediately in the caller's thread
+    def addDoneCallback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _setResult(self, result):
+        self._result = result
+        self._finish()
+
+    def _setException(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                print("An error occurred in a command callback: {}".format(e))
+
+# Per-device command scheduler
+# All commands to one Cryostream 800 go through a single worker thread, so the UDP frames
+# and confirmation loops of different callers never interleave.
+# Identical requests that are queued or running are merged (single-flight),
+# e.g. 5 clients asking coolWithConfirmation(100) share a single confirmation.
+class CommandScheduler:
+
+    # Constructor
+    # device: a Cryostream800 object
+    def __init__(self, device):
+
+        # Device being controlled
+        self._device = device
+
+        # Queue of (priority, sequence, key, future)
+        # Sequence keeps FIFO order among commands with the same priority
+        self._queue    = queue.PriorityQueue()
+        self._sequence = itertools.count()
+
+        # Commands queued or running, indexed by methodName and normalized args (see _makeKey)
+        self._inFlight     = dict()
+        self._inFlightLock = threading.Lock()
+
+        # Key and priority of the command currently being executed by the worker
+        self._current         = None
+        self._currentPriority = None
+
+        # Priorities of the Stop and emergency commands queued, not yet taken by the worker
+        # Guarded by _currentLock with the current command, so a Stop submitted while the worker switches
+        # commands is seen by one side or the other and always pre-empts a slower command
+        self._urgentPending = []
+        self._currentLock   = threading.Lock()
+
+        # Worker thread, the only one allowed to talk to the device
+        self._running = True
+        self._worker  = threading.Thread(target=self._workerLoop, name="CommandScheduler-" + str(device.getIP()))
+        self._worker.daemon = True
+        self._worker.start()
+
+    # Submits a command to be executed on the device
+    # methodName: name of a Cryostream800 method, e.g. "coolWithConfirmation"
+    # priority: optional, overrides the default priority of the command
+    # Returns a CommandFuture
+    def submit(self, methodName, *args, **kwargs):
+
+        priority = kwargs.pop("priority", None)
+        if kwargs:
+            raise TypeError("Unexpected arguments: " + ", ".join(kwargs.keys()))
+
+        if not self._running:
+            raise RuntimeError("Command scheduler for " + str(self._device.getIP()) + " is closed.")
+
+        if not callable(getattr(self._device, methodName, None)):
+            raise AttributeError("Unknown Cryostream 800 command: " + methodName)
+
+        if priority is None:
+            priority = _defaultPriorities.get(methodName, PRIORITY_NORMAL)
+
+        key = _makeKey(methodName, args)
+
+        with self._inFlightLock:
+
+            # Single-flight: an identical command is already queued or running
+            if key in self._inFlight:
+                return self._inFlight[key]
+
+            future = CommandFuture(methodName, args)
+            self._inFlight[key] = future
+
+        with self._currentLock:
+
+            self._queue.put((priority, next(self._sequence), key, future))
+
+            # Stop and emergency commands pre-empt a slower command that is already running
+            # The running confirmation loop gives up at its next attempt (see Cryostream800.preempt)
+            if priority <= PRIORITY_STOP:
+                self._urgentPending.append(priority)
+                if self._currentPriority is not None and priority < self._currentPriority:
+                    self._device.preempt()
+
+        return future
+
+    # Shortcuts for the commands with confirmation
+    def cool(self, targetTemp):
+        return self.submit("coolWithConfirmation", targetTemp)
+
+    def restart(self):
+        return self.submit("restartWithConfirmation")
+
+    def stop(self):
+        return self.submit("stopWithConfirmation")
+
+    def setTurboMode(self, mode):
+        return self.submit("setTurboModeWithConfirmation", mode)
+
+    def setAutofillMode(self, mode):
+        return self.submit("setAutofillModeWithConfirmation", mode)
+
+    def anneal(self, temperature = 100.0, duration = 2.0):
+        return self.submit("anneal", temperature, duration)
+
+    # Number of commands waiting to be executed
+    def pending(self):
+        return self._queue.qsize()
+
+    # Stops the worker once the commands already queued are executed
+    def close(self, wait = True):
+        if not self._running:
+            return
+        self._running = False
+        # Sentinel, sorted after every real command
+        self._queue.put((float("inf"), next(self._sequence), None, None))
+        if wait:
+            self._worker.join()
+
+    # Executes commands one by one, in priority order
+    def _workerLoop(self):
+
+        while True:
+
+            priority, sequence, key, future = self._queue.get()
+
+            # Sentinel from close()
+            if key is None:
+                break
+
+            with self._currentLock:
+
+                if priority <= PRIORITY_STOP:
+                    self._urgentPending.remove(priority)
+
+                # A pre-emption request only applies to the command that was running at that time
+                # Cleared before the new command is published, a Stop submitted from now on pre-empts it
+                self._device.clearPreempt()
+
+                self._current         = key
+                self._currentPriority = priority
+
+                # A Stop queued while the worker was taking this command, before it was published
+                if self._urgentPending and min(self._urgentPending) < priority:
+                    self._device.preempt()
+
+            try:
+                method = getattr(self._device, future._methodName)
+                result = method(*future._args)
+            except Exception as e:
+                result = None
+                error  = e
+            else:
+                error  = None
+
+            # Removes from in-flight before completing, so a new identical request
+            # submitted from a callback issues a new command
+            with self._inFlightLock:
+                del self._inFlight[key]
+
+            with self._currentLock:
+                self._current         = None
+                self._currentPriority = None
+
+            if error is None:
+                future._setResult(result)
+            else:
+                future._setException(error)
+
+# Single-flight key of a command
+# Arguments are compared by value: numbers as floats (cool(100) and cool(100.0) are the same command),
+# lists and tuples alike, so arguments that cannot be hashed (e.g. profile steps) can be merged too
+def _makeKey(methodName, args):
+    return (methodName, json.dumps(_normalize(args), sort_keys = True, default = repr))
+
+# Returns the arguments with every number as a float and every sequence as a list
+def _normalize(value):
+    # bool is a number too, True and 1.0 are different commands
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, numbers.Real):
+        return float(value)
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return dict((str(k), _normalize(v)) for k, v in value.items())
+    return value
@@ -0,0 +1,361 @@
+from __future__ import print_function
+
+import argparse
+import mmap
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from cryostream_catalog import _arraySize, getPropertyId, getPropertyName, scaleValue
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Latest Cryostream 800 status in shared memory
+# One writer (the process that owns port 30304) keeps the last status in a memory-mapped file,
+# any number of local processes read it without sockets, without locks and without blocking the writer.
+#
+# Segment layout (native byte order):
+# [0:4]    Magic "CSHM"
+# [4:6]    Version
+# [6:8]    Number of slots
+# [8:12]   Sequence number (seqlock), odd while the writer updates the segment
+# [12:16]  Device IP (4 bytes, IPv4)
+# [16:24]  Receive timestamp (double, seconds since epoch)
+# [24:28]  Writer state: 1 while a writer publishes, 0 once it closed (or before the first writer)
+# [28:32]  Reserved
+# [32:]    One uint32 slot per property id: 32 + 4 * id, same index as the property table of cryostream_catalog
+#          Raw value of the property (0..65535), or 0xFFFFFFFF if the last packet did not have it
+#
+# Seqlock: the writer makes the sequence odd, copies the slots, then makes it even.
+# A reader reads the sequence, the slots it wants, and the sequence again, and retries if it was odd or changed.
+# The writer never waits for the readers, a reader only retries during the few microseconds of a copy.
+# The sequence and every slot are aligned 4-byte words, written with a single store by CPython on x86 and ARM64.
+#
+# The segment outlives its writer: a new writer (e.g. a restarted daemon) resets it in place, under an odd sequence,
+# and close() only marks it closed. A reader opened before the restart keeps the same file and sees the new status.
+#
+# Usage:
+# writer = SharedStatusWriter("121.223.76.47")       # In the process that owns port 30304
+# writer.publish(packet)
+# reader = SharedStatusReader("121.223.76.47")       # In every consumer process
+# reader.get("Sample temp")                          # 100.0 (K)
+# timestamp, status = reader.read(["Sample temp", "Run mode"])
+#
+# Command line:
+# python cryostream_shm.py publish --ip 121.223.76.47          # Standalone writer (the daemon does it with --shm)
+# python cryostream_shm.py read --ip 121.223.76.47 "Sample temp" "Run mode"
+
+_shmMagic   = b"CSHM"
+_shmVersion = 1
+_shmHeader  = struct.Struct("=4sHHI4sdI4x")
+
+_sequenceOffset = 8
+_sequence       = struct.Struct("=I")
+_stateOffset    = 24
+_state          = struct.Struct("=I")
+_slotsOffset    = _shmHeader.size
+_slot           = struct.Struct("=I")
+_slotCount      = _arraySize
+_segmentSize    = _slotsOffset + _slot.size * _slotCount
+
+# Value of a slot with no property in the last packet
+_absent = 0xFFFFFFFF
+
+# Writer state
+_writerClosed = 0
+_writerOpen   = 1
+
+# Maximum size of a status packet (same as the buffer in _getBinaryStatusPacket)
+_maxPacketSize = 8192
+
+# Default segment path of a device: /dev/shm (RAM) when it exists, the temporary directory otherwise
+def getSegmentPath(ip):
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, "cryostream-" + ip + ".shm")
+
+# Returns the property id of a name or id, KeyError if it has no slot
+def _getSlotId(prop):
+    propId = getPropertyId(prop)
+    if not isinstance(propId, int) or not 0 <= propId < _slotCount:
+        raise KeyError("Unknown property: " + str(prop))
+    return propId
+
+# Single writer of a status segment
+class SharedStatusWriter:
+
+    # Constructor
+    # Creates the segment of the device, or resets in place the segment left by a previous writer
+    def __init__(self, ip, path = None):
+
+        self._ip   = ip
+        self._path = path or getSegmentPath(ip)
+
+        # Slots of the last status, copied to the segment in one step by publish()
+        self._slots    = bytearray(_slot.pack(_absent) * _slotCount)
+        self._previous = []
+        self._sequence = 0
+
+        # A segment of another layout is replaced, its readers could not use the new one anyway
+        if not self._hasSegmentLayout():
+
+            # The segment is built in a temporary file and renamed, a reader never sees a half-written header
+            temporaryPath = self._path + ".tmp"
+            with open(temporaryPath, "wb") as segmentFile:
+                segmentFile.write(_shmHeader.pack(_shmMagic, _shmVersion, _slotCount, 0, socket.inet_aton(ip), 0.0, _writerClosed))
+                segmentFile.write(self._slots)
+
+            # os.rename does not replace an existing file on Windows
+            if os.name == "nt" and os.path.exists(self._path):
+                os.remove(self._path)
+
+            os.rename(temporaryPath, self._path)
+
+        self._file = open(self._path, "r+b")
+        self._map  = mmap.mmap(self._file.fileno(), _segmentSize)
+
+        # The sequence goes on from the previous writer, so readers see the reset as a new status
+        self._sequence = _sequence.unpack_from(self._map, _sequenceOffset)[0]
+
+        # Seqlock write of the whole segment: header of this writer, every slot absent
+        # A writer that died while copying left the sequence odd already
+        if not self._sequence & 1:
+            self._sequence += 1
+        _sequence.pack_into(self._map, _sequenceOffset, self._sequence & 0xFFFFFFFF)
+        self._map[0:_slotsOffset] = _shmHeader.pack(_shmMagic, _shmVersion, _slotCount, self._sequence & 0xFFFFFFFF,
+                                                    socket.inet_aton(ip), 0.0, _writerOpen)
+        self._map[_slotsOffset:_segmentSize] = bytes(self._slots)
+        self._sequence += 1
+        _sequence.pack_into(self._map, _sequenceOffset, self._sequence & 0xFFFFFFFF)
+
+    # Publishes one raw status packet
+    # packet: bytes, bytearray or memoryview with the raw status packet
+    # timestamp: receive time, now by default
+    def publish(self, packet, timestamp = None):
+
+        if timestamp is None:
+            timestamp = time.time()
+
+        count  = len(packet) // 4
+        values = struct.unpack_from(">" + str(2 * count) + "H", packet)
+
+        # Properties of the previous packet missing from this one are cleared
+        for propId in self._previous:
+            _slot.pack_into(self._slots, 4 * propId, _absent)
+
+        present = []
+        for i in range(0, 2 * count, 2):
+            propId = values[i]
+            if propId < _slotCount:
+                _slot.pack_into(self._slots, 4 * propId, values[i + 1])
+                present.append(propId)
+
+        self._previous = present
+
+        # Seqlock write: odd sequence, copy, even sequence
+        self._sequence += 1
+        _sequence.pack_into(self._map, _sequenceOffset, self._sequence & 0xFFFFFFFF)
+        struct.pack_into("=d", self._map, 16, timestamp)
+        self._map[_slotsOffset:_segmentSize] = bytes(self._slots)
+        self._sequence += 1
+        _sequence.pack_into(self._map, _sequenceOffset, self._sequence & 0xFFFFFFFF)
+
+    # Receives the status broadcasts of the device on port 30304 and publishes them until interrupted
+    def runListener(self, port = 30304):
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        s.bind(("0.0.0.0", port))
+        s.settimeout(1.0)
+
+        buf  = bytearray(_maxPacketSize)
+        view = memoryview(buf)
+
+        try:
+            while True:
+                try:
+                    size, address = s.recvfrom_into(buf)
+                except socket.timeout:
+                    continue
+                if address[0] == self._ip:
+                    self.publish(view[:size])
+        finally:
+            s.close()
+
+    # Returns the path of the segment
+    def getPath(self):
+        return self._path
+
+    # Marks the segment closed and unmaps it
+    # The file is kept, so readers keep their mapping and see the status of the next writer
+    def close(self):
+        _state.pack_into(self._map, _stateOffset, _writerClosed)
+        self._map.close()
+        self._file.close()
+
+    # True if the file at the path is a segment of this layout, which can be reset in place
+    def _hasSegmentLayout(self):
+
+        if not os.path.exists(self._path) or os.path.getsize(self._path) != _segmentSize:
+            return False
+
+        with open(self._path, "rb") as segmentFile:
+            magic, version, slotCount = _shmHeader.unpack(segmentFile.read(_shmHeader.size))[:3]
+
+        return magic == _shmMagic and version == _shmVersion and slotCount == _slotCount
+
+# Lock-free reader of a status segment, any number per machine
+class SharedStatusReader:
+
+    # Constructor
+    # ip: device IP, used to find the segment at its default path
+    # path: segment path, overrides ip
+    # timeout: longest time (s) a read retries while the writer updates the segment
+    def __init__(self, ip = None, path = None, timeout = 0.1):
+
+        self._path    = path or getSegmentPath(ip)
+        self._timeout = timeout
+
+        self._file = open(self._path, "rb")
+        self._map  = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+
+        magic, version, slotCount, sequence, ip, timestamp, state = _shmHeader.unpack_from(self._map, 0)
+        if magic != _shmMagic or version != _shmVersion or slotCount != _slotCount:
+            self.close()
+            raise IOError("Invalid status segment: " + self._path)
+
+        self._ip = socket.inet_ntoa(ip)
+
+    # Returns the IP of the device
+    def getIP(self):
+        return self._ip
+
+    # Returns True while a writer publishes to the segment, False once it closed
+    # The last status stays readable after the writer closed, its timestamp tells how old it is
+    def isWriterOpen(self):
+        return _state.unpack_from(self._map, _stateOffset)[0] == _writerOpen
+
+    # Returns the sequence number of the last complete status, it changes with every published packet
+    def getSequence(self):
+        return self._read(())[0]
+
+    # Returns the receive time of the last status, 0.0 if nothing was published yet
+    def getTimestamp(self):
+        return self._read(())[1]
+
+    # Returns the raw value of a property, by id (1051) or name ("Sample temp")
+    # Returns default if the property was not in the last packet
+    def getRaw(self, prop, default = None):
+        value = self._read((_getSlotId(prop),))[2][0]
+        if value == _absent:
+            return default
+        return value
+
+    # Returns the value of a property in its unit (K, K/h, bar, ...), see cryostream_catalog.scaleValue()
+    # Returns default if the property was not in the last packet
+    def get(self, prop, default = None):
+        propId = _getSlotId(prop)
+        value  = self._read((propId,))[2][0]
+        if value == _absent:
+            return default
+        return scaleValue(propId, value)
+
+    # Returns (timestamp, status) with the raw values of the properties asked, all from the same packet
+    # props: list of property ids or names, None returns every property of the last packet
+    # status keys are the property names, the numeric id for properties missing from the catalog
+    def read(self, props = None):
+
+        if props is None:
+            sequence, timestamp, values = self._read(None)
+            propIds = range(_slotCount)
+        else:
+            propIds = [_getSlotId(prop) for prop in props]
+            sequence, timestamp, values = self._read(propIds)
+
+        status = dict()
+        for propId, value in zip(propIds, values):
+            if value != _absent:
+                status[getPropertyName(propId) or propId] = value
+
+        return timestamp, status
+
+    # Unmaps the segment
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    # Seqlock read
+    # propIds: property ids to read, None copies every slot
+    # Returns (sequence, timestamp, values)
+    def _read(self, propIds):
+
+        deadline = None
+
+        while True:
+
+            sequence = _sequence.unpack_from(self._map, _sequenceOffset)[0]
+
+            if not sequence & 1:
+                timestamp = struct.unpack_from("=d", self._map, 16)[0]
+                if propIds is None:
+                    values = struct.unpack_from("=" + str(_slotCount) + "I", self._map, _slotsOffset)
+                else:
+                    values = [_slot.unpack_from(self._map, _slotsOffset + 4 * propId)[0] for propId in propIds]
+                if _sequence.unpack_from(self._map, _sequenceOffset)[0] == sequence:
+                    return sequence, timestamp, values
+
+            # The writer is copying, or died while copying
+            # sleep(0) gives the CPU (and the GIL) back, the writer may be a thread of this process
+            time.sleep(0)
+            if deadline is None:
+                deadline = time.time() + self._timeout
+            elif time.time() > deadline:
+                raise IOError("Status segment " + self._path + " is being written for too long, the writer may have died.")
+
+#=== Command line ===
+
+def _main(argv):
+
+    parser = argparse.ArgumentParser(description="Cryostream 800 status in shared memory")
+    subparsers = parser.add_subparsers(dest="action")
+
+    publishParser = subparsers.add_parser("publish", help="Publish the status broadcasts of a device")
+    publishParser.add_argument("--ip", required=True, help="IP of the Cryostream 800")
+    publishParser.add_argument("--path", default=None, help="Segment path (default: /dev/shm/cryostream-<ip>.shm)")
+
+    readParser = subparsers.add_parser("read", help="Print the last status")
+    readParser.add_argument("--ip", default=None, help="IP of the Cryostream 800")
+    readParser.add_argument("--path", default=None, help="Segment path (default: /dev/shm/cryostream-<ip>.shm)")
+    readParser.add_argument("fields", nargs="*", help="Property names, every property by default")
+
+    args = parser.parse_args(argv)
+
+    if args.action == "publish":
+        writer = SharedStatusWriter(args.ip, args.path)
+        print("Publishing the status of " + args.ip + " to " + writer.getPath())
+        try:
+            writer.runListener()
+        except KeyboardInterrupt:
+            print("Exiting program.")
+        finally:
+            writer.close()
+
+    elif args.action == "read":
+        if args.ip is None and args.path is None:
+            parser.error("read needs --ip or --path")
+        reader = SharedStatusReader(args.ip, args.path)
+        timestamp, status = reader.read(args.fields or None)
+        reader.close()
+        print("Status of " + reader.getIP() + ", " + "%.1f" % (time.time() - timestamp) + " s old")
+        for name in sorted(status, key = str):
+            print("  " + str(name) + ": " + str(scaleValue(getPropertyId(name), status[name])))
+
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    _main(sys.argv[1:])
@@ -0,0 +1,290 @@
+import struct
+import time
+
+from cryostream_catalog import getPropertyId, getPropertyName, getPropertyUnits, scaleValue, formatValue, getSubsystemIds
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Typed, unit-aware status snapshots of the Cryostream 800
+# A snapshot keeps the raw status packet and decodes a field only when it is read,
+# converting it to the units shown to the user (OxcryoProperties.xml "outputunits"), e.g. "Sample temp" in K, not cK.
+# Snapshots are immutable and small (__slots__ plus the raw packet), so thousands can be kept for windowed analysis.
+#
+# Usage:
+# snapshot = cryostream.getSnapshot()
+# snapshot.get("Sample temp")      # 100.25 (K)
+# snapshot.getRaw("Sample temp")   # 10025  (cK, as broadcast)
+# snapshot.getUnits("Sample temp") # "K"
+# snapshot.getText("Run mode")     # "Running"
+# snapshot.getSubsystem("CD")      # every Cryodrive field, name -> value
+# snapshot.getAge()                # seconds since the packet was received
+
+# Names, units and conversions of the properties are in cryostream_catalog
+
+# Byte offsets of every property inside a status packet
+# The status packet is a sequence of 4 byte groups: 2 bytes property id, 2 bytes value (see _parseBinaryStatusPacket)
+# The order of the groups does not change between packets of the same device, so the offsets are computed once
+# and only recomputed when the packet length or the id found at a known offset changes.
+class PacketLayout:
+
+    # Constructor
+    def __init__(self):
+        self._offsets = dict()
+        self._length  = -1
+
+    # Recomputes the offsets from a packet if the layout changed
+    # Returns True if the layout was (re)built
+    def learn(self, packet):
+
+        if len(packet) == self._length and self._offsets:
+            return False
+
+        offsets = dict()
+        for offset in range(0, len(packet) - (len(packet) % 4), 4):
+            propId = struct.unpack_from(">H", packet, offset)[0]
+            offsets[propId] = offset
+
+        self._offsets = offsets
+        self._length  = len(packet)
+
+        return True
+
+    # Forgets the offsets, the next learn() rebuilds them
+    def invalidate(self):
+        self._length = -1
+
+    # Sets offsets learned earlier (e.g. read from the status cache, cryostream_cache.py)
+    # readRaw() still checks every id, a layout that no longer matches the packets is relearned
+    def restore(self, length, offsets):
+        self._offsets = dict(offsets)
+        self._length  = length
+
+    # Returns the length of the packets the offsets were learned from, -1 if none
+    def getLength(self):
+        return self._length
+
+    # Returns the offset of a property id, or None if it is not in the packet
+    def getOffset(self, propId):
+        return self._offsets.get(propId)
+
+    # Returns the list of property ids in the packet
+    def getIds(self):
+        return list(self._offsets.keys())
+
+    # Returns the raw value of a property in a packet, or None if it is not in the packet
+    # Checks the id at the offset and relearns the layout if the device changed the order of the fields
+    def readRaw(self, packet, propId):
+
+        offset = self._offsets.get(propId)
+
+        if offset is None:
+            return None
+
+        if struct.unpack_from(">H", packet, offset)[0] != propId:
+            self.invalidate()
+            self.learn(packet)
+            offset = self._offsets.get(propId)
+            if offset is None:
+                return None
+
+        return struct.unpack_from(">H", packet, offset + 2)[0]
+
+# Compiled accessor for a fixed set of fields
+# The offsets of the fields, learned from the packet, are compiled into a single struct format
+# (padding bytes between them), so one struct.unpack_from call reads the id and the value of every field asked.
+# The ids read are compared with the ids expected, the packet is scanned again only when the layout changes.
+# Meant for monitors that watch a few fields of many devices, the rest of the packet is never decoded.
+#
+# Usage:
+# projection = FieldProjection(["Sample temp", "Run mode"])
+# sampleTemp, runMode = projection.read(packet)   # Raw values, None if the packet does not have the field
+# projection.readValues(packet)                   # Values in output units (K, ...)
+class FieldProjection:
+
+    # Constructor
+    # fields: property names ("Sample temp") or ids (1051), in the order the values are returned
+    def __init__(self, fields):
+
+        self._fields = list(fields)
+        self._ids    = [getPropertyId(field) for field in self._fields]
+
+        # Compiled for packets of this length: struct format, ids expected, position of each value (None if absent)
+        self._length    = -1
+        self._struct    = None
+        self._expected  = None
+        self._positions = None
+
+        # Number of times the layout was learned
+        self._compilations = 0
+
+    # Returns the raw values of the fields, as broadcast (unsigned 16 bit), None for a field missing from the packet
+    def read(self, packet):
+
+        if len(packet) != self._length:
+            self._compile(packet)
+
+        words = self._struct.unpack_from(packet)
+
+        # Same length, different order: the device changed the layout
+        if words[0::2] != self._expected:
+            self._compile(packet)
+            words = self._struct.unpack_from(packet)
+
+        return tuple(None if position is None else words[position] for position in self._positions)
+
+    # Returns the values of the fields in their output units (K, K/h, ...), None for a field missing from the packet
+    def readValues(self, packet):
+        return tuple(None if raw is None else scaleValue(propId, raw) for propId, raw in zip(self._ids, self.read(packet)))
+
+    # Returns the raw values of the fields, field -> value
+    def readDict(self, packet):
+        return dict(zip(self._fields, self.read(packet)))
+
+    # Returns the fields, in the order of the values
+    def getFields(self):
+        return list(self._fields)
+
+    # Returns the number of times the layout was learned (1 for a device that never changes it)
+    def getCompilations(self):
+        return self._compilations
+
+    # Full scan of the packet, then one struct format for the fields found in it
+    def _compile(self, packet):
+
+        layout = PacketLayout()
+        layout.learn(packet)
+
+        found = sorted((layout.getOffset(propId), propId) for propId in set(self._ids) if layout.getOffset(propId) is not None)
+
+        fmt      = ">"
+        position = 0
+        index    = dict()
+        for count, (offset, propId) in enumerate(found):
+            if offset > position:
+                fmt += str(offset - position) + "x"
+            fmt += "HH"
+            position = offset + 4
+            index[propId] = 2 * count + 1
+
+        self._struct    = struct.Struct(fmt)
+        self._expected  = tuple(propId for offset, propId in found)
+        self._positions = [index.get(propId) for propId in self._ids]
+        self._length    = len(packet)
+
+        self._compilations += 1
+
+# Returns a property of a status in output units (K, bar, ...), None if it is not in the status
+# status: StatusSnapshot, already in output units, or dict / StatusPacketView with the values as broadcast (cK, dbar, ...)
+# The analyzers take live snapshots, recordings (cryostream_export.readRecording()) and fan-out views alike
+def readStatusValue(status, prop):
+
+    if isinstance(status, StatusSnapshot):
+        return status.get(prop)
+
+    raw = status.get(prop)
+    return None if raw is None else scaleValue(getPropertyId(prop), raw)
+
+# Immutable status snapshot, decoded lazily from the raw packet
+# Inherits from object because __slots__ needs a new-style class on Python 2.7
+class StatusSnapshot(object):
+
+    __slots__ = ("_packet", "_layout", "_timestamp", "_ip")
+
+    # Constructor
+    # packet: raw status packet (bytes), as received from the network
+    # timestamp: time.time() when the packet was received
+    # layout: PacketLayout shared by every snapshot of the same device
+    # ip: IP of the device
+    def __init__(self, packet, timestamp, layout, ip = None):
+
+        # Copied, so the snapshot does not depend on a receive buffer that will be reused
+        # memoryview.tobytes() works on Python 2.7 and 3, bytes(memoryview) does not on Python 2.7
+        if isinstance(packet, memoryview):
+            packet = packet.tobytes()
+
+        object.__setattr__(self, "_packet", bytes(packet))
+        object.__setattr__(self, "_layout", layout)
+        object.__setattr__(self, "_timestamp", timestamp)
+        object.__setattr__(self, "_ip", ip)
+
+        layout.learn(self._packet)
+
+    # Snapshots are immutable
+    def __setattr__(self, name, value):
+        raise AttributeError("StatusSnapshot is immutable.")
+
+    def __repr__(self):
+        return "StatusSnapshot(ip=" + str(self._ip) + ", timestamp=" + str(self._timestamp) + ", fields=" + str(len(self._layout.getIds())) + ")"
+
+    # Returns the value of a property in its output units, by name ("Sample temp") or id (1051)
+    # Returns default if the property is not in the packet
+    def get(self, prop, default = None):
+        propId = getPropertyId(prop)
+        raw    = self._layout.readRaw(self._packet, propId)
+        if raw is None:
+            return default
+        return scaleValue(propId, raw)
+
+    # Returns the value of a property exactly as broadcast by the device (unsigned 16 bit)
+    def getRaw(self, prop, default = None):
+        raw = self._layout.readRaw(self._packet, getPropertyId(prop))
+        if raw is None:
+            return default
+        return raw
+
+    # Returns the output units of a property, e.g. "K" for "Sample temp"
+    def getUnits(self, prop):
+        return getPropertyUnits(prop)
+
+    # Returns a property as text: the label of an enumeration ("Running"), or the value with its units ("100.25 K")
+    def getText(self, prop, default = None):
+        propId = getPropertyId(prop)
+        raw    = self._layout.readRaw(self._packet, propId)
+        if raw is None:
+            return default
+        return formatValue(propId, raw)
+
+    # Returns the fields of a subsystem in the packet ("FC", "CD", "PU", "AF", "DAU", ...), name -> value in output units
+    def getSubsystem(self, subsystem):
+        values = dict()
+        for propId in getSubsystemIds(subsystem):
+            raw = self._layout.readRaw(self._packet, propId)
+            if raw is not None:
+                values[getPropertyName(propId)] = scaleValue(propId, raw)
+        return values
+
+    def __getitem__(self, prop):
+        value = self.get(prop)
+        if value is None:
+            raise KeyError(prop)
+        return value
+
+    def __contains__(self, prop):
+        return self._layout.getOffset(getPropertyId(prop)) is not None
+
+    # Returns the time.time() value when the packet was received
+    def getTimestamp(self):
+        return self._timestamp
+
+    # Returns the seconds since the packet was received
+    def getAge(self):
+        return time.time() - self._timestamp
+
+    # Returns the IP of the device
+    def getIP(self):
+        return self._ip
+
+    # Returns the raw status packet
+    def getPacket(self):
+        return self._packet
+
+    # Returns the ids of the properties in the packet
+    def getIds(self):
+        return self._layout.getIds()
+
+    # Decodes every field, name (or id if unknown) -> value in output units
+    # Useful to export, not meant for the hot path
+    def toDict(self):
+        return dict((getPropertyName(propId) or propId, self.get(propId)) for propId in self._layout.getIds())
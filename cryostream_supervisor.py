@@ -0,0 +1,83 @@
+import threading
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Supervisor for long-running loops (status listeners, fan-out, ...)
+# Runs a function in a background thread and restarts it when it raises, with a growing wait between restarts.
+# A stray packet or a network hiccup costs one restart, not the whole process.
+#
+# Usage:
+# supervisor = SupervisedThread("CryostreamListener", listenOnce)
+# supervisor.start()
+# ...
+# supervisor.stop()
+class SupervisedThread:
+
+    # Constructor
+    # name: thread name, used in the messages
+    # step: function called over and over while the supervisor runs, one unit of work per call
+    # minBackoff, maxBackoff: wait (s) after the first failure, and the longest wait after many failures in a row
+    def __init__(self, name, step, minBackoff = 0.5, maxBackoff = 30.0):
+
+        self._name       = name
+        self._step       = step
+        self._minBackoff = minBackoff
+        self._maxBackoff = maxBackoff
+
+        # Restarts and last error, useful to monitor the service
+        self._restarts  = 0
+        self._lastError = None
+
+        self._running = False
+        self._stopped = threading.Event()
+        self._thread  = None
+
+    # Starts the background thread
+    def start(self):
+        self._running = True
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=self._name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Asks the thread to stop after the current step
+    def stop(self, timeout = None):
+        self._running = False
+        self._stopped.set()
+        if self._thread is not None and _canJoin(self._thread):
+            self._thread.join(timeout)
+
+    # Returns True while the supervisor is running
+    def isRunning(self):
+        return self._running
+
+    # Returns the number of restarts since start()
+    def getRestarts(self):
+        return self._restarts
+
+    # Returns the last exception raised by the step function (or None)
+    def getLastError(self):
+        return self._lastError
+
+    def _run(self):
+
+        backoff = self._minBackoff
+
+        while self._running:
+
+            try:
+                self._step()
+                backoff = self._minBackoff
+            except Exception as e:
+                self._restarts += 1
+                self._lastError = e
+                print(self._name + " failed (" + type(e).__name__ + ": " + str(e) + "), restarting in " + str(backoff) + " s.")
+                # Interrupted early by stop()
+                self._stopped.wait(backoff)
+                backoff = min(self._maxBackoff, backoff * 2)
+
+# A thread cannot join itself, stop() may be called from the step function
+def _canJoin(thread):
+    return thread is not threading.current_thread()
@@ -0,0 +1,99 @@
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Trends fitted on a stream of samples, in a single pass and with constant memory
+# Used by the maintenance forecasts (cryostream_maintenance.py) and by the device clock drift (cryostream_clock.py)
+#
+# Usage:
+# trend = LinearTrend(halfLife = 86400.0)
+# trend.add(timestamp, pressure)
+# trend.getSlope()                             # Pressure per second
+# trend.getCrossing(15.0)                      # Timestamp the fitted line reaches 15.0, None if it moves away
+
+# Straight line y = a + b * x fitted by least squares, with exponential forgetting
+# Only five sums are kept, whatever the number of samples
+class LinearTrend:
+
+    # Constructor
+    # halfLife: a sample weighs half as much after halfLife (x units), None keeps every sample at full weight
+    def __init__(self, halfLife = None):
+
+        self._halfLife = halfLife
+
+        # x is stored relative to the first sample, so the sums keep their precision with epoch timestamps
+        self._origin = None
+        self._lastX  = None
+
+        self._count = 0
+        self._sw    = 0.0
+        self._sx    = 0.0
+        self._sy    = 0.0
+        self._sxx   = 0.0
+        self._sxy   = 0.0
+
+    # Adds a sample, x must not go backwards
+    def add(self, x, y):
+
+        if self._origin is None:
+            self._origin = x
+            self._lastX  = x
+
+        if self._halfLife is not None and x > self._lastX:
+            decay = 0.5 ** ((x - self._lastX) / self._halfLife)
+            self._sw  *= decay
+            self._sx  *= decay
+            self._sy  *= decay
+            self._sxx *= decay
+            self._sxy *= decay
+
+        self._lastX = max(self._lastX, x)
+
+        x = x - self._origin
+
+        self._count += 1
+        self._sw    += 1.0
+        self._sx    += x
+        self._sy    += y
+        self._sxx   += x * x
+        self._sxy   += x * y
+
+    # Number of samples added
+    def getCount(self):
+        return self._count
+
+    # Slope (y per x unit), None until the samples span some x
+    def getSlope(self):
+
+        denominator = self._sw * self._sxx - self._sx * self._sx
+
+        if self._count < 2 or denominator <= 1e-12 * max(1.0, self._sw * self._sxx):
+            return None
+
+        return (self._sw * self._sxy - self._sx * self._sy) / denominator
+
+    # Fitted value at x, None without a slope
+    def getValue(self, x):
+
+        slope = self.getSlope()
+
+        if slope is None:
+            return None
+
+        intercept = (self._sy - slope * self._sx) / self._sw
+
+        return intercept + slope * (x - self._origin)
+
+    # x where the fitted line reaches the threshold, in the future of the last sample
+    # None if the line moves away from the threshold or is flat
+    def getCrossing(self, threshold):
+
+        slope = self.getSlope()
+
+        if slope is None or slope == 0.0:
+            return None
+
+        current = self.getValue(self._lastX)
+        crossing = self._lastX + (threshold - current) / slope
+
+        return max(crossing, self._lastX) if (threshold - current) / slope >= 0 else None
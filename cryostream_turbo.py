@@ -0,0 +1,401 @@
+from __future__ import print_function
+
+import argparse
+import time
+
+from cryostream_snapshot import readStatusValue
+from cryostream_supervisor import SupervisedThread
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Automatic turbo mode of the Cryostream 800, driven by the thermal load seen in the status
+# Turbo (more gas flow) brings the sample to the target faster, but uses more nitrogen.
+# TurboPolicy watches "Sample temp" (and its slope), "Target temp", "Temp error" and "Gas heat" and decides:
+# - Turbo on after a large setpoint change, or when the sample is far from the target (e.g. after a sample mount)
+# - Turbo off once the sample is close to the target and its temperature no longer moves,
+#   or at once when the gas heater burns the extra flow (gas heat high while on target)
+# Hysteresis keeps it from flapping: the "on" distance is larger than the "off" distance,
+# and turbo stays on (off) for a minimum time after each change.
+# When "Turbo mode" is 2 or 3 the device is in control, and the policy does nothing.
+#
+# TurboController runs the policy on a live device, through setTurboModeWithConfirmation()
+# (or a CommandScheduler, at low priority, so user commands go first).
+# benchmarkPolicy() replays a recorded session through the policy, to tune it before it touches a device.
+#
+# Usage:
+# controller = TurboController(cryostream, TurboPolicy(onError = 5.0, offError = 1.0))
+# controller.start()
+# ...
+# controller.stop()
+#
+# Command line:
+# python cryostream_turbo.py run 10.0.0.5 --dry-run
+# python cryostream_turbo.py bench /data/10.0.0.5.csr
+
+# "Run mode" value while running (see _buildOxCryoEnumsInline())
+_runModeRunning = 3
+
+# "Turbo mode" values
+_turboOff = 0
+_turboOn  = 1
+
+#==============
+#=== Policy ===
+#==============
+
+# Decides when turbo should be on, from one status at a time
+class TurboPolicy:
+
+    # Constructor
+    # onStep: a change of the target temperature of at least onStep (K) turns turbo on
+    # onError: the sample at least onError (K) away from the target turns turbo on
+    # offError: turbo may go off once the sample is within offError (K) of the target
+    # stableSlope: ... and the sample temperature changes by less than stableSlope (K/min)
+    # stableTime: ... for stableTime seconds
+    # slopeTime: seconds over which the sample temperature slope is smoothed
+    # offGasHeat: turbo goes off at once, within offError of the target, if "Gas heat" is above offGasHeat (%)
+    #             the heater is burning the extra flow, None disables it
+    # minOnTime, minOffTime: seconds turbo stays on (off) after a change, whatever the status
+    # maxOnTime: turbo goes off after maxOnTime seconds even if not stable, None for no limit
+    def __init__(self, onStep = 20.0, onError = 5.0, offError = 1.0, stableSlope = 0.5, stableTime = 60.0, slopeTime = 30.0,
+                 offGasHeat = None, minOnTime = 60.0, minOffTime = 30.0, maxOnTime = 1800.0):
+
+        if offError >= onError:
+            raise ValueError("offError must be smaller than onError, otherwise turbo flaps.")
+
+        self._onStep      = onStep
+        self._onError     = onError
+        self._offError    = offError
+        self._stableSlope = stableSlope
+        self._stableTime  = stableTime
+        self._slopeTime   = slopeTime
+        self._offGasHeat  = offGasHeat
+        self._minOnTime   = minOnTime
+        self._minOffTime  = minOffTime
+        self._maxOnTime   = maxOnTime
+
+        # Last turbo mode seen or decided, and when it changed
+        self._turbo       = None
+        self._changedAt   = None
+
+        self._lastTarget  = None
+        self._lastTime    = None
+        self._lastSample  = None
+        self._slope       = None
+        self._stableSince = None
+
+        # Reason of the last decision, shown to the operator
+        self._reason      = None
+
+    # Decides from one status
+    # timestamp: seconds
+    # status: StatusSnapshot, or dict or StatusPacketView with raw values, as broadcast by the device
+    # turboMode: current turbo mode, None reads "Turbo mode" from the status
+    # Returns 1 (turn turbo on), 0 (turn it off) or None (nothing to do)
+    def decide(self, timestamp, status, turboMode = None):
+
+        if turboMode is None:
+            turboMode = status.get("Turbo mode")
+
+        sample = self._get(status, "Sample temp")
+        target = self._get(status, "Target temp")
+
+        if sample is None or target is None or turboMode is None:
+            return None
+
+        self._updateSlope(timestamp, sample)
+
+        targetStep = abs(target - self._lastTarget) if self._lastTarget is not None else 0.0
+        self._lastTarget = target
+
+        # The device is in control (2, 3), or not running: the policy starts again from what it sees
+        if turboMode not in (_turboOff, _turboOn) or status.get("Run mode") != _runModeRunning:
+            self._setTurbo(timestamp, None)
+            return None
+
+        if turboMode != self._turbo:
+            self._setTurbo(timestamp, turboMode)
+
+        # "Temp error" follows the ramp, the distance to the target tells how far the sample still has to go
+        distance = max(abs(sample - target), abs(self._getTempError(status)))
+        onFor    = timestamp - self._changedAt
+
+        if self._turbo == _turboOff:
+
+            if onFor < self._minOffTime:
+                return None
+
+            if targetStep >= self._onStep:
+                return self._decide(timestamp, _turboOn, "target changed by " + str(round(targetStep, 1)) + " K")
+
+            if distance >= self._onError:
+                return self._decide(timestamp, _turboOn, "sample " + str(round(distance, 1)) + " K from the target")
+
+            return None
+
+        # Turbo on
+        if onFor < self._minOnTime:
+            return None
+
+        if self._maxOnTime is not None and onFor >= self._maxOnTime:
+            return self._decide(timestamp, _turboOff, "on for " + str(int(onFor)) + " s")
+
+        if distance > self._offError:
+            self._stableSince = None
+            return None
+
+        gasHeat = self._get(status, "Gas heat")
+        if self._offGasHeat is not None and gasHeat is not None and gasHeat > self._offGasHeat:
+            return self._decide(timestamp, _turboOff, "gas heat " + str(gasHeat) + " %, flow not needed")
+
+        if self._slope is None or abs(self._slope) > self._stableSlope:
+            self._stableSince = None
+            return None
+
+        if self._stableSince is None:
+            self._stableSince = timestamp
+
+        if timestamp - self._stableSince >= self._stableTime:
+            return self._decide(timestamp, _turboOff, "stable within " + str(self._offError) + " K")
+
+        return None
+
+    # Returns the reason of the last decision
+    def getReason(self):
+        return self._reason
+
+    # Returns the sample temperature slope (K/min), None until two samples were seen
+    def getSlope(self):
+        return self._slope
+
+    def _decide(self, timestamp, mode, reason):
+        self._setTurbo(timestamp, mode)
+        self._reason = reason
+        return mode
+
+    def _setTurbo(self, timestamp, mode):
+        self._turbo       = mode
+        self._changedAt   = timestamp
+        self._stableSince = None
+
+    # Sample temperature slope (K/min), smoothed over slopeTime so one noisy sample does not reset stability
+    def _updateSlope(self, timestamp, sample):
+
+        if self._lastTime is not None and timestamp > self._lastTime:
+            slope  = (sample - self._lastSample) / (timestamp - self._lastTime) * 60.0
+            weight = min(1.0, (timestamp - self._lastTime) / self._slopeTime)
+            self._slope = slope if self._slope is None else self._slope + weight * (slope - self._slope)
+
+        self._lastTime   = timestamp
+        self._lastSample = sample
+
+    def _get(self, status, name):
+        return readStatusValue(status, name)
+
+    # "Temp error" in K, 0 if not broadcast
+    def _getTempError(self, status):
+        tempError = self._get(status, "Temp error")
+        return 0.0 if tempError is None else tempError / 100.0
+
+#==================
+#=== Controller ===
+#==================
+
+# Runs a TurboPolicy on a live device
+class TurboController:
+
+    # Constructor
+    # cryostream: Cryostream800 object
+    # policy: TurboPolicy, default settings if None
+    # scheduler: optional CommandScheduler of the device, status reads and commands then go through it at low priority
+    # dryRun: decisions are printed but not sent, to try a policy next to an operator
+    def __init__(self, cryostream, policy = None, scheduler = None, dryRun = False):
+
+        self._cryostream = cryostream
+        self._policy     = policy if policy is not None else TurboPolicy()
+        self._scheduler  = scheduler
+        self._dryRun     = dryRun
+
+        # (time, mode, reason, confirmed) of every decision
+        self._actions = []
+
+        self._supervisor = SupervisedThread("CryostreamTurbo-" + str(cryostream.getIP()), self.step)
+
+    # Starts deciding in the background, once per status broadcast
+    def start(self):
+        self._supervisor.start()
+
+    # Stops deciding, turbo is left as it is
+    def stop(self):
+        self._supervisor.stop(timeout = 10.0)
+
+    # Reads one status and applies the decision, called over and over by start()
+    def step(self):
+
+        if self._scheduler is not None:
+            from cryostream_scheduler import PRIORITY_LOW
+            self._scheduler.submit("refreshStatus", priority = PRIORITY_LOW).result()
+        else:
+            self._cryostream.refreshStatus()
+
+        status = self._cryostream.getLastStatus()[0]
+        mode   = self._policy.decide(time.time(), status)
+
+        if mode is None:
+            return
+
+        reason = self._policy.getReason()
+        print("Turbo " + ("on" if mode == _turboOn else "off") + ": " + reason + (" (dry run)" if self._dryRun else ""))
+
+        if self._dryRun:
+            confirmed = None
+        elif self._scheduler is not None:
+            from cryostream_scheduler import PRIORITY_LOW
+            confirmed = self._scheduler.submit("setTurboModeWithConfirmation", mode, priority = PRIORITY_LOW).result()
+        else:
+            confirmed = self._cryostream.setTurboModeWithConfirmation(mode)
+
+        self._actions.append((time.time(), mode, reason, confirmed))
+
+    # Returns the decisions taken, as (time, mode, reason, confirmed), confirmed is None in dry run
+    def getActions(self):
+        return list(self._actions)
+
+#=================
+#=== Benchmark ===
+#=================
+
+# Replays a recorded session through a policy
+# history: iterable of (timestamp, status), e.g. cryostream_export.readRecording()
+# The device of the recording did not follow the policy, so the figures compare what the policy would have
+# asked for with what was recorded, for each setpoint change (cryostream_analytics.py):
+# Returns {"switches", "switchesPerHour", "policyTurboTime", "recordedTurboTime", "duration", "events"}
+# "events": one dictionary per setpoint change, the analytics figures plus the turbo seconds of both
+def benchmarkPolicy(history, policy = None):
+
+    from cryostream_analytics import SetpointAnalyzer
+
+    if policy is None:
+        policy = TurboPolicy()
+
+    analyzer = SetpointAnalyzer()
+    events   = []
+
+    # Turbo mode the policy would have set, and seconds of turbo in the current event
+    simulated     = None
+    switches      = 0
+    policyTime    = 0.0
+    recordedTime  = 0.0
+    eventPolicy   = 0.0
+    eventRecorded = 0.0
+
+    firstTime = None
+    lastTime  = None
+
+    def closeEvent(event):
+        figures = event.toDict()
+        figures["policyTurboTime"]   = eventPolicy
+        figures["recordedTurboTime"] = eventRecorded
+        events.append(figures)
+
+    for timestamp, status in history:
+
+        recorded = status.get("Turbo mode")
+
+        # Until the policy decides, it keeps the recorded mode, the device in control is followed as recorded
+        if simulated is None or recorded not in (_turboOff, _turboOn):
+            simulated = recorded
+
+        if lastTime is not None:
+            elapsed = timestamp - lastTime
+            if simulated in (_turboOn, 2, 3):
+                policyTime  += elapsed
+                eventPolicy += elapsed
+            if recorded in (_turboOn, 2, 3):
+                recordedTime  += elapsed
+                eventRecorded += elapsed
+        else:
+            firstTime = timestamp
+
+        lastTime = timestamp
+
+        mode = policy.decide(timestamp, status, simulated)
+        if mode is not None:
+            simulated = mode
+            switches += 1
+
+        event = analyzer.add(timestamp, status)
+        if event is not None:
+            closeEvent(event)
+            eventPolicy   = 0.0
+            eventRecorded = 0.0
+
+    event = analyzer.finish()
+    if event is not None:
+        closeEvent(event)
+
+    duration = (lastTime - firstTime) if lastTime is not None else 0.0
+
+    return {
+        "switches":          switches,
+        "switchesPerHour":   switches * 3600.0 / duration if duration > 0 else None,
+        "policyTurboTime":   policyTime,
+        "recordedTurboTime": recordedTime,
+        "duration":          duration,
+        "events":            events,
+    }
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Cryostream automatic turbo mode")
+    parser.add_argument("--on-step", type=float, default=20.0, help="Target change (K) that turns turbo on")
+    parser.add_argument("--on-error", type=float, default=5.0, help="Distance to the target (K) that turns turbo on")
+    parser.add_argument("--off-error", type=float, default=1.0, help="Distance to the target (K) below which turbo may go off")
+    parser.add_argument("--stable-time", type=float, default=60.0, help="Seconds stable before turbo goes off")
+    parser.add_argument("--off-gas-heat", type=float, default=None, help="Gas heat (%%) that turns turbo off on target")
+    parser.add_argument("--max-on-time", type=float, default=1800.0, help="Longest time (s) with turbo on")
+
+    commands = parser.add_subparsers(dest="command")
+
+    runParser = commands.add_parser("run", help="Control turbo on a device until Ctrl+C")
+    runParser.add_argument("ip")
+    runParser.add_argument("--dry-run", action="store_true", help="Print the decisions, do not send them")
+
+    benchParser = commands.add_parser("bench", help="Replay a recording (cryostream_export.py) through the policy")
+    benchParser.add_argument("recording")
+
+    args = parser.parse_args()
+
+    policy = TurboPolicy(onStep = args.on_step, onError = args.on_error, offError = args.off_error,
+                         stableTime = args.stable_time, offGasHeat = args.off_gas_heat, maxOnTime = args.max_on_time)
+
+    if args.command == "run":
+
+        from cryostream800 import Cryostream800
+
+        controller = TurboController(Cryostream800(args.ip), policy, dryRun = args.dry_run)
+        controller.start()
+
+        try:
+            while True:
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            controller.stop()
+
+    elif args.command == "bench":
+
+        from cryostream_export import readRecording
+
+        result = benchmarkPolicy(readRecording(args.recording), policy)
+
+        for event in result["events"]:
+            print("Target " + str(event["targetTemp"]) + " K: settling " + str(event["settlingTime"]) + " s, turbo " +
+                  str(int(event["policyTurboTime"])) + " s (policy) / " + str(int(event["recordedTurboTime"])) + " s (recorded)")
+
+        print("Turbo " + str(int(result["policyTurboTime"])) + " s (policy) / " + str(int(result["recordedTurboTime"])) +
+              " s (recorded) over " + str(int(result["duration"])) + " s, " + str(result["switches"]) + " switches")
+
+    else:
+        parser.print_help()
@@ -0,0 +1,270 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+from cryostream800 import Cryostream800
+from cryostream_errors import ForeignSourceError, InvalidCommandError, MalformedPacketError, StatusTimeout
+from cryostream_export import StatusRecorder, readRecordedPackets
+from cryostream_fleet import makeStatusPacket
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Tests of the bytes-native packet handling of Cryostream800 (Python 2.7 and Python 3)
+# Status packets are recorded to a file (cryostream_export.py) and replayed through a transport,
+# so the driver decodes them exactly as it decodes the broadcasts of a device.
+#
+# Usage:
+# python -m pytest -q test_cryostream800.py
+
+# IP of the replayed device
+_ip = "10.0.0.6"
+
+# Raw status of a device ready to cool: limits 80 K - 400 K, sample at 295 K, Temp error -150 (two's complement)
+_readyFields = {1002: 8000, 1003: 40000, 1050: 29500, 1051: 29500, 1052: -150, 1053: 2, 1054: 1, 1056: 29500}
+
+#=================
+#=== Transport ===
+#=================
+
+# Transport of a Cryostream800 that replays recorded packets, then broadcasts a live status
+# Commands are recorded, a Cool command changes the live status the way the device would
+class _ReplayTransport:
+
+    # Constructor
+    # records: (timestamp, packet) read from a recording, handed over first
+    # fields: raw status broadcast once the records are replayed, None raises StatusTimeout instead
+    # sequence: packet id of the first live packet, after the ids of the records
+    # coolCode: command id of Cool, None ignores every command
+    # silentAfter: live packets broadcast after the last command before the device goes silent, None never
+    def __init__(self, records, fields = None, sequence = 100, coolCode = None, silentAfter = None):
+        self._records     = list(records)
+        self._fields      = fields
+        self._sequence    = sequence
+        self._coolCode    = coolCode
+        self._silentAfter = silentAfter
+        self._sentAfter   = 0
+        self.commands     = []
+
+    def waitForStampedPacket(self, ip, deadline = None):
+
+        if self._records:
+            timestamp, packet = self._records.pop(0)
+            return packet, timestamp
+
+        if self._fields is None:
+            raise StatusTimeout(ip, deadline)
+
+        if self._silentAfter is not None and self.commands:
+            if self._sentAfter >= self._silentAfter:
+                raise StatusTimeout(ip, deadline)
+            self._sentAfter += 1
+
+        # A broadcast every 10 ms, instead of every second
+        time.sleep(0.01)
+        self._sequence += 1
+        return makeStatusPacket(sorted(self._fields.items()), self._sequence), time.time()
+
+    def sendCommand(self, packet, address):
+
+        self.commands.append((packet, address))
+        self._sentAfter = 0
+
+        command, param1, param2 = struct.unpack(">HHH", packet[:6])
+        if command == self._coolCode and self._fields is not None:
+            self._fields[1056] = param1
+            self._fields[1053] = 3
+
+# Broadcasts status packets to the status port (30304) on loopback, as several devices on a subnetwork
+# Each round sends one packet from every foreign IP, then one from the device IP (None for no device)
+class _LoopbackSubnetwork:
+
+    # Constructor
+    # foreignIPs: loopback IPs of the other devices, e.g. "127.0.0.2"
+    # deviceIP: loopback IP of the device, None if it is silent
+    def __init__(self, foreignIPs, deviceIP = None):
+
+        self._sockets = []
+        for ip in list(foreignIPs) + ([deviceIP] if deviceIP else []):
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.bind((ip, 0))
+            self._sockets.append(sender)
+
+        self._stopped = threading.Event()
+        self._thread  = threading.Thread(target = self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exception):
+        self._stopped.set()
+        self._thread.join()
+        for sender in self._sockets:
+            sender.close()
+
+    def _run(self):
+
+        sequence = 0
+        while not self._stopped.is_set():
+            sequence += 1
+            for sender in self._sockets:
+                sender.sendto(makeStatusPacket(sorted(_readyFields.items()), sequence), ("127.0.0.1", 30304))
+            time.sleep(0.005)
+
+# Records raw status packets to a file and reads them back, as recordDevice() and readRecordedPackets() do
+def _recordPackets(path, packets, startTime = 1700000000.0):
+
+    recorder = StatusRecorder(path)
+    for index, packet in enumerate(packets):
+        recorder.record(packet, startTime + index)
+    recorder.close()
+
+    return list(readRecordedPackets(path))
+
+# Returns a Cryostream800 that read its first status from the records
+def _replay(records, **options):
+    return Cryostream800(_ip, transport = _ReplayTransport(records, **options))
+
+#===============
+#=== Parsing ===
+#===============
+
+def test_parse_gives_same_fields_for_every_buffer_type():
+
+    cryostream = _replay([(1.0, makeStatusPacket(sorted(_readyFields.items()), 1))])
+    packet     = makeStatusPacket([(1051, 29500), (1053, 3), (2021, 65534)], 7)
+
+    expected = [(1051, 29500), (1053, 3), (2021, 65534), (5000, 24), (5001, 7)]
+
+    for buffer in (packet, bytearray(packet), memoryview(packet)):
+        assert cryostream._parseBinaryStatusPacket(buffer)[:5] == expected
+
+def test_parse_rejects_packet_not_multiple_of_four():
+
+    cryostream = _replay([(1.0, makeStatusPacket(sorted(_readyFields.items()), 1))])
+
+    with pytest.raises(MalformedPacketError):
+        cryostream._parseBinaryStatusPacket(makeStatusPacket([(1051, 29500)], 2)[:-2])
+
+def test_recorded_packets_are_the_status(tmp_path):
+
+    records = _recordPackets(str(tmp_path / "status.csr"), [makeStatusPacket(sorted(_readyFields.items()), 1)])
+    cryostream = _replay(records)
+
+    assert isinstance(records[0][1], bytes)
+    assert cryostream.getMinTemperature() == 8000
+    assert cryostream.getMaxTemperature() == 40000
+    assert cryostream.getSampleTemperature() == 29500
+    assert cryostream.getRunMode() == "Ready"
+    assert cryostream.getProperty("Sample temp") == 295.0
+    assert cryostream.getProperty("Temp error") == -150
+    assert cryostream.getSnapshot().getTimestamp() == records[0][0]
+
+def test_malformed_recorded_packet_is_skipped(tmp_path):
+
+    good    = makeStatusPacket(sorted(_readyFields.items()), 1)
+    records = _recordPackets(str(tmp_path / "status.csr"), [good[:-3], good])
+
+    cryostream = _replay(records)
+
+    assert cryostream.getPacketErrorCounts()["malformed"] == 1
+    assert cryostream.getSnapshot().getTimestamp() == records[1][0]
+
+def test_late_recorded_packet_is_skipped(tmp_path):
+
+    fields  = dict(_readyFields)
+    packets = [makeStatusPacket(sorted(fields.items()), 2)]
+    fields[1051] = 29000
+    packets.append(makeStatusPacket(sorted(fields.items()), 1))
+    packets.append(makeStatusPacket(sorted(fields.items()), 3))
+
+    records    = _recordPackets(str(tmp_path / "status.csr"), packets)
+    cryostream = _replay(records)
+    cryostream.refreshStatus()
+
+    assert cryostream.getPacketErrorCounts()["late"] == 1
+    assert cryostream.getSampleTemperature() == 29000
+    assert cryostream.getSnapshot().getTimestamp() == records[2][0]
+
+#================
+#=== Commands ===
+#================
+
+def test_command_is_seven_bytes_with_checksum():
+
+    cryostream = _replay([(1.0, makeStatusPacket(sorted(_readyFields.items()), 1))])
+    command    = cryostream._binarizeCommand(cryostream._getCommandsList(0x0102, 10000, 300))
+
+    assert isinstance(command, bytes)
+    assert bytearray(command) == bytearray([0x01, 0x02, 0x27, 0x10, 0x01, 0x2C, (0x01 + 0x02 + 0x27 + 0x10 + 0x01 + 0x2C) % 256])
+
+    with pytest.raises(InvalidCommandError):
+        cryostream._binarizeCommand([0, 0, 0])
+
+def test_cool_is_confirmed_by_replayed_status(tmp_path):
+
+    records   = _recordPackets(str(tmp_path / "status.csr"), [makeStatusPacket(sorted(_readyFields.items()), 1)])
+    transport = _ReplayTransport(records, fields = dict(_readyFields))
+
+    cryostream = Cryostream800(_ip, transport = transport)
+    transport._coolCode = int(cryostream._commandBook["Cool"])
+
+    assert cryostream.coolWithConfirmation(100.0)
+    assert cryostream.getTargetTemperature() == 10000
+    assert cryostream.getRunMode() == "Running"
+
+    packet, address = transport.commands[-1]
+    assert address == (_ip, 30305)
+    assert struct.unpack(">HHH", packet[:6]) == (int(cryostream._commandBook["Cool"]), 10000, 10000)
+
+def test_cool_not_confirmed_reports_without_error(tmp_path, capsys):
+
+    records = _recordPackets(str(tmp_path / "status.csr"), [makeStatusPacket(sorted(_readyFields.items()), 1)])
+
+    # The status never changes, the device ignores the command
+    cryostream = Cryostream800(_ip, transport = _ReplayTransport(records, fields = dict(_readyFields)))
+
+    assert not cryostream.coolWithConfirmation(100.0, maxRetries = 1)
+    assert "Target Temperature: 100.0 K." in capsys.readouterr().out
+
+def test_profile_gives_up_when_device_goes_silent(tmp_path):
+
+    records   = _recordPackets(str(tmp_path / "status.csr"), [makeStatusPacket(sorted(_readyFields.items()), 1)])
+    transport = _ReplayTransport(records, fields = dict(_readyFields), silentAfter = 5)
+
+    cryostream = Cryostream800(_ip, transport = transport)
+    transport._coolCode = int(cryostream._commandBook["Cool"])
+
+    # Cool is confirmed, then the device is powered off while the profile waits for the end of the phase
+    assert not cryostream.runProfile([["cool", 100], ["end", 360]])
+
+    sent = [struct.unpack(">H", packet[:2])[0] for packet, address in transport.commands]
+    assert int(cryostream._commandBook["End"]) not in sent
+
+#===============
+#=== Network ===
+#===============
+
+def test_foreign_packets_are_skipped_until_own_packet():
+
+    # More devices than Cryostream800._maxSkippedPackets broadcast before this one in every round
+    foreignIPs = ["127.0.0." + str(host) for host in range(2, 15)]
+
+    with _LoopbackSubnetwork(foreignIPs, deviceIP = "127.0.0.1"):
+        cryostream = Cryostream800("127.0.0.1", statusTimeout = 2.0)
+        cryostream.refreshStatus()
+
+    assert cryostream.getPacketErrorCounts()["foreign"] >= len(foreignIPs)
+    assert cryostream.getRunMode() == "Ready"
+
+def test_only_foreign_packets_is_wrong_ip():
+
+    with _LoopbackSubnetwork(["127.0.0.2"]):
+        with pytest.raises(ForeignSourceError):
+            Cryostream800("127.0.0.1", statusTimeout = 0.5)
@@ -0,0 +1,185 @@
+import struct
+
+import pytest
+
+from cryostream_errors import MalformedPacketError
+from cryostream_fleet import makeStatusPacket
+from cryostream_integrity import PacketValidator, _confirmRun, _dropRun, _resetRun
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Tests of the integrity checks of the status packets (cryostream_integrity.py)
+# Packets are built with the size, id and checksum fields a device broadcasts (cryostream_fleet.makeStatusPacket)
+#
+# Usage:
+# python -m pytest -q test_cryostream_integrity.py
+
+# Fields of the packets, the sample temperature changes so the checksums differ
+def _packet(sequence, sampleTemp = 29500):
+    return makeStatusPacket([(1051, sampleTemp), (1053, 3), (1054, 1)], sequence)
+
+# Same packet with another checksum, as if the device summed the bytes another way
+def _otherChecksum(packet, checksum):
+    return packet[:-2] + struct.pack(">H", checksum & 0xFFFF)
+
+# Returns a validator with the size and checksum checks confirmed, and the id of the next packet
+def _confirmedValidator():
+
+    validator = PacketValidator()
+    for sequence in range(_confirmRun):
+        assert validator.check(_packet(sequence))
+
+    stats = validator.getStats()
+    assert stats["sizeConfirmed"] and stats["checksumConfirmed"]
+
+    return validator, _confirmRun
+
+#==========================
+#=== Size and checksum ===
+#==========================
+
+def test_checksum_is_not_enforced_before_a_run_of_matches():
+
+    validator = PacketValidator()
+
+    for sequence in range(_confirmRun - 1):
+        assert validator.check(_packet(sequence))
+    assert not validator.getStats()["checksumConfirmed"]
+
+    assert validator.check(_otherChecksum(_packet(_confirmRun), 0))
+    assert validator.getStats()["unverified"] == 1
+
+def test_chance_checksum_match_does_not_enforce_a_wrong_guess():
+
+    validator = PacketValidator()
+
+    # The device does not sum the bytes: every checksum is wrong for the validator, except one by chance
+    for sequence in range(200):
+        packet = _packet(sequence, 29000 + sequence)
+        if sequence != 50:
+            packet = _otherChecksum(packet, struct.unpack(">H", packet[-2:])[0] ^ 0x5A5A)
+        assert validator.check(packet)
+
+    stats = validator.getStats()
+    assert not stats["checksumConfirmed"]
+    assert stats["checksum"] == 0
+
+def test_confirmed_checksum_rejects_corrupted_packet():
+
+    validator, sequence = _confirmedValidator()
+
+    with pytest.raises(MalformedPacketError):
+        validator.check(_otherChecksum(_packet(sequence), 0))
+
+    assert validator.check(_packet(sequence + 1))
+    assert validator.getStats()["checksum"] == 1
+
+def test_confirmed_checksum_is_dropped_after_a_run_of_mismatches():
+
+    validator, sequence = _confirmedValidator()
+
+    for index in range(_dropRun - 1):
+        with pytest.raises(MalformedPacketError):
+            validator.check(_otherChecksum(_packet(sequence + index), 0))
+
+    # The check was wrong, the packets are accepted again
+    assert validator.check(_otherChecksum(_packet(sequence + _dropRun), 0))
+    assert validator.check(_otherChecksum(_packet(sequence + _dropRun + 1), 0))
+
+    stats = validator.getStats()
+    assert not stats["checksumConfirmed"]
+    assert stats["dropped"] == 1
+
+def test_truncated_packet_is_rejected_once_confirmed():
+
+    validator, sequence = _confirmedValidator()
+
+    # Cut before the integrity fields
+    with pytest.raises(MalformedPacketError):
+        validator.check(_packet(sequence)[:8])
+
+    # Size field announcing more bytes than received
+    packet = bytearray(_packet(sequence + 1))
+    struct.pack_into(">H", packet, 14, len(packet) + 8)
+    with pytest.raises(MalformedPacketError):
+        validator.check(bytes(packet))
+
+    assert validator.getStats()["truncated"] == 2
+
+def test_packet_without_integrity_fields_is_unchecked():
+
+    validator = PacketValidator()
+
+    assert validator.check(struct.pack(">HHHH", 1051, 29500, 1053, 3))
+    assert validator.getStats()["unchecked"] == 1
+
+#================
+#=== Sequence ===
+#================
+
+def test_gap_counts_lost_packets():
+
+    validator = PacketValidator()
+
+    for sequence in (1, 2, 5, 6):
+        assert validator.check(_packet(sequence))
+
+    stats = validator.getStats()
+    assert stats["lost"] == 2
+    assert stats["lossRate"] == 2 / 6.0
+
+def test_duplicate_and_late_packets():
+
+    validator = PacketValidator()
+
+    assert validator.check(_packet(10))
+    assert validator.check(_packet(10))
+    assert validator.check(_packet(12))
+    assert not validator.check(_packet(11))
+    assert validator.check(_packet(13))
+
+    stats = validator.getStats()
+    assert stats["duplicates"] == 1
+    assert stats["reordered"] == 1
+
+def test_packet_id_wraps_around():
+
+    validator = PacketValidator()
+
+    for sequence in (0xFFFE, 0xFFFF, 0, 1):
+        assert validator.check(_packet(sequence))
+
+    stats = validator.getStats()
+    assert stats["lost"] == 0
+    assert stats["resyncs"] == 0
+
+def test_large_jump_is_a_resync():
+
+    validator = PacketValidator()
+
+    assert validator.check(_packet(100))
+    assert validator.check(_packet(30000))
+    assert validator.check(_packet(30001))
+
+    stats = validator.getStats()
+    assert stats["resyncs"] == 1
+    assert stats["lost"] == 0
+
+def test_reset_to_a_lower_id_resyncs_after_a_run():
+
+    validator = PacketValidator()
+
+    for sequence in range(40, 50):
+        assert validator.check(_packet(sequence))
+
+    # The device restarted a few ids behind: the first packets look late, then the sequence is resynchronised
+    for sequence in range(30, 30 + _resetRun - 1):
+        assert not validator.check(_packet(sequence))
+    assert validator.check(_packet(30 + _resetRun - 1))
+    assert validator.check(_packet(30 + _resetRun))
+
+    stats = validator.getStats()
+    assert stats["resyncs"] == 1
+    assert stats["reordered"] == _resetRun - 1
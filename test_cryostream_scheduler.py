@@ -0,0 +1,157 @@
+import threading
+import time
+
+from cryostream_scheduler import CommandScheduler, PRIORITY_LOW
+
+#Authors:
+#John Taylor, Berkeley National Laboratory (Email: jrtaylor_at_lbl.gov)
+#Gabriel Gazolla, Berkeley National Laboratory (Email: gabrielgazolla_at_lbl.gov)
+
+# Tests of the command scheduler (cryostream_scheduler.py): priority order, single-flight and pre-emption
+# The device is replaced by an object with the same preempt() / clearPreempt() as Cryostream800,
+# whose commands record the order they ran in
+#
+# Usage:
+# python -m pytest -q test_cryostream_scheduler.py
+
+# Longest wait (s) of a test, a scheduler that misbehaves fails the test instead of hanging it
+_timeout = 5.0
+
+# Device with the pre-emption flag of Cryostream800 and commands that record their calls
+class _FakeDevice:
+
+    # Constructor
+    # onClearPreempt: called by clearPreempt() before the flag is cleared, to submit a command at that moment
+    def __init__(self, onClearPreempt = None):
+        self._preemptEvent   = threading.Event()
+        self._onClearPreempt = onClearPreempt
+        self.started         = threading.Event()
+        self.gate            = threading.Event()
+        self.calls           = []
+
+    def getIP(self):
+        return "10.0.0.6"
+
+    def preempt(self):
+        self._preemptEvent.set()
+
+    def clearPreempt(self):
+        if self._onClearPreempt is not None:
+            onClearPreempt, self._onClearPreempt = self._onClearPreempt, None
+            onClearPreempt()
+        self._preemptEvent.clear()
+
+    # Slow command: runs until pre-empted, as a confirmation loop gives up at its next attempt
+    def coolWithConfirmation(self, targetTemp):
+        self.calls.append(("cool", targetTemp))
+        self.started.set()
+        return not self._preemptEvent.wait(_timeout)
+
+    # Blocks the worker until the test opens the gate, so commands can be queued behind it
+    def restartWithConfirmation(self):
+        self.calls.append(("restart",))
+        self.started.set()
+        self.gate.wait(_timeout)
+        return True
+
+    def stopWithConfirmation(self):
+        self.calls.append(("stop",))
+        return True
+
+    def setTurboModeWithConfirmation(self, mode):
+        self.calls.append(("turbo", mode))
+        return True
+
+    def setAutofillModeWithConfirmation(self, mode):
+        self.calls.append(("autofill", mode))
+        return True
+
+def test_stop_preempts_running_command():
+
+    device    = _FakeDevice()
+    scheduler = CommandScheduler(device)
+
+    cool = scheduler.cool(100)
+    assert device.started.wait(_timeout)
+
+    start = time.time()
+    stop  = scheduler.stop()
+
+    assert cool.result(_timeout) is False
+    assert stop.result(_timeout) is True
+    assert time.time() - start < 1.0
+    assert device.calls == [("cool", 100), ("stop",)]
+
+    scheduler.close()
+
+def test_stop_submitted_while_worker_switches_commands_preempts():
+
+    scheduler = []
+    futures   = []
+
+    # A client submits Stop while the worker clears the pre-emption flag of the command it starts
+    def submitStop():
+        submitter = threading.Thread(target = lambda: futures.append(scheduler[0].stop()))
+        submitter.start()
+        submitter.join(0.2)
+
+    device = _FakeDevice(onClearPreempt = submitStop)
+    scheduler.append(CommandScheduler(device))
+
+    cool = scheduler[0].cool(100)
+
+    assert cool.result(_timeout) is False
+    assert device.calls == [("cool", 100), ("stop",)]
+
+    scheduler[0].close()
+
+def test_commands_run_in_priority_order():
+
+    device    = _FakeDevice()
+    scheduler = CommandScheduler(device)
+
+    restart = scheduler.restart()
+    assert device.started.wait(_timeout)
+
+    futures = [
+        scheduler.submit("setAutofillModeWithConfirmation", 1, priority = PRIORITY_LOW),
+        scheduler.setTurboMode(1),
+        scheduler.setTurboMode(0),
+        scheduler.stop(),
+    ]
+
+    device.gate.set()
+    for future in [restart] + futures:
+        assert future.result(_timeout) is True
+
+    assert device.calls == [("restart",), ("stop",), ("turbo", 1), ("turbo", 0), ("autofill", 1)]
+
+    scheduler.close()
+
+def test_identical_commands_share_one_execution():
+
+    device    = _FakeDevice()
+    scheduler = CommandScheduler(device)
+
+    restart = scheduler.restart()
+    assert device.started.wait(_timeout)
+
+    first  = scheduler.setTurboMode(1)
+    second = scheduler.setTurboMode(1.0)
+    other  = scheduler.setTurboMode(0)
+
+    assert first is second
+    assert other is not first
+    assert scheduler.pending() == 2
+
+    device.gate.set()
+    for future in (restart, first, other):
+        assert future.result(_timeout) is True
+
+    assert device.calls.count(("turbo", 1)) == 1
+
+    # Once finished, the same command runs again
+    assert scheduler.setTurboMode(1).result(_timeout) is True
+    assert device.calls.count(("turbo", 1)) == 2
+
+    scheduler.close()